@@ -9,50 +9,109 @@ import time
 from copy import deepcopy
 from functools import partial
 
-import bayesian_changepoint_detection.online_changepoint_detection as oncd
-import falcon_mpsched as mpsched
 import matplotlib.pyplot as plt
+import mpsched_backend as mpsched
 import numpy as np
 import pandas as pd
 import torch
-from bayes_online import BayesOnline
+from action_cache import create_action_cache
+from changepoint import create_detector
+from decision_clock import DecisionClock, create_clock
 
 # from env import Env
 from DQN import DQN_Agent
 from env import Env
-from replay_memory import ReplayMemory, Transition
+from model_bank import open_bank
+from policy_table import PolicyTable, TableBuilder
+from replay_memory import ReplayMemory, Transition, anneal_beta
+from telemetry import create_telemetry
 from torch.autograd import Variable
 from torch.optim import Adam
+from training_throttle import create_throttle
 
 CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
 TMP_DIR = CURRENT_DIR / "artifacts"
 
 
-class Online_Agent(threading.Thread):
-    """Online Agent thread that runs parallel to scheduling/sending data
-    Derives scheduling policy based on K-shot optimized meta models depending on current network characteristics
-    Meta Models are called from files that are created in Offline Agent (slower loop)
+class ConnectionContext:
+    """State of the online agent for a single MPTCP connection: environment, changepoint detector, path
+    characteristics and fine tune experience of the connection. The decisions are taken by the inference engine
 
     :param fd: socket file descriptor
     :type fd: int
     :param cfg: contains all the neccessary training parameter read from config.ini
     :type cfg: configParser
-    :param event: event to inform the online agent of finished MPTCP connection and no need to perform new interactions
-    :type event: class:'threading.event'
+    :param path_char: path characteristics the connection starts with
+    :type path_char: list
+    :param slot: slot of the connection in the slot table of process mode, see engine_ipc
+    :type slot: int
     """
 
-    def __init__(self, fd, cfg, event):
-        threading.Thread.__init__(self)
+    def __init__(self, fd, cfg, path_char, slot=None):
         self.fd = fd
-        self.cfg = cfg
-        self.memory = str((TMP_DIR / cfg.get("replaymemory", "memory")).resolve())
-        self.agent_name = str((TMP_DIR / cfg.get("dqn", "agent")).resolve()) + "/"
-        self.agent = torch.load(self.agent_name + "0000.pkl")
+        self.slot = slot
         self.env = Env(
-            fd=self.fd,
-            time=self.cfg.getfloat("env", "time"),
+            fd=fd,
+            time=cfg.getfloat("env", "time"),
             max_flows=cfg.getint("train", "max_num_flows"),
+            clock=create_clock(cfg),
+        )
+        # one changepoint detector per characteristic and subflow
+        self.det = create_detector(
+            cfg,
+            cfg.getint("train", "num_characteristics")
+            * cfg.getint("train", "max_num_flows"),
         )
+        self.path_char = list(path_char)
+        self.index = "".join(str(x) for x in self.path_char)
+        self.ft_replay_memory = ReplayMemory(
+            cfg.getint("train", "batch_size")
+        )  # replay memory for fine tune
+        self.telemetry = create_telemetry(cfg, TMP_DIR)
+        self.action_cache = create_action_cache(cfg)
+        self.state = None
+        self.action = None
+        self.detached = False  # transfer over, no further decisions
+        # set once the engine no longer uses the connection
+        self.finished = threading.Event()
+
+    def start(self):
+        """Take the first observations of the connection"""
+        if self.telemetry is not None:
+            self.env.telemetry = self.telemetry.start(self.fd)
+        self.state = self.env.reset()
+
+    def stop(self):
+        try:
+            if self.telemetry is not None:
+                self.telemetry.stop()
+                self.env.telemetry = None
+            if self.action_cache is not None:
+                print(f"action cache: {self.action_cache.summary()}")
+        finally:
+            self.finished.set()
+
+
+class InferenceEngine(threading.Thread):
+    """Online Agent thread that runs parallel to scheduling/sending data
+    Derives scheduling policy based on K-shot optimized meta models depending on current network characteristics
+    Meta Models are called from files that are created in Offline Agent (slower loop)
+
+    Every connection has a context of its own. Each tick the engine decides for all active connections with one
+    forward pass per meta model in use, sets the subflows, waits once for the shortest SI of the connections and
+    observes all of them. Meta models are loaded once per path characteristics and shared by the connections.
+
+    :param cfg: contains all the neccessary training parameter read from config.ini
+    :type cfg: configParser
+    :param event: set by the engine while a connection is attached
+    :type event: class:'multiprocessing.Event'
+    """
+
+    def __init__(self, cfg, event):
+        threading.Thread.__init__(self)
+        self.cfg = cfg
+        self.memory = str((TMP_DIR / cfg.get("replaymemory", "memory")).resolve())
+        self.bank = open_bank(cfg, TMP_DIR)
         self.batch_size = cfg.getint("train", "batch_size")
         self.event = event
         self.k = cfg.get("dqn", "k")
@@ -67,112 +126,249 @@ class Online_Agent(threading.Thread):
             list((map(float, cfg.get("train", "rtt_range").split(","))))
         )
         self.R_s = [loss_range1, loss_range1, rtt_range1, rtt_range1]
+        # last detected path characteristics, new connections start with them
         self.path_char = [0] * (
             cfg.getint("train", "max_num_flows")
             * cfg.getint("train", "num_characteristics")
         )
-        self.done = False
-        self.ft_replay_memory = ReplayMemory(
-            self.batch_size
-        )  # replay memory for fine tune
         self.fft = 0  # first fine tune after starting testing
+        self.use_table = cfg.getboolean("lookup", "enabled")
+        self.table_name = str((TMP_DIR / cfg.get("lookup", "tables")).resolve()) + "/"
+        self.models = {}  # meta model of every path characteristics in use
+        # lookup table of every loaded meta model if enabled, None if none was exported
+        self.tables = {}
+        # tables of fine tuned or reloaded meta models are built off the tick
+        self.table_builder = TableBuilder(self.tables.__setitem__)
+        self.clock = DecisionClock(cfg.getfloat("env", "time"))
+        self.contexts = (
+            []
+        )  # connections decided by the engine, only used by the engine thread
+        self.pending = []  # attached connections the engine has not seen yet
+        self.attached = 0
+        self.lock = threading.Condition()
+        # slot table of process mode, see engine_ipc
+        self.slots = None
+
+    def attach(self, fd, slot=None):
+        """Start deciding for a new connection, called by the thread serving it
+
+        :param fd: socket file descriptor
+        :type fd: int
+        :param slot: slot of the connection in process mode
+        :type slot: int
+        :return: context of the connection, pass it to detach at the end of the transfer
+        :rtype: class:'ConnectionContext'
+        """
+        ctx = ConnectionContext(fd, self.cfg, self.path_char, slot)
+        ctx.start()
+        with self.lock:
+            self.pending.append(ctx)
+            self.attached += 1
+            self.event.set()
+            self.lock.notify()
+        return ctx
+
+    def detach(self, ctx, timeout=None):
+        """End the decisions for a connection, returns once the engine no longer uses its socket
+
+        :param ctx: context returned by attach
+        :type ctx: class:'ConnectionContext'
+        :param timeout: seconds to wait for the engine, no limit if None
+        :type timeout: float
+        :return: False on timeout
+        :rtype: bool
+        """
+        ctx.detached = True
+        finished = ctx.finished.wait(timeout)
+        with self.lock:
+            self.attached -= 1
+            if self.attached == 0:
+                self.event.clear()
+        return finished
 
     def run(self):
         """Override the run method from threading with the desired behaviour of the Online Agent class"""
-        detected_change = 0
-        self.fft = 0
+        if self.use_table:
+            self.table_builder.start()
+        # creating the first model of a process takes seconds, not to be spent on the first connection
+        try:
+            self.model("".join(str(x) for x in self.path_char))
+        except Exception as e:
+            print(f"Failed to load the first meta model: {e}")
         while True:
-            self.event.wait()
-            det = []
-            for i in range(self.num_char * self.max_flows):
-                det.append(BayesOnline())
-            state = self.env.reset()
-            start = time.time()
-            # if not self.done:
-            # print(*(state[0 : self.max_flows]))
-            count = 0
-            while True:
-                action = self.agent.select_action(torch.FloatTensor(state).unsqueeze(0))
-                end = time.time()
-                active = [0] * self.max_flows
-                active[action] = 1
-                # if not self.done:
-                # print(end - start)
-                # print(*active)
-                state_nxt, reward, self.done, cond = self.env.step((action))
-                start = time.time()
-                if self.done or (not self.event.is_set()):
+            with self.lock:
+                while not self.contexts and not self.pending:
+                    self.lock.wait()
+                if not self.contexts:
+                    self.clock.start()
+                self.contexts.extend(self.pending)
+                self.pending.clear()
+            try:
+                self.tick()
+            except Exception as e:
+                # the engine keeps running for the connections attached later, the handlers of the failed ones
+                # must not wait for it forever
+                print(f"Failed in inference engine tick: {e}")
+                for ctx in self.contexts:
+                    ctx.stop()
+                self.contexts = []
+
+    def tick(self):
+        """One decision for every active connection"""
+        self.decide()
+        for ctx in self.contexts:
+            ctx.env.act(ctx.action)
+            if ctx.slot is not None:
+                self.slots.record(ctx.slot, [ctx.action])
+        self.clock.interval = min(ctx.env.clock.interval for ctx in self.contexts)
+        self.clock.wait()
+
+        active = []
+        rows = []
+        for ctx in self.contexts:
+            try:
+                state_nxt, reward, done, cond = ctx.env.observe()
+                if done or ctx.detached:
                     self.fft += 1
-                    break
-                # print(cond)
-                # if not self.done:
-                # print(*(state_nxt[0 : self.max_flows]))
-
-                # print(self.agent.train_steps)
-                mask = not self.done
-                if len(self.ft_replay_memory) >= 32:
-                    if self.fft == 11:
-                        index = "".join(str(x) for x in self.path_char)
-                        self.agent = torch.load(self.agent_name + index + ".pkl")
-                        if len(self.ft_replay_memory) >= self.batch_size:
-                            print("first fine tune for static scenario")
-                            transitions = self.ft_replay_memory.sample(self.batch_size)
-                            batch = Transition(*zip(*transitions))
-                            loss = self.agent.train(batch, int(self.k))
-                            # print(loss)
-                            self.fft = 12
-                    self.ft_replay_memory = ReplayMemory(self.batch_size)
-                self.ft_replay_memory.push(
-                    torch.FloatTensor(state).unsqueeze(0),
-                    torch.Tensor([float(action)]),
-                    torch.FloatTensor([mask]),
-                    torch.FloatTensor(state_nxt).unsqueeze(0),
-                    torch.FloatTensor([float(reward)]),
+                    ctx.stop()
+                    continue
+                rows.extend(self.learn(ctx, state_nxt, reward, not done, cond))
+            except Exception as e:
+                print(f"Failed in online agent of connection {ctx.fd}: {e}")
+                ctx.stop()
+                continue
+            active.append(ctx)
+        self.contexts = active
+        if not active:
+            print(f"decision clock: {self.clock.summary()}")
+        if rows:
+            # one write per tick for all connections
+            try:
+                pd.DataFrame(rows).to_csv(
+                    self.memory, mode="a+", index=False, header=False
                 )
+            except OSError as e:
+                print(f"Failed to write the online experience: {e}")
 
-                df = pd.DataFrame.from_dict(
-                    {
-                        "state": pd.Series(state),
-                        "action": pd.Series(action),
-                        "mask": pd.Series(mask),
-                        "next state": pd.Series(state_nxt),
-                        "reward": pd.Series(reward),
-                        "condition": pd.Series(self.path_char),
-                    },
-                    orient="index",
+    def decide(self):
+        """Actions of all active connections, the states of the connections with the same meta model are evaluated in
+        one batch"""
+        groups = {}
+        for ctx in self.contexts:
+            groups.setdefault(ctx.index, []).append(ctx)
+        for index, group in groups.items():
+            agent = self.model(index)
+            table = self.tables.get(index)
+            states = np.stack([ctx.state for ctx in group])
+            if table is not None:
+                actions = table.select_actions(states)
+            elif group[0].action_cache is not None:
+                actions = agent.select_actions(
+                    states, [ctx.action_cache for ctx in group]
                 )
+            else:
+                actions = agent.select_actions(states)
+            for ctx, action in zip(group, actions):
+                ctx.action = int(action)
+
+    def learn(self, ctx, state_nxt, reward, mask, cond):
+        """Fine tune experience and changepoint detection of a connection after a decision
+
+        :return: rows of the decision for the online experience csv
+        :rtype: list
+        """
+        state = ctx.state
+        action = ctx.action
+        if len(ctx.ft_replay_memory) >= 32:
+            if self.fft == 11:
+                agent = self.model(ctx.index, reload=True)
+                if len(ctx.ft_replay_memory) >= self.batch_size:
+                    print("first fine tune for static scenario")
+                    batch = ctx.ft_replay_memory.sample(self.batch_size)
+                    loss, _ = agent.train(batch, int(self.k))
+                    self.rebuild_table(ctx.index)
+                    self.fft = 12
+            ctx.ft_replay_memory = ReplayMemory(self.batch_size)
+        ctx.ft_replay_memory.push(
+            torch.as_tensor(state, dtype=torch.float32).unsqueeze(0),
+            torch.Tensor([float(action)]),
+            torch.FloatTensor([mask]),
+            torch.as_tensor(state_nxt, dtype=torch.float32).unsqueeze(0),
+            torch.FloatTensor([float(reward)]),
+        )
+
+        # rows of the online experience csv, padded to the longest row when written
+        experience = [
+            list(state),
+            [action],
+            [mask],
+            list(state_nxt),
+            [reward],
+            list(ctx.path_char),
+        ]
 
-                df.to_csv(self.memory, mode="a+", index=False, header=False)
-
-                for m in range(self.num_char * self.max_flows):
-                    det[m].update(cond[m])
-                    prob = det[m].get_probabilities(
-                        32
-                    )  # changepoint over the last 32 points (batch_size)
-                    if len(prob) >= 1 and np.any(prob[1:] > 0.95):
-                        det[m] = BayesOnline()
-                        detected_change = 1
-                if detected_change:
-                    detected_change = 0
-                    last_path_char = self.path_char
-                    for i in range(len(self.R_s)):
-                        for k in range(self.num_ranges):
-                            if self.R_s[i][0::2][k] <= cond[i] <= self.R_s[i][1::2][k]:
-                                self.path_char[i] = k
-                    if np.any(last_path_char != self.path_char):
-                        index = "".join(str(x) for x in self.path_char)
-                        self.agent = torch.load(self.agent_name + index + ".pkl")
-                        if len(self.ft_replay_memory) > self.batch_size:
-                            transitions = self.ft_replay_memory.sample(self.batch_size)
-                            batch = Transition(*zip(*transitions))
-                            loss = self.agent.train(batch, int(self.k))
-
-                # print(self.path_char)
-                state = state_nxt
-
-    def update_fd(self, fd):
-        """Update the current file descriptor used in the Environment Class for reading information from subflows with socket options"""
-        self.env.update_fd(fd)
+        if np.any(ctx.det.update(cond[: self.num_char * self.max_flows])):
+            last_path_char = list(ctx.path_char)
+            for i in range(len(self.R_s)):
+                for k in range(self.num_ranges):
+                    if self.R_s[i][0::2][k] <= cond[i] <= self.R_s[i][1::2][k]:
+                        ctx.path_char[i] = k
+            if last_path_char != ctx.path_char:
+                ctx.index = "".join(str(x) for x in ctx.path_char)
+                self.path_char = list(ctx.path_char)
+                agent = self.model(ctx.index, reload=True)
+                if len(ctx.ft_replay_memory) > self.batch_size:
+                    batch = ctx.ft_replay_memory.sample(self.batch_size)
+                    loss, _ = agent.train(batch, int(self.k))
+                    self.rebuild_table(ctx.index)
+
+        ctx.state = state_nxt
+        return experience
+
+    def model(self, index, reload=False):
+        """Meta model of path characteristics, shared by all connections with them. Loading the lookup table of the
+        meta model if the lookup mode is enabled. Tables hold the greedy policy, there is no exploration while deciding
+        by lookup
+
+        :param index: path characteristics of the meta model
+        :type index: str
+        :param reload: load the latest meta model of the offline agent even if the model is loaded already
+        :type reload: bool
+        :rtype: class:'DQN.DQN_Agent'
+        """
+        if reload or index not in self.models:
+            self.models[index] = self.bank.load(index)
+            if self.use_table:
+                self.load_table(index)
+        return self.models[index]
+
+    def load_table(self, index):
+        """Lookup table of a meta model that was just loaded. The exported table is used the first time, the table of a
+        reloaded model is evaluated again from the loaded network since the exported one may be older than the model.
+        Without an exported table the meta model decides
+
+        :param index: path characteristics of the meta model
+        :type index: str
+        """
+        if index in self.tables:
+            self.rebuild_table(index)
+            return
+        path = self.table_name + index + ".npz"
+        if os.path.exists(path):
+            self.tables[index] = PolicyTable.load(path)
+        else:
+            print(f"Warning: no lookup table {path}, deciding with the meta model")
+            self.tables[index] = None
+
+    def rebuild_table(self, index):
+        """Evaluate the lookup table again after the meta model was fine tuned or reloaded. The table is built by the
+        table builder, the connections are decided with the old table until it is done
+        """
+        table = self.tables.get(index)
+        if table is not None:
+            self.table_builder.request(
+                index, self.models[index].policy_network, table.grids
+            )
 
 
 class Offline_Agent(multiprocessing.Process):
@@ -183,15 +379,15 @@ class Offline_Agent(multiprocessing.Process):
 
     :param cfg: contains all the neccessary training parameter read from config.ini
     :type cfg: configParser
-    :param event: event indicating start/end of episode
-    :type event: class:'threading.event'
+    :param event: set while a transfer is in flight, training is throttled meanwhile (training_throttle.py)
+    :type event: class:'multiprocessing.Event'
     """
 
     def __init__(self, cfg, event):
         """Constructor Method"""
         multiprocessing.Process.__init__(self)
         self.memory_name = str((TMP_DIR / cfg.get("replaymemory", "memory")).resolve())
-        self.nn = str((TMP_DIR / cfg.get("dqn", "agent")).resolve()) + "/"
+        self.bank = open_bank(cfg, TMP_DIR)
         self.cfg = cfg
         self.episode = cfg.getint("train", "episode")
         self.batch_size = cfg.getint("train", "batch_size")
@@ -228,8 +424,21 @@ class Offline_Agent(multiprocessing.Process):
         self.replay_memory = []
         for i in range(len(self.ALL_CHAR)):
             self.replay_memory.append(
-                ReplayMemory(cfg.getint("replaymemory", "capacity"))
+                ReplayMemory(
+                    cfg.getint("replaymemory", "capacity"),
+                    dtype=getattr(torch, cfg.get("replaymemory", "dtype")),
+                )
             )
+        # prioritized replay, samples uniformly for priority_alpha = 0
+        priority_alpha = cfg.getfloat("replaymemory", "priority_alpha")
+        self.priority_beta = cfg.getfloat("replaymemory", "priority_beta")
+        self.beta_steps = cfg.getint("replaymemory", "beta_steps")
+        if priority_alpha > 0:
+            for memory in self.replay_memory:
+                memory.enable_priorities(priority_alpha)
+        # number of transitions each partition received since its meta model was last
+        # updated, partitions without new experience are neither trained nor saved
+        self.new_transitions = np.zeros(len(self.ALL_CHAR), dtype=np.int64)
 
     def run(self):
         """Override the run method from threading with the desired behaviour of the Online Agent class"""
@@ -240,6 +449,8 @@ class Offline_Agent(multiprocessing.Process):
         )
         checkpoint = 0
         weights_before = None
+        # created in the process of the offline agent, the policy applies to its threads
+        throttle = create_throttle(self.cfg, self.event)
         Exp = [[0]]  # dataframe to save online experience
         print("start server")
         while True:
@@ -271,24 +482,38 @@ class Offline_Agent(multiprocessing.Process):
                     ).unsqueeze(0),
                     torch.FloatTensor([float(Exp.iloc[t - 1][0])]),
                 )
+                self.new_transitions[combination_index] += 1
                 t += 6
                 if t >= len(Exp[0]):
                     break
 
             # reptile learning loop using openai/research/reptile as reference
-            # do n_iteration for ever partitioned group to create all meta models
-            for k in range(len(self.ALL_CHAR)):
+            # do n_iteration for every partitioned group with new experience to update its
+            # meta model, partitions with the most new transitions first
+            for k in self.dirty_partitions():
                 number_of_convergence_points = 0
                 index = "".join(str(x) for x in self.ALL_CHAR[k])
-                agent_name = self.nn + index + ".pkl"
-                agent = torch.load(agent_name)
+                agent = self.bank.load(index)
                 for i in range(n_iterations):
                     if len(self.replay_memory[k]) > self.batch_size * 1000:
+                        throttle.step()
                         weights_before = deepcopy(agent.policy_network.state_dict())
 
-                        transitions = self.replay_memory[k].sample(self.batch_size)
-                        batch = Transition(*zip(*transitions))
-                        loss = agent.train(batch, self.k)
+                        memory = self.replay_memory[k]
+                        if memory.priorities is not None:
+                            batch, positions, weights = memory.sample_prioritized(
+                                self.batch_size,
+                                anneal_beta(
+                                    self.priority_beta,
+                                    agent.train_steps,
+                                    self.beta_steps,
+                                ),
+                            )
+                            loss, td_errors = agent.train(batch, self.k, weights)
+                            memory.update_priorities(positions, td_errors)
+                        else:
+                            batch = memory.sample(self.batch_size)
+                            loss, _ = agent.train(batch, self.k)
                         weights_after = agent.policy_network.state_dict()
 
                         outer_step_size = outer_step_size0 * (1 - i / n_iterations)
@@ -301,5 +526,19 @@ class Offline_Agent(multiprocessing.Process):
                         # for the next k step of optimization in the following episode
                         agent.update_state_dict(weights_before, i)
 
-                torch.save(agent, agent_name)
+                self.bank.save(index, agent)
+                self.new_transitions[k] = 0
             time.sleep(5)
+
+    def dirty_partitions(self):
+        """Partitions that received new transitions since their last meta update and hold enough experience
+        to be trained, ordered by the number of new transitions (largest first)
+
+        :return: indices into ALL_CHAR of the partitions to update in this cycle
+        :rtype: numpy.ndarray
+        """
+        sizes = np.array([len(memory) for memory in self.replay_memory])
+        ready = np.flatnonzero(
+            (self.new_transitions > 0) & (sizes > self.batch_size * 1000)
+        )
+        return ready[np.argsort(-self.new_transitions[ready], kind="stable")]
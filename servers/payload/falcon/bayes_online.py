@@ -11,11 +11,14 @@
 """Tools for performing online Bayesian changepoint detection"""
 import math
 
-import numba
+import numba_compat as numba
 import numpy as np
-from scipy import signal, stats
+from scipy import signal, special, stats
 
 _jit = numba.jit(nopython=True, nogil=True)
+# kernels without jitclass arguments are cached on disk, numba cannot reuse the
+# cache of kernels that take jitclass instances in a new process
+_jit_cached = numba.jit(nopython=True, nogil=True, cache=True)
 
 
 class ConstHazard:
@@ -113,7 +116,7 @@ class StudentT:
         self._beta = betaT0
 
 
-@_jit
+@_jit_cached
 def t_pdf(x, df, loc=0, scale=1):
     """Numba-based implementation of :py:func:`scipy.stats.t.pdf`
     This is for scalars only.
@@ -218,6 +221,227 @@ def segmentation_numba(data, hazard, obs_likelihood):
     return ret
 
 
+def bank_step(x, p, alpha, beta, kappa, mu, prior, hazard):
+    """Calculate changepoint probabilities for a bank of detectors (in place)
+    Every row of `p` holds the run length probabilities of one stream,
+    truncated to a fixed maximum run length. The probability mass that
+    would grow beyond the last run length is dropped before
+    renormalization.
+    Parameters
+    ----------
+    x : numpy.ndarray
+        New datapoint of every stream, shape (n_streams,)
+    p : numpy.ndarray
+        Run length probabilities, shape (n_streams, max_run_length)
+    alpha, beta, kappa, mu : numpy.ndarray
+        Student T parameters for every stream and run length, same shape
+        as `p`
+    prior : numpy.ndarray
+        Prior parameters ``[alpha, beta, kappa, mu]`` used for run length 0
+    hazard : float
+        Constant hazard
+    """
+    xs = x[:, None]
+    df = 2 * alpha
+    scale = np.sqrt(beta * (kappa + 1) / (alpha * kappa))
+    y = (xs - mu) / scale
+    predprobs = np.exp(
+        special.gammaln((df + 1) / 2)
+        - special.gammaln(df / 2)
+        - (df + 1) / 2 * np.log1p(y**2 / df)
+    ) / (np.sqrt(np.pi * df) * scale)
+
+    growth = p * predprobs
+    p[:, 0] = np.sum(growth, axis=1) * hazard
+    p[:, 1:] = growth[:, :-1] * (1 - hazard)
+    p /= np.sum(p, axis=1, keepdims=True)
+
+    beta[:, 1:] = (beta + (kappa * (xs - mu) ** 2) / (2.0 * (kappa + 1.0)))[:, :-1]
+    mu[:, 1:] = ((kappa * mu + xs) / (kappa + 1))[:, :-1]
+    kappa[:, 1:] = kappa[:, :-1] + 1.0
+    alpha[:, 1:] = alpha[:, :-1] + 0.5
+    alpha[:, 0], beta[:, 0], kappa[:, 0], mu[:, 0] = prior
+
+
+@_jit_cached
+def bank_step_numba(x, p, alpha, beta, kappa, mu, prior, hazard):
+    """Numba-based implementation of :py:func:`bank_step`"""
+    n_streams, max_run_length = p.shape
+    for s in range(n_streams):
+        cp = 0.0
+        total = 0.0
+        # walk backwards so that every run length can be shifted in place
+        for r in range(max_run_length - 1, -1, -1):
+            scale = math.sqrt(
+                beta[s, r] * (kappa[s, r] + 1) / (alpha[s, r] * kappa[s, r])
+            )
+            growth = p[s, r] * t_pdf(x[s], 2 * alpha[s, r], mu[s, r], scale)
+            cp += growth * hazard
+            if r + 1 < max_run_length:
+                p[s, r + 1] = growth * (1 - hazard)
+                total += p[s, r + 1]
+                beta[s, r + 1] = beta[s, r] + (kappa[s, r] * (x[s] - mu[s, r]) ** 2) / (
+                    2.0 * (kappa[s, r] + 1.0)
+                )
+                mu[s, r + 1] = (kappa[s, r] * mu[s, r] + x[s]) / (kappa[s, r] + 1)
+                kappa[s, r + 1] = kappa[s, r] + 1.0
+                alpha[s, r + 1] = alpha[s, r] + 0.5
+        p[s, 0] = cp
+        total += cp
+        for r in range(max_run_length):
+            p[s, r] /= total
+        alpha[s, 0] = prior[0]
+        beta[s, 0] = prior[1]
+        kappa[s, 0] = prior[2]
+        mu[s, 0] = prior[3]
+
+
+class BayesOnlineBank:
+    """Bank of Bayesian online changepoint detectors with bounded memory
+    Runs one detector per stream, as :py:class:`BayesOnline` with constant
+    hazard and Student T observation likelihood does, but updates all
+    streams with a single call. Run lengths are truncated at
+    `max_run_length` and only the last `history` probability vectors are
+    kept in a ring buffer, so the cost of an update does not grow with the
+    number of datapoints seen.
+    """
+
+    def __init__(
+        self,
+        num_streams,
+        max_run_length=128,
+        history=32,
+        time_scale=250.0,
+        obs_params={"alpha": 0.1, "beta": 0.01, "kappa": 1.0, "mu": 0.0},
+        engine="numba",
+    ):
+        """Parameters
+        ----------
+        num_streams : int
+            Number of independent data streams
+        max_run_length : int, optional
+            Largest run length that is tracked. Defaults to 128.
+        history : int, optional
+            Number of probability vectors kept in the ring buffer, at least
+            2. Defaults to 32.
+        time_scale : float, optional
+            Time scale of the constant hazard. Defaults to 250.
+        obs_params : dict, optional
+            Prior parameters of the Student T observation likelihood.
+            Defaults to ``{"alpha": 0.1, "beta": 0.01, "kappa": 1., "mu": 0.}``.
+        """
+        self._use_numba = (engine == "numba") and numba.numba_available
+        self.hazard = 1 / time_scale
+        self.prior = np.array(
+            [
+                obs_params["alpha"],
+                obs_params["beta"],
+                obs_params["kappa"],
+                obs_params["mu"],
+            ],
+            dtype=np.float64,
+        )
+        shape = (num_streams, max_run_length)
+        self._alpha = np.empty(shape)
+        self._beta = np.empty(shape)
+        self._kappa = np.empty(shape)
+        self._mu = np.empty(shape)
+        self.history = np.zeros((max(history, 2),) + shape)
+        self._head = 0
+        self.num_updates = np.zeros(num_streams, dtype=np.int64)
+
+        self.reset()
+
+    @property
+    def probabilities(self):
+        """Current run length probabilities, shape (num_streams, max_run_length)"""
+        return self.history[self._head]
+
+    def reset(self, streams=None):
+        """Reset detectors
+        Parameters
+        ----------
+        streams : numpy.ndarray or None, optional
+            Boolean mask or indices of the streams to reset. If `None`,
+            reset all streams. Defaults to `None`.
+        """
+        if streams is None:
+            streams = slice(None)
+        self.history[:, streams] = 0
+        self.history[self._head, streams, 0] = 1
+        self._alpha[streams] = self.prior[0]
+        self._beta[streams] = self.prior[1]
+        self._kappa[streams] = self.prior[2]
+        self._mu[streams] = self.prior[3]
+        self.num_updates[streams] = 0
+
+    def update(self, x):
+        """Add a data point to every stream and calculate changepoint probabilities
+        Parameters
+        ----------
+        x : array-like
+            New data point of every stream
+        """
+        x = np.asarray(x, dtype=np.float64)
+        head = (self._head + 1) % len(self.history)
+        self.history[head] = self.history[self._head]
+        step = bank_step_numba if self._use_numba else bank_step
+        step(
+            x,
+            self.history[head],
+            self._alpha,
+            self._beta,
+            self._kappa,
+            self._mu,
+            self.prior,
+            self.hazard,
+        )
+        self._head = head
+        self.num_updates += 1
+
+    def detect(self, past, prob_threshold):
+        """Check for changepoints `past` data points back
+        Equivalent to checking ``BayesOnline.get_probabilities(past)[1:]``
+        against the threshold after every update: only the probability
+        vector that just left the head of the ring buffer has to be looked
+        at, older ones were checked by previous calls.
+        Parameters
+        ----------
+        past : int
+            How many datapoints into the past to look, smaller than
+            `max_run_length`
+        prob_threshold : float
+            Changepoint probability above which a changepoint is reported
+        Returns
+        -------
+        numpy.ndarray
+            Boolean mask of the streams with a changepoint
+        """
+        previous = self.history[(self._head - 1) % len(self.history)]
+        return (self.num_updates >= past + 2) & (previous[:, past] > prob_threshold)
+
+    def get_probabilities(self, past):
+        """Get changepoint probabilities of the recent history
+        Like :py:meth:`BayesOnline.get_probabilities`, but limited to the
+        probability vectors held in the ring buffer.
+        Parameters
+        ----------
+        past : int
+            How many datapoints into the past to look
+        Returns
+        -------
+        numpy.ndarray
+            Changepoint probabilities, shape (history - 1, num_streams),
+            oldest first. Entries of data points before the `past`-th one
+            after the last reset are 0.
+        """
+        n = len(self.history)
+        steps_back = np.arange(n - 1, 0, -1)
+        prob = self.history[(self._head - steps_back) % n, :, past]
+        prob[self.num_updates[None, :] - steps_back[:, None] < past] = 0
+        return prob
+
+
 class BayesOnline:
     """Bayesian online changepoint detector
     This is an implementation of [Adam2007]_ based on the one from the
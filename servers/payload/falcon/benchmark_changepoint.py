@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+# Compares the changepoint detectors of changepoint.py on recorded or synthetic network condition streams
+
+import argparse
+import pathlib
+import time
+from configparser import ConfigParser
+
+import numpy as np
+from changepoint import DETECTORS, create_detector
+
+CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
+
+
+def load_streams(path):
+    """Load recorded condition streams, one row per state interval and one column per stream
+
+    :param path: .npy file or comma separated text file
+    :type path: str
+    :return: condition streams with shape (time steps, streams)
+    :rtype: numpy.ndarray
+    """
+    if path.endswith(".npy"):
+        streams = np.load(path)
+    else:
+        streams = np.loadtxt(path, delimiter=",", ndmin=2)
+    return np.asarray(streams, dtype=np.float64).reshape(len(streams), -1)
+
+
+def synthetic_streams(num_steps, num_streams, num_changes, seed):
+    """Piecewise constant streams with noise, changing level at the same time steps in every stream
+
+    Levels are drawn from the ranges of packet loss (percent) and mean RTT (ms) the meta models are partitioned by.
+
+    :return: condition streams with shape (time steps, streams) and the time steps of the changepoints
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+    rng = np.random.default_rng(seed)
+    changepoints = np.sort(
+        rng.choice(np.arange(64, num_steps - 64), size=num_changes, replace=False)
+    )
+    bounds = np.concatenate(([0], changepoints, [num_steps]))
+    streams = np.empty((num_steps, num_streams))
+    for s in range(num_streams):
+        high = 10.0 if s < num_streams // 2 else 300.0
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            level = rng.uniform(0.05, 1.0) * high
+            streams[start:end, s] = level + rng.normal(0, 0.05 * level, end - start)
+    return np.abs(streams), changepoints
+
+
+def evaluate(detector, streams, changepoints, horizon):
+    """Run a detector over all streams and score its alarms against the known changepoints
+
+    An alarm within `horizon` steps after a changepoint detects it, all other alarms are false alarms.
+
+    :return: mean detection delay in steps, fraction of missed changepoints, false alarms per 1000 steps
+        and stream, mean time per update in microseconds
+    :rtype: tuple
+    """
+    num_steps, num_streams = streams.shape
+    alarms = np.zeros(streams.shape, dtype=bool)
+    start = time.perf_counter()
+    for t in range(num_steps):
+        alarms[t] = detector.update(streams[t])
+    latency = (time.perf_counter() - start) / num_steps * 1e6
+
+    delays = []
+    missed = 0
+    explained = np.zeros(streams.shape, dtype=bool)
+    for cp in changepoints:
+        window = slice(cp, min(cp + horizon, num_steps))
+        explained[window] = True
+        for s in range(num_streams):
+            hits = np.flatnonzero(alarms[window, s])
+            if len(hits):
+                delays.append(hits[0])
+            else:
+                missed += 1
+    false_alarms = np.count_nonzero(alarms & ~explained)
+    return (
+        np.mean(delays) if delays else float("nan"),
+        missed / max(len(changepoints) * num_streams, 1),
+        false_alarms / (num_steps * num_streams) * 1000,
+        latency,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark changepoint detectors on network condition streams"
+    )
+    parser.add_argument(
+        "--streams",
+        help="Recorded condition streams (.npy or .csv, one column per stream), synthetic if omitted",
+    )
+    parser.add_argument(
+        "--changepoints",
+        default="",
+        help="Comma separated time steps of the true changepoints of the recorded streams",
+    )
+    parser.add_argument("--steps", type=int, default=5000, help="Synthetic steps")
+    parser.add_argument("--num_streams", type=int, default=4, help="Synthetic streams")
+    parser.add_argument(
+        "--num_changes", type=int, default=10, help="Synthetic changepoints"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Synthetic seed")
+    parser.add_argument(
+        "--horizon",
+        type=int,
+        default=64,
+        help="Steps after a changepoint in which an alarm counts as detection",
+    )
+    parser.add_argument(
+        "--detectors",
+        default=",".join(DETECTORS),
+        help="Comma separated detectors to compare",
+    )
+    args = parser.parse_args()
+
+    cfg = ConfigParser()
+    cfg.read(CURRENT_DIR / "config.ini")
+
+    if args.streams:
+        streams = load_streams(args.streams)
+        changepoints = np.array(
+            [int(x) for x in args.changepoints.split(",") if x], dtype=np.int64
+        )
+    else:
+        streams, changepoints = synthetic_streams(
+            args.steps, args.num_streams, args.num_changes, args.seed
+        )
+
+    print(
+        f"{streams.shape[0]} steps, {streams.shape[1]} streams, {len(changepoints)} changepoints"
+    )
+    print(
+        f"{'detector':<14}{'delay [steps]':>15}{'missed':>10}"
+        f"{'false alarms/1k':>18}{'update [us]':>14}"
+    )
+    for name in args.detectors.split(","):
+        detector = create_detector(cfg, streams.shape[1], name=name)
+        delay, missed, false_rate, latency = evaluate(
+            detector, streams, changepoints, args.horizon
+        )
+        print(
+            f"{name:<14}{delay:>15.1f}{missed:>10.1%}{false_rate:>18.2f}{latency:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
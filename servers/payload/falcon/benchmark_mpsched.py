@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+# Compares reading and setting the subflows with the list api of mpsched (get_sub_info, set_seg) and the buffer api
+# the environment uses (get_sub_info_into, set_seg_array), and taking the k + 1 observations of Env.reset with one
+# call each or with a single sample_sub_info. Needs an MPTCP connection to the given port with the
+# extension, or run with MPSCHED_STUB=1 to time the pure Python stub.
+
+import argparse
+import socket
+import time
+
+import mpsched_backend as mpsched
+import numpy as np
+from state_buffer import SubflowSnapshot
+
+
+def measure(call, repeat):
+    """Time a call
+
+    :return: median and 99th percentile latency in microseconds
+    :rtype: float, float
+    """
+    latencies = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        call()
+        latencies[i] = time.perf_counter() - start
+    latencies *= 1e6
+    return np.median(latencies), np.percentile(latencies, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the list and the buffer api of mpsched"
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Host of the connection")
+    parser.add_argument(
+        "--port", type=int, help="Port of the connection, a dummy fd if omitted"
+    )
+    parser.add_argument("--repeat", type=int, default=100000, help="Calls per api")
+    parser.add_argument("--k", type=int, default=8, help="Observations of a reset")
+    args = parser.parse_args()
+
+    sock = socket.socket()
+    if args.port is not None:
+        sock.connect((args.host, args.port))
+    fd = sock.fileno()
+    mpsched.persist_state(fd)
+
+    num_flows = mpsched.NUM_SUBFLOWS
+    num_fields = len(mpsched.FIELDS)
+    snapshot = SubflowSnapshot(num_flows, num_fields)
+    raw = np.zeros((num_flows, num_fields), dtype=np.uint32)
+    segments = np.zeros(num_flows, dtype=np.int32)
+    segments[0] = 1
+    active = segments.tolist()
+    samples = np.zeros((args.k + 1, num_flows, num_fields), dtype=np.uint32)
+    times = np.zeros(args.k + 1)
+    counts = np.zeros(args.k + 1, dtype=np.int32)
+
+    def reset_loop():
+        for sample in samples:
+            mpsched.get_sub_info_into(fd, sample)
+
+    calls = {
+        "get_sub_info": lambda: snapshot.load(mpsched.get_sub_info(fd)),
+        "get_sub_info_into": lambda: snapshot.load(
+            raw[: mpsched.get_sub_info_into(fd, raw)]
+        ),
+        "set_seg": lambda: mpsched.set_seg([fd] + active),
+        "set_seg_array": lambda: mpsched.set_seg_array(fd, segments),
+        "reset, k + 1 calls": reset_loop,
+        "reset, sample_sub_info": lambda: mpsched.sample_sub_info(
+            fd, 0, samples, times, counts
+        ),
+    }
+    print(f"{'api':<26}{'median [us]':>14}{'p99 [us]':>12}")
+    for name, call in calls.items():
+        median, p99 = measure(call, args.repeat)
+        print(f"{name:<26}{median:>14.2f}{p99:>12.2f}")
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""Changepoint detectors for the network conditions observed by the online agent
+
+All detectors run one independent detector per stream (characteristic and
+subflow) and update every stream with a single call. Except for the Bayesian
+detector, the cost of an update is constant per stream.
+"""
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+from bayes_online import BayesOnlineBank
+
+
+class ChangeDetector(ABC):
+    """Interface of the changepoint detectors
+
+    :param num_streams: number of independent data streams
+    :type num_streams: int
+    """
+
+    def __init__(self, num_streams):
+        self.num_streams = num_streams
+
+    @abstractmethod
+    def update(self, x):
+        """Add a data point to every stream
+
+        Detectors of streams with a changepoint are reset, so that they start
+        learning the new condition with the next data point.
+
+        :param x: new data point of every stream
+        :type x: array-like
+        :return: Boolean mask of the streams with a changepoint
+        :rtype: numpy.ndarray
+        """
+
+    @abstractmethod
+    def reset(self, streams=None):
+        """Forget all data seen so far
+
+        :param streams: boolean mask or indices of the streams to reset, all streams if None
+        :type streams: numpy.ndarray
+        """
+
+
+class BayesDetector(ChangeDetector):
+    """Bayesian online changepoint detection, see :py:class:`bayes_online.BayesOnlineBank`
+
+    :param past: how many datapoints into the past to look for a changepoint
+    :type past: int
+    :param threshold: changepoint probability above which a change is reported
+    :type threshold: float
+    :param max_run_length: largest run length that is tracked
+    :type max_run_length: int
+    :param time_scale: time scale of the constant hazard
+    :type time_scale: float
+    """
+
+    def __init__(
+        self, num_streams, past=32, threshold=0.95, max_run_length=128, time_scale=250.0
+    ):
+        super().__init__(num_streams)
+        self.past = past
+        self.threshold = threshold
+        self.bank = BayesOnlineBank(
+            num_streams, max_run_length=max_run_length, time_scale=time_scale
+        )
+
+    def update(self, x):
+        self.bank.update(x)
+        changed = self.bank.detect(self.past, self.threshold)
+        if np.any(changed):
+            self.bank.reset(changed)
+        return changed
+
+    def reset(self, streams=None):
+        self.bank.reset(streams)
+
+
+class _StandardizedDetector(ChangeDetector):
+    """Base class of detectors that work on standardized data
+
+    Mean and standard deviation of every stream are estimated from the first
+    `warmup` data points after a reset, no changepoints are reported during
+    that time.
+
+    :param warmup: number of data points used to estimate mean and standard deviation
+    :type warmup: int
+    :param min_std: lower bound of the standard deviation relative to the absolute mean,
+        keeps constant streams from raising an alarm on every small deviation
+    :type min_std: float
+    """
+
+    def __init__(self, num_streams, warmup=16, min_std=0.05):
+        super().__init__(num_streams)
+        self.warmup = warmup
+        self.min_std = min_std
+        self.count = np.zeros(num_streams, dtype=np.int64)
+        self.mean = np.zeros(num_streams)
+        self._m2 = np.zeros(num_streams)
+        self.std = np.ones(num_streams)
+
+    def _standardize(self, x):
+        """Update the warmup statistics and standardize `x`
+
+        :return: standardized data points and mask of the streams that finished their warmup
+        :rtype: numpy.ndarray, numpy.ndarray
+        """
+        x = np.asarray(x, dtype=np.float64)
+        learning = self.count < self.warmup
+        # Welford's online algorithm for streams still in their warmup
+        self.count[learning] += 1
+        delta = x - self.mean
+        self.mean[learning] += delta[learning] / self.count[learning]
+        self._m2[learning] += (delta * (x - self.mean))[learning]
+        self.std[learning] = np.maximum(
+            np.sqrt(self._m2[learning] / self.count[learning]),
+            np.maximum(self.min_std * np.abs(self.mean[learning]), 1e-9),
+        )
+        return (x - self.mean) / self.std, ~learning
+
+    def reset(self, streams=None):
+        if streams is None:
+            streams = slice(None)
+        self.count[streams] = 0
+        self.mean[streams] = 0
+        self._m2[streams] = 0
+        self.std[streams] = 1
+
+
+class CUSUMDetector(_StandardizedDetector):
+    """Two-sided cumulative sum (CUSUM) control chart
+
+    :param drift: allowed drift of the standardized data before it accumulates
+    :type drift: float
+    :param threshold: cumulative sum above which a change is reported
+    :type threshold: float
+    """
+
+    def __init__(self, num_streams, warmup=16, min_std=0.05, drift=0.5, threshold=5.0):
+        super().__init__(num_streams, warmup, min_std)
+        self.drift = drift
+        self.threshold = threshold
+        self.pos = np.zeros(num_streams)
+        self.neg = np.zeros(num_streams)
+
+    def update(self, x):
+        z, active = self._standardize(x)
+        self.pos = np.where(active, np.maximum(0, self.pos + z - self.drift), 0)
+        self.neg = np.where(active, np.maximum(0, self.neg - z - self.drift), 0)
+        changed = (self.pos > self.threshold) | (self.neg > self.threshold)
+        if np.any(changed):
+            self.reset(changed)
+        return changed
+
+    def reset(self, streams=None):
+        super().reset(streams)
+        if streams is None:
+            streams = slice(None)
+        self.pos[streams] = 0
+        self.neg[streams] = 0
+
+
+class PageHinkleyDetector(_StandardizedDetector):
+    """Two-sided Page-Hinkley test
+
+    :param delta: magnitude of changes of the standardized data that are tolerated
+    :type delta: float
+    :param threshold: deviation of the cumulative sum from its extremum above which a
+        change is reported
+    :type threshold: float
+    """
+
+    def __init__(self, num_streams, warmup=16, min_std=0.05, delta=0.5, threshold=8.0):
+        super().__init__(num_streams, warmup, min_std)
+        self.delta = delta
+        self.threshold = threshold
+        self.up = np.zeros(num_streams)
+        self.up_min = np.zeros(num_streams)
+        self.down = np.zeros(num_streams)
+        self.down_max = np.zeros(num_streams)
+
+    def update(self, x):
+        z, active = self._standardize(x)
+        self.up = np.where(active, self.up + z - self.delta, 0)
+        self.down = np.where(active, self.down + z + self.delta, 0)
+        self.up_min = np.minimum(self.up_min, self.up)
+        self.down_max = np.maximum(self.down_max, self.down)
+        changed = (self.up - self.up_min > self.threshold) | (
+            self.down_max - self.down > self.threshold
+        )
+        if np.any(changed):
+            self.reset(changed)
+        return changed
+
+    def reset(self, streams=None):
+        super().reset(streams)
+        if streams is None:
+            streams = slice(None)
+        self.up[streams] = 0
+        self.up_min[streams] = 0
+        self.down[streams] = 0
+        self.down_max[streams] = 0
+
+
+class EWMADetector(_StandardizedDetector):
+    """Exponentially weighted moving average with a control band
+
+    A change is reported once `persistence` consecutive data points lie
+    outside of `width` exponentially weighted standard deviations around the
+    exponentially weighted mean.
+
+    :param alpha: smoothing factor of mean and variance
+    :type alpha: float
+    :param width: width of the band in standard deviations
+    :type width: float
+    :param persistence: number of consecutive data points outside of the band
+    :type persistence: int
+    """
+
+    def __init__(
+        self, num_streams, warmup=16, min_std=0.05, alpha=0.1, width=3.0, persistence=3
+    ):
+        super().__init__(num_streams, warmup, min_std)
+        self.alpha = alpha
+        self.width = width
+        self.persistence = persistence
+        self.ewma = np.zeros(num_streams)
+        self.ewmv = np.ones(num_streams)
+        self.outside = np.zeros(num_streams, dtype=np.int64)
+
+    def update(self, x):
+        z, active = self._standardize(x)
+        deviation = z - self.ewma
+        out = active & (np.abs(deviation) > self.width * np.sqrt(self.ewmv))
+        self.outside = np.where(out, self.outside + 1, 0)
+        # the band only follows data points that are inside of it
+        follow = active & ~out
+        self.ewma = np.where(follow, self.ewma + self.alpha * deviation, self.ewma)
+        self.ewmv = np.where(
+            follow,
+            (1 - self.alpha) * (self.ewmv + self.alpha * deviation**2),
+            self.ewmv,
+        )
+        changed = self.outside >= self.persistence
+        if np.any(changed):
+            self.reset(changed)
+        return changed
+
+    def reset(self, streams=None):
+        super().reset(streams)
+        if streams is None:
+            streams = slice(None)
+        self.ewma[streams] = 0
+        self.ewmv[streams] = 1
+        self.outside[streams] = 0
+
+
+DETECTORS = {
+    "bayes": BayesDetector,
+    "cusum": CUSUMDetector,
+    "page_hinkley": PageHinkleyDetector,
+    "ewma": EWMADetector,
+}
+
+
+def create_detector(cfg, num_streams, name=None):
+    """Create the changepoint detector configured in the [changepoint] section of config.ini
+
+    :param cfg: contains all the neccessary parameters read from config.ini
+    :type cfg: configParser
+    :param num_streams: number of independent data streams
+    :type num_streams: int
+    :param name: detector to create instead of the configured one
+    :type name: str
+    :return: changepoint detector
+    :rtype: class:'ChangeDetector'
+    """
+    section = "changepoint"
+    name = name or cfg.get(section, "detector", fallback="bayes")
+    if name == "bayes":
+        return BayesDetector(
+            num_streams,
+            past=cfg.getint(section, "past", fallback=32),
+            threshold=cfg.getfloat(section, "probability", fallback=0.95),
+            max_run_length=cfg.getint(section, "max_run_length", fallback=128),
+            time_scale=cfg.getfloat(section, "time_scale", fallback=250.0),
+        )
+
+    kwargs = {
+        "warmup": cfg.getint(section, "warmup", fallback=16),
+        "min_std": cfg.getfloat(section, "min_std", fallback=0.05),
+    }
+    if name == "cusum":
+        return CUSUMDetector(
+            num_streams,
+            drift=cfg.getfloat(section, "cusum_drift", fallback=0.5),
+            threshold=cfg.getfloat(section, "cusum_threshold", fallback=5.0),
+            **kwargs,
+        )
+    if name == "page_hinkley":
+        return PageHinkleyDetector(
+            num_streams,
+            delta=cfg.getfloat(section, "ph_delta", fallback=0.5),
+            threshold=cfg.getfloat(section, "ph_threshold", fallback=8.0),
+            **kwargs,
+        )
+    if name == "ewma":
+        return EWMADetector(
+            num_streams,
+            alpha=cfg.getfloat(section, "ewma_alpha", fallback=0.1),
+            width=cfg.getfloat(section, "ewma_width", fallback=3.0),
+            persistence=cfg.getint(section, "ewma_persistence", fallback=3),
+            **kwargs,
+        )
+    raise ValueError(
+        f"Unknown changepoint detector {name}, expected one of {', '.join(DETECTORS)}"
+    )
@@ -1,8 +1,13 @@
-import statistics
 import time
 
-import falcon_mpsched as mpsched
+import mpsched_backend as mpsched
 import numpy as np
+from decision_clock import DecisionClock
+from state_buffer import RingWindow, RunningMean, SubflowSnapshot
+
+# position of the values reported per subflow by mpsched.get_sub_info
+SEGS_OUT, RTT, CWND, UNACKED, TOTAL_RETRANS, DST_ADDR, SND_WND = range(7)
+NUM_FIELDS = 9
 
 
 class Env:
@@ -16,41 +21,90 @@ class Env:
     :param k: int
     :param max_flows: Maximum possible number of available subflows
     :type max_flows: int
+    :param clock: clock that paces the decisions, a fixed SI of time if None
+    :type clock: class:'decision_clock.DecisionClock'
     """
 
-    def __init__(self, fd, time, max_flows):
+    def __init__(self, fd, time, max_flows, clock=None):
         """Constructor method"""
         self.fd = fd
         self.time = time
+        self.clock = clock if clock is not None else DecisionClock(time)
         self.k = 8
         self.max_num_flows = max_flows
 
-        # only works for 2 subflows with this declaration
-        self.last = [[0] * 5 for _ in range(self.max_num_flows)]
-        self.tp = [
-            0
-        ] * self.max_num_flows  # number of segs sent(Max number of subflows)
-        self.rtt = [0] * self.max_num_flows  # snapshot of rtt
-        self.drtt = [0] * self.max_num_flows  # ratio of RTT deviation to mean RTTT
-        self.cwnd = [0] * self.max_num_flows  # cwnd
-        self.rr = [0] * self.max_num_flows  # number of packets in flight
-        self.in_flight = [
-            0
-        ] * self.max_num_flows  # number of total retransmission (packets_lost)
-        self.packet_loss = [
-            0
-        ] * self.max_num_flows  # packet loss in percent compared to segs_out(tp)
-        self.send_wnd = [0] * self.max_num_flows  # SWND in bytes
-        self.rtts = [[] for _ in range(self.max_num_flows)]
-        self.mean_RTT = [
-            0
-        ] * self.max_num_flows  # current mean RTT of paths to calculate deviation to current RTT
+        self.subflows = SubflowSnapshot(self.max_num_flows, NUM_FIELDS)
+        # raw observations are read into this buffer instead of a new list per call
+        self._raw = np.zeros((self.max_num_flows, NUM_FIELDS), dtype=np.uint32)
+        # the k + 1 observations of reset are taken with a single call
+        self._samples = np.zeros(
+            (self.k + 1, mpsched.NUM_SUBFLOWS, NUM_FIELDS), dtype=np.uint32
+        )
+        self._sample_times = np.zeros(self.k + 1)
+        self._sample_counts = np.zeros(self.k + 1, dtype=np.int32)
+        # ring buffer of a background sampler of the connection, replaces reading the subflows in step
+        self.telemetry = None
+        # subflow set in the kernel scheduler
+        self.segments = np.zeros(self.max_num_flows, dtype=np.int32)
+        # state and network condition of all subflows are preallocated once, the per characteristic
+        # attributes are views into them
+        self._state = np.zeros(4 * self.max_num_flows)
+        self._cond = np.zeros(3 * self.max_num_flows)
+        (
+            self.rtt,  # snapshot of rtt
+            self.cwnd,  # cwnd
+            self.rr,  # number of packets in flight
+            self.send_wnd,  # SWND in bytes
+        ) = np.split(self._state, 4)
+        (
+            self.packet_loss,  # packet loss in percent compared to segs_out(tp)
+            self.mean_RTT,  # current mean RTT of paths to calculate deviation to current RTT
+            self.rtt_deviation,  # deviation of mean rtt to current rtt
+        ) = np.split(self._cond, 3)
+        self.tp = np.zeros(
+            self.max_num_flows
+        )  # number of segs sent(Max number of subflows)
+        self.in_flight = np.zeros(
+            self.max_num_flows
+        )  # number of total retransmission (packets_lost)
+        self.rtts = RunningMean(self.max_num_flows)
+        self.states = RingWindow(len(self._state), self.k)  # last k states
         self.path_mask = [
             0
         ] * self.max_num_flows  # path mask for ordering from user space to kernel space
-        self.rtt_deviation = [
-            0
-        ] * self.max_num_flows  # deviation of mean rtt to current rtt
+
+    def measure(self, subs):
+        """Loads a raw observation and calculates throughput, state variables and packet loss of all subflows.
+        Subflows that are not available get the worst case for each characteristic (e.g RTT->inf) s.t path is unfavorable
+        for decision
+
+        :param subs: Raw observations from socket api with mpsched extension
+        :type subs: list
+        """
+        self.subflows.load(subs)
+        self.clock.update(self.subflows.current[: self.subflows.num_active, RTT] / 1e6)
+        current = self.subflows.current
+        active = self.subflows.active
+        rtt = current[:, RTT] / 1000
+        valid = active & (rtt != 0)
+
+        # 1440 is MSS taken from kernel information sudo dmesg
+        self.tp[:] = np.where(active, self.subflows.delta(SEGS_OUT) * 1440, 0)
+        self.rtt[:] = np.where(active, rtt, 32000)
+        self.in_flight[:] = np.where(active, self.subflows.delta(TOTAL_RETRANS), 0)
+        self.cwnd[:] = 0
+        self.rr[:] = 32000
+        self.send_wnd[:] = 0
+        np.divide(current[:, CWND], rtt, out=self.cwnd, where=valid)
+        np.divide(self.subflows.delta(UNACKED), rtt, out=self.rr, where=valid)
+        np.divide(current[:, SND_WND], rtt * 1000, out=self.send_wnd, where=valid)
+        self.packet_loss[:] = 0
+        np.divide(
+            self.in_flight * 1440 * 100,
+            self.tp,
+            out=self.packet_loss,
+            where=active & (self.tp != 0),
+        )
 
     def adjust(self, state):
         """Converts the raw observations collected with mpsched socket api into appropriate values for state information and reward
@@ -59,45 +113,26 @@ class Env:
         :param state: Raw observations from socket api with mpsched extension
         :type state: list
 
-        :return: All values for state infomration from socket api measurments as well as current network condition
-        :type: list
+        :return: All values for state infomration from socket api measurments as well as current network condition.
+            Both are views into preallocated buffers, the state stays valid for k - 1 further steps, the network
+            condition until the next step
+        :type: numpy.ndarray, numpy.ndarray
         """
-        for m in range(self.max_num_flows):
-            # adjust initial values to represent worst case for each characteristic (e.g RTT->inf) s.t path is unfavorable for decision
-            self.tp[m] = 0
-            self.rtt[m] = 32000
-            self.cwnd[m] = 0
-            self.rr[m] = 32000
-            self.in_flight[m] = 0
-            self.packet_loss[m] = 0
-            self.send_wnd[m] = 0
-        for i in range(len(state)):
-            if len(self.last) < (len(state)):
-                self.last.append([0, 0, 0, 0, 0, 0])
-            self.tp[i] = (
-                np.abs(state[i][0] - self.last[i][0]) * 1440
-            )  # 1440 is MSS taken from kernel information sudo dmesg
-            self.rtt[i] = state[i][1] / 1000
-            if self.rtt[i] != 32000:
-                self.rtts[i].append(self.rtt[i])
-            else:
-                self.rtts[i].append(self.mean_RTT[i])
-            self.mean_RTT[i] = statistics.fmean(self.rtts[i])
-            if self.mean_RTT[i] != 0:
-                self.rtt_deviation[i] = self.rtt[i] / self.mean_RTT[i]
-            self.cwnd[i] = state[i][2] / self.rtt[i]
-            self.rr[i] = np.abs(state[i][3] - self.last[i][3]) / self.rtt[i]
-            self.in_flight[i] = np.abs(state[i][4] - self.last[i][4])
-            self.send_wnd[i] = state[i][6] / (self.rtt[i] * 1000)
-            if self.tp[i] != 0:
-                self.packet_loss[i] = (self.in_flight[i] * 1440 / self.tp[i]) * 100
-            else:
-                self.packet_loss[i] = 0
-            # print(state[i][5])
-        self.last = state
+        self.measure(state)
+        active = self.subflows.active
+        # a subflow without rtt measurement keeps its mean
+        self.rtts.update(np.where(self.rtt != 32000, self.rtt, self.rtts.mean), active)
+        self.mean_RTT[:] = self.rtts.mean
+        np.divide(
+            self.rtt,
+            self.mean_RTT,
+            out=self.rtt_deviation,
+            where=active & (self.mean_RTT != 0),
+        )
+        self.states.push(self._state)
         return (
-            list(np.concatenate((self.rtt, self.cwnd, self.rr, self.send_wnd))),
-            list(np.concatenate((self.packet_loss, self.mean_RTT, self.rtt_deviation))),
+            self.states.latest(),
+            self._cond,
         )  # net char used packetloss,mean rtt and deviation
 
     def reward(self):
@@ -106,8 +141,9 @@ class Env:
         :return: Reward value
         :type: float
         """
-        if self.rtt != 0:
-            rewards = (sum(self.tp)) / (sum(self.rtt) / 2)
+        rtt = np.sum(self.rtt)
+        if rtt != 0:
+            rewards = np.sum(self.tp) / (rtt / 2)
         else:
             rewards = 0
         return rewards
@@ -116,72 +152,95 @@ class Env:
         """Initialization of the Environment variables with the last of k measurments where k is a user defined parameter
 
         :return: State parameters
+        :rtype: numpy.ndarray
+        """
+        self.clock.reset()
+        observations = self.sample(0)
+        self.subflows.load(observations[0])
+        self.rtts.reset()
+        self.mean_RTT[:] = 0
+        for subs in observations[1:]:
+            self.measure(subs)
+            self.states.push(self._state)
+        self.clock.start()
+        return self.states.latest()
+
+    def sub_info(self):
+        """Raw observation of all subflows with the socket api of the mpsched extension, the newest snapshot of the
+        background sampler if there is one
+
+        :return: one row per reported subflow, a view into a preallocated buffer that stays valid until the next call
+        :rtype: numpy.ndarray
+        """
+        if self.telemetry is not None:
+            subs = self.telemetry.latest(self._raw)
+            if subs is not None:
+                return subs
+        return self._raw[: mpsched.get_sub_info_into(self.fd, self._raw)]
+
+    def sample(self, interval):
+        """k + 1 raw observations of all subflows interval seconds apart, taken with a single call of the mpsched
+        extension that does not hold the GIL while it waits
+
+        :param interval: seconds between two observations
+        :type interval: float
+        :return: reported subflows of every observation, views into a preallocated buffer that stay valid until the next
+            call
         :rtype: list
         """
-        self.last = mpsched.get_sub_info(self.fd)
-        self.rtts = [[] for _ in range(self.max_num_flows)]
-        self.mean_RTT = [0] * self.max_num_flows
-        for i in range(self.k):
-            subs = mpsched.get_sub_info(self.fd)
-            for m in range(self.max_num_flows):
-                self.tp[m] = 0
-                self.rtt[m] = 32000
-                self.cwnd[m] = 0
-                self.rr[m] = 32000
-                self.in_flight[m] = 0
-                self.packet_loss[m] = 0
-                self.send_wnd[m] = 0
-            for j in range(len(subs)):
-                if len(self.last) < (len(subs)):
-                    self.last.append([0, 0, 0, 0, 0, 0])
-                self.tp[j] = (np.abs(subs[j][0] - self.last[j][0])) * 1440
-                self.rtt[j] = subs[j][1] / 1000
-                self.cwnd[j] = subs[j][2] / self.rtt[j]
-                self.rr[j] = np.abs(subs[j][3] - self.last[j][3]) / self.rtt[j]
-                self.in_flight[j] = np.abs(subs[j][4] - self.last[j][4])
-                self.send_wnd[j] = subs[j][6] / (self.rtt[j] * 1000)
-                if self.tp[j] != 0:
-                    self.packet_loss[j] = (self.in_flight[j] * 1440 / self.tp[j]) * 100
-                else:
-                    self.packet_loss[j] = 0
-                # print(subs[j][5])
-            self.last = subs
-        return list(np.concatenate((self.rtt, self.cwnd, self.rr, self.send_wnd)))
+        mpsched.sample_sub_info(
+            self.fd, interval, self._samples, self._sample_times, self._sample_counts
+        )
+        return [
+            samples[:count]
+            for samples, count in zip(self._samples, self._sample_counts)
+        ]
 
     def update_fd(self, fd):
         self.fd = fd
 
-    def step(self, action):
-        """Performs all neccessary actions to transition the Environment into the next state.
-        Actions include among other things:
-        -setting the desired subflow in the kernel scheduler using socket api with mpsched extension
-        -calculated the reward of the action using reward method
-        -take measurement of the new path characteristics after taking action using socket api with mpsched extension
-        -adjust the current environment variables using adjust method
+    def act(self, action):
+        """Set the desired subflow in the kernel scheduler using socket api with mpsched extension
 
-        :param action: output of the DQN with position of desired subflow set to one
-        :type action: list
-        :return: state observation of the next state t+1,reward value, flag to signal end and current network conditions
-        :rtype: list,float,boolean,list
+        :param action: index of the desired subflow
+        :type action: int
         """
-        active = [int(0)] * self.max_num_flows
-        active[action] = int(1)
-        A = [self.fd]
+        self.segments[:] = 0
+        self.segments[action] = 1
+        mpsched.set_seg_array(self.fd, self.segments)
 
-        A = list(np.concatenate((A, active)))
+    def observe(self):
+        """Take measurement of the path characteristics after an action using socket api with mpsched extension,
+        adjust the current environment variables using adjust method and calculate the reward of the action
 
-        # print(active)
-        mpsched.set_seg(A)
-
-        state_nxt = mpsched.get_sub_info(self.fd)
-        # print(state_nxt)
+        :return: state observation of the next state t+1,reward value, flag to signal end and current network conditions
+        :rtype: numpy.ndarray,float,boolean,numpy.ndarray
+        """
+        state_nxt = self.sub_info()
         done = False
-        if not state_nxt:
+        if len(state_nxt) == 0:
             done = True
 
         state_nxt, cond = self.adjust(state_nxt)
 
         reward = self.reward()
-        # print(reward)
 
         return state_nxt, reward, done, cond
+
+    def step(self, action):
+        """Performs all neccessary actions to transition the Environment into the next state.
+        Actions include among other things:
+        -setting the desired subflow in the kernel scheduler using act method
+        -wait on the decision clock until the begin of the next state
+        -take measurement of the new path characteristics and calculate the reward using observe method
+
+        The inference engine of the online agent calls act and observe itself, to wait once for all connections
+
+        :param action: output of the DQN with position of desired subflow set to one
+        :type action: list
+        :return: state observation of the next state t+1,reward value, flag to signal end and current network conditions
+        :rtype: numpy.ndarray,float,boolean,numpy.ndarray
+        """
+        self.act(action)
+        self.clock.wait()
+        return self.observe()
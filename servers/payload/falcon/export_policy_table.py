@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+# Exports the greedy policy of every FALCON meta model as a lookup table for the online agent
+
+import argparse
+import os
+import pathlib
+import time
+from configparser import ConfigParser
+
+import numpy as np
+import torch
+from model_bank import open_bank
+from policy_table import PolicyTable, grids_from_config
+
+CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
+TMP_DIR = CURRENT_DIR / "artifacts"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the meta models as policy lookup tables"
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=65536,
+        help="Grid points evaluated per forward pass",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=10000,
+        help="Random states used to compare table and network decisions",
+    )
+    args = parser.parse_args()
+
+    cfg = ConfigParser()
+    cfg.read(CURRENT_DIR / "config.ini")
+    bank = open_bank(cfg, TMP_DIR)
+    table_dir = TMP_DIR / cfg.get("lookup", "tables")
+    os.makedirs(table_dir, exist_ok=True)
+    grids = grids_from_config(cfg, cfg.getint("train", "max_num_flows"))
+    print(f"{int(np.prod([len(points) for points in grids]))} grid points per table")
+
+    # random states within the grids to estimate the error of the quantization
+    rng = np.random.default_rng(0)
+    states = np.stack(
+        [rng.uniform(points[0], points[-1], args.samples) for points in grids], axis=1
+    )
+    for index in bank.indices():
+        agent = bank.load(index)
+        start = time.perf_counter()
+        table = PolicyTable.build(agent.policy_network, grids, args.batch_size)
+        duration = time.perf_counter() - start
+        table.save(table_dir / (index + ".npz"))
+
+        with torch.no_grad():
+            expected = torch.argmax(
+                agent.policy_network(torch.as_tensor(states, dtype=torch.float32)),
+                dim=1,
+            ).numpy()
+        agree = np.mean([table.select_action(s) for s in states] == expected)
+        print(
+            f"{index}: built in {duration:.2f}s, "
+            f"decisions equal to the network {agree:.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
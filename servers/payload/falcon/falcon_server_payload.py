@@ -5,6 +5,7 @@
 import argparse
 import http.server
 import itertools
+import multiprocessing
 import os
 import pathlib
 import re
@@ -14,31 +15,49 @@ import threading
 import time
 from configparser import ConfigParser
 from datetime import datetime
-from threading import Event
+from functools import partial
 from urllib.parse import parse_qs, urlparse
 
-import falcon_mpsched as mpsched  # Install this beforehand in systems
+import mpsched_backend as mpsched  # Install falcon_mpsched beforehand in systems
 import numpy as np
 import torch
-from agent import Offline_Agent, Online_Agent
-from DQN import DQN_Agent
+from agent import InferenceEngine, Offline_Agent
+from engine_ipc import EngineClient, SlotTable, channel, serve_engine
+from jit_warmup import warmup
+from model_bank import open_bank
 
 CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
 TMP_DIR = CURRENT_DIR / "artifacts"
 
 
 class MyHTTPHandler(http.server.SimpleHTTPRequestHandler):
-    """SimpleHTTPRequestHandler with overwritten do_GET function to give information about start of file transfer
-    and the socket fd to the online agent
+    """SimpleHTTPRequestHandler with overwritten do_GET function to hand the socket fd of every connection to the
+    inference engine of the online agent for the duration of the file transfer
     """
 
     def do_GET(self):
-
-        self.server.event.set()
         sock = self.request
+        engine = self.server.engine
+        if engine is not None:
+            # process mode, the online agent runs in the decision engine process
+            slot = engine.attach(sock.fileno())
+            if slot is None:
+                print("Warning: no engine slot, no online agent for connection")
+            try:
+                self.send_file()
+            finally:
+                if slot is not None:
+                    engine.finish(slot)
+            return
 
-        self.server.agent.update_fd(sock.fileno())
+        ctx = self.server.agent.attach(sock.fileno())
+        try:
+            self.send_file()
+        finally:
+            if not self.server.agent.detach(ctx, timeout=5):
+                print("Warning: Online Agent did not terminate in time")
 
+    def send_file(self):
         file_size, file_name = self.parse_file_size()
         if file_size is None:
             self.send_error(400, "Bad Request: Invalid file size specifier")
@@ -61,8 +80,6 @@ class MyHTTPHandler(http.server.SimpleHTTPRequestHandler):
 
         print(f"Done sending {file_path}")
 
-        self.server.event.clear()
-
     def parse_file_size(self):
         # Extract the file size specifier from the query parameter
         parsed_url = urlparse(self.path)
@@ -107,6 +124,47 @@ class MyHTTPHandler(http.server.SimpleHTTPRequestHandler):
         return file_path
 
 
+def run_engine(cfg, sock, slots_name, event):
+    """Decision engine process of process mode. Runs the inference engine of the online agent, which also fine
+    tunes the meta models, for the connections handed over by the server
+
+    :param sock: engine end of the channel to the server
+    :type sock: socket.socket
+    :param slots_name: shared memory of the slot table
+    :type slots_name: str
+    :param event: set while a connection is active
+    :type event: class:'multiprocessing.Event'
+    """
+    slots = SlotTable(cfg.getint("engine", "slots"), 1, name=slots_name)
+    agent = InferenceEngine(cfg=cfg, event=event)
+    agent.slots = slots
+    agent.daemon = True
+    agent.start()
+
+    def attach(slot, fd):
+        return partial(agent.detach, agent.attach(fd, slot), timeout=5)
+
+    serve_engine(sock, slots, attach)
+
+
+def start_engine(cfg, event):
+    """Start the decision engine process
+
+    :param event: set while a connection is active
+    :type event: class:'multiprocessing.Event'
+    :return: server side of the engine and the process
+    :rtype: class:'engine_ipc.EngineClient', class:'multiprocessing.Process'
+    """
+    slots = SlotTable(cfg.getint("engine", "slots"), 1)
+    server_sock, engine_sock = channel()
+    process = multiprocessing.Process(
+        target=run_engine, args=(cfg, engine_sock, slots.name, event), daemon=True
+    )
+    process.start()
+    engine_sock.close()
+    return EngineClient(server_sock, slots), process
+
+
 class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
     """ThreadedHTTPServer class initialized with (IP,PORT),HTTPRequestHandler"""
 
@@ -143,13 +201,14 @@ def main():
     IP = args.ip
     PORT = args.port
     MEMORY_FILE = str((TMP_DIR / cfg.get("replaymemory", "memory")).resolve())
-    AGENT_FILE = str((TMP_DIR / cfg.get("dqn", "agent")).resolve()) + "/"
+    AGENT_FILE = str((TMP_DIR / cfg.get("dqn", "agent")).resolve())
     INTERVAL = cfg.getint("train", "interval")
     EPISODE = cfg.getint("train", "episode")
     BATCH_SIZE = cfg.getint("train", "batch_size")
     MAX_NUM_FLOWS = cfg.getint("train", "max_num_flows")
     K = cfg.getint("dqn", "k")
-    transfer_event = Event()
+    # shared with the offline agent, which throttles its training while a transfer is in flight
+    transfer_event = multiprocessing.Event()
     NUM_CHAR = cfg.getint("train", "num_characteristics")
     NUM_RANGES = cfg.getint("train", "num_ranges")
     CONTINUE_TRAIN = args.continue_train
@@ -157,44 +216,52 @@ def main():
     now = datetime.now().replace(microsecond=0)
     start_train = now.strftime("%Y-%m-%d %H:%M:%S")
 
-    path_char = list(itertools.product(list(range(0, NUM_RANGES)), repeat=NUM_CHAR))
-    ALL_CHAR = np.array(
-        list(map(list, (itertools.product(path_char, repeat=MAX_NUM_FLOWS))))
-    ).reshape((-1, MAX_NUM_FLOWS * NUM_CHAR))
+    # meta models pickled per partition by earlier versions are converted once
+    legacy = pathlib.Path(AGENT_FILE).with_suffix("")
+    if not os.path.exists(AGENT_FILE) and legacy.is_dir():
+        bank = open_bank(cfg, TMP_DIR)
+        for index in bank.indices():
+            pickled = legacy / f"{index}.pkl"
+            if pickled.exists():
+                bank.save(index, torch.load(pickled))
+        os.makedirs(TMP_DIR / "trained_models", exist_ok=True)
+        shutil.move(
+            str(legacy), str(TMP_DIR / f"trained_models/meta_models_{start_train}")
+        )
+        print(f"Converted {legacy} into {AGENT_FILE}")
 
-    agent_name = []
     if CONTINUE_TRAIN != 1 and os.path.exists(AGENT_FILE):
         try:
             os.remove(MEMORY_FILE)
         except FileNotFoundError:
             print("MEMORY file does not exist yet")
-        os.makedirs("trained_models/", exist_ok=True)
+        os.makedirs(TMP_DIR / "trained_models", exist_ok=True)
         shutil.move(
-            AGENT_FILE, str(TMP_DIR / f"trained_models/meta_models_{start_train}")
+            AGENT_FILE,
+            str(TMP_DIR / f"trained_models/meta_models_{start_train}.npy"),
         )
 
-    os.makedirs(AGENT_FILE, exist_ok=True)
-    for i in range(len(ALL_CHAR)):
-        index = "".join(str(x) for x in ALL_CHAR[i])
-        agent_name.append(AGENT_FILE + index + ".pkl")
-        if not os.path.exists(agent_name[i]) or CONTINUE_TRAIN != 1:
-            agent = DQN_Agent(
-                hidden_size=3,
-                num_inputs=4 * MAX_NUM_FLOWS,
-                num_outputs=MAX_NUM_FLOWS,
-                gamma=cfg.getfloat("dqn", "gamma"),
-            )
-            torch.save(agent, agent_name[i])
-
-    online_process = Online_Agent(fd=0, cfg=cfg, event=transfer_event)
-    online_process.daemon = True
-    online_process.start()
+    # meta models of partitions that were never trained are only created when they are first used
+    open_bank(cfg, TMP_DIR)
+    # compile the numba kernels before the first transfer, the engine process inherits them
+    for kernel, seconds in warmup(cfg).items():
+        print(f"Compiled {kernel} in {seconds:.2f}s")
+
+    if cfg.get("engine", "mode") == "process":
+        engine, engine_process = start_engine(cfg, transfer_event)
+        online_process = None
+    else:
+        engine = None
+        online_process = InferenceEngine(cfg=cfg, event=transfer_event)
+        online_process.daemon = True
+        online_process.start()
     offline_process = Offline_Agent(cfg, transfer_event)
     offline_process.daemon = True
     offline_process.start()
     server = ThreadedHTTPServer((IP, PORT), MyHTTPHandler)
     server.event = transfer_event
     server.agent = online_process
+    server.engine = engine
     server_thread = threading.Thread(target=server.serve_forever)
     server_thread.daemon = True
     server_thread.start()
@@ -207,6 +274,10 @@ def main():
             time.sleep(360)
     except (KeyboardInterrupt, SystemExit):
         print("exit")
+    if engine is not None:
+        engine_process.terminate()
+        engine_process.join(timeout=10)
+        engine.slots.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,188 @@
+"""Meta models of all partitions of the network conditions in a single file
+
+The offline agent keeps a meta model per partition (ALL_CHAR). Instead of a
+pickled DQN_Agent per partition, the bank holds the weights of the policy
+networks of all partitions as the rows of one .npy file of records. Opening
+the bank maps the file into memory without reading any weights, and a new
+bank is a sparse file without any weights at all: the model of a partition
+that was never trained is created when it is first loaded, seeded with the
+partition, so that every process starts from the same model. The offline
+agent writes a partition in place, readers copy the weights of a partition
+again if it was written meanwhile.
+"""
+
+import os
+
+import numpy as np
+import torch
+from DQN import DQN_Agent, DQN_Network
+
+
+def open_bank(cfg, directory):
+    """Model bank with the parameters of config.ini, created if it does not exist
+
+    :param cfg: contains all the neccessary training parameter read from config.ini
+    :type cfg: configParser
+    :param directory: directory the bank file of the config is relative to
+    :type directory: pathlib.Path
+    :rtype: class:'ModelBank'
+    """
+    max_flows = cfg.getint("train", "max_num_flows")
+    return ModelBank(
+        path=directory / cfg.get("dqn", "agent"),
+        num_ranges=cfg.getint("train", "num_ranges"),
+        num_char=max_flows * cfg.getint("train", "num_characteristics"),
+        num_inputs=4 * max_flows,
+        num_outputs=max_flows,
+        gamma=cfg.getfloat("dqn", "gamma"),
+    )
+
+
+def bank_dtype(num_params):
+    """Record of one partition, version is odd while the partition is written
+
+    :rtype: numpy.dtype
+    """
+    return np.dtype(
+        [
+            ("version", "<u8"),
+            ("initialized", "?"),
+            ("train_steps", "<i8"),
+            ("weights", "<f4", (num_params,)),
+        ]
+    )
+
+
+class ModelBank:
+    """Memory mapped meta models of all partitions
+
+    :param path: .npy file of the bank
+    :type path: pathlib.Path
+    :param num_ranges: number of ranges per path characteristic
+    :type num_ranges: int
+    :param num_char: number of path characteristics of a partition, over all subflows
+    :type num_char: int
+    :param num_inputs: state size of the DQN
+    :type num_inputs: int
+    :param num_outputs: number of actions of the DQN
+    :type num_outputs: int
+    :param gamma: discount factor of the DQN
+    :type gamma: float
+    """
+
+    def __init__(self, path, num_ranges, num_char, num_inputs, num_outputs, gamma):
+        self.path = path
+        self.num_ranges = num_ranges
+        self.num_char = num_char
+        self.num_inputs = num_inputs
+        self.num_outputs = num_outputs
+        self.gamma = gamma
+        self.num_partitions = num_ranges**num_char
+        # names and shapes of the parameters in the order they are stored, taken from a bare network since the
+        # first optimizer of a process takes seconds to create
+        template = DQN_Network(num_inputs, 3, num_outputs)
+        self.shapes = [
+            (name, tuple(value.shape)) for name, value in template.state_dict().items()
+        ]
+        dtype = bank_dtype(sum(int(np.prod(shape)) for _, shape in self.shapes))
+        if os.path.exists(path):
+            self.records = np.load(path, mmap_mode="r+")
+            if self.records.dtype != dtype or len(self.records) != self.num_partitions:
+                raise ValueError(
+                    f"{path} does not hold {self.num_partitions} models of this DQN"
+                )
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.records = np.lib.format.open_memmap(
+                path, mode="w+", dtype=dtype, shape=(self.num_partitions,)
+            )
+
+    def new_agent(self):
+        return DQN_Agent(
+            hidden_size=3,
+            num_inputs=self.num_inputs,
+            num_outputs=self.num_outputs,
+            gamma=self.gamma,
+        )
+
+    def row(self, index):
+        """Row of a partition, partitions are numbered like ALL_CHAR
+
+        :param index: path characteristics of the partition, one digit per characteristic
+        :type index: str
+        :rtype: int
+        """
+        if len(index) != self.num_char:
+            raise ValueError(f"Partition {index} needs {self.num_char} characteristics")
+        return int(index, self.num_ranges)
+
+    def indices(self):
+        """Path characteristics of all partitions in the order of ALL_CHAR
+
+        :rtype: list
+        """
+        return [
+            np.base_repr(row, self.num_ranges).zfill(self.num_char)
+            for row in range(self.num_partitions)
+        ]
+
+    def initialized(self, index):
+        """Whether a model was saved for the partition"""
+        return bool(self.records["initialized"][self.row(index)])
+
+    def load(self, index):
+        """Meta model of a partition
+
+        :param index: path characteristics of the partition
+        :type index: str
+        :rtype: class:'DQN.DQN_Agent'
+        """
+        row = self.row(index)
+        record = self.records[row : row + 1]
+        while True:
+            version = int(record["version"][0])
+            if version % 2 == 0:
+                initialized = bool(record["initialized"][0])
+                train_steps = int(record["train_steps"][0])
+                weights = record["weights"][0].copy()
+                if int(record["version"][0]) == version:
+                    break
+            os.sched_yield()
+        if not initialized:
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(row)
+                return self.new_agent()
+        agent = self.new_agent()
+        state_dict = {}
+        offset = 0
+        for name, shape in self.shapes:
+            size = int(np.prod(shape))
+            state_dict[name] = torch.from_numpy(
+                weights[offset : offset + size].reshape(shape)
+            )
+            offset += size
+        agent.update_state_dict(state_dict, 0)
+        agent.train_steps = train_steps
+        return agent
+
+    def save(self, index, agent):
+        """Write the policy network of a meta model into its partition
+
+        :param index: path characteristics of the partition
+        :type index: str
+        :param agent: meta model of the partition
+        :type agent: class:'DQN.DQN_Agent'
+        """
+        record = self.records[self.row(index)]
+        weights = np.concatenate(
+            [
+                value.detach().cpu().numpy().reshape(-1)
+                for value in agent.policy_network.state_dict().values()
+            ]
+        )
+        record["version"] += 1
+        record["weights"] = weights
+        record["train_steps"] = agent.train_steps
+        record["initialized"] = True
+        record["version"] += 1
+        self.records.flush()
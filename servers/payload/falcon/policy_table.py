@@ -0,0 +1,197 @@
+"""Lookup tables of the greedy policy of the FALCON meta models
+
+The state of the online agent (rtt, cwnd, unacked and send window of every
+path) is quantized to the nearest of a few representative values per
+variable. The greedy action of every combination of representative values is
+evaluated once with the DQN, after which a decision is a table lookup.
+"""
+
+import threading
+from copy import deepcopy
+
+import numpy as np
+import torch
+
+# state variables of every path in the order of Env.adjust
+FEATURES = ("rtt", "cwnd", "rr", "send_wnd")
+
+
+def grids_from_config(cfg, max_flows):
+    """Representative values of every state dimension from the [lookup] section of config.ini,
+    every path uses the same values for a state variable
+
+    :param cfg: contains all the neccessary parameters read from config.ini
+    :type cfg: configParser
+    :param max_flows: Maximum possible number of available subflows
+    :type max_flows: int
+    :return: sorted representative values of every state dimension
+    :rtype: list
+    """
+    grids = []
+    for feature in FEATURES:
+        points = np.sort(
+            np.array(list(map(float, cfg.get("lookup", feature).split(","))))
+        )
+        grids.extend([points] * max_flows)
+    return grids
+
+
+class PolicyTable:
+    """Greedy action of every combination of representative state values
+
+    :param grids: sorted representative values of every state dimension
+    :type grids: list
+    :param actions: action of every grid point, one axis per state dimension
+    :type actions: numpy.ndarray
+    """
+
+    def __init__(self, grids, actions):
+        self.grids = [np.asarray(points, dtype=np.float64) for points in grids]
+        self.actions = np.ascontiguousarray(actions)
+        if self.actions.shape != tuple(len(points) for points in self.grids):
+            raise ValueError(
+                f"Table of shape {self.actions.shape} does not match the grids"
+            )
+        # A state value is quantized to the nearest representative value by counting the
+        # midpoints between neighbouring values it exceeds. Padding with inf lets all
+        # dimensions be quantized with a single comparison.
+        width = max(len(points) for points in self.grids) - 1
+        self._edges = np.full((len(self.grids), max(width, 1)), np.inf)
+        for i, points in enumerate(self.grids):
+            self._edges[i, : len(points) - 1] = (points[1:] + points[:-1]) / 2
+        self._strides = np.array(
+            [s // self.actions.itemsize for s in self.actions.strides], dtype=np.int64
+        )
+        self._flat = self.actions.reshape(-1)
+
+    @classmethod
+    def build(cls, network, grids, batch_size=65536):
+        """Evaluate the greedy action of a network on every grid point
+
+        :param network: policy network of a meta model
+        :type network: class:'DQN.DQN_Network'
+        :param grids: sorted representative values of every state dimension
+        :type grids: list
+        :param batch_size: number of grid points evaluated per forward pass
+        :type batch_size: int
+        :rtype: class:'PolicyTable'
+        """
+        shape = tuple(len(points) for points in grids)
+        size = int(np.prod(shape))
+        dtype = np.uint8 if network.num_outputs <= 256 else np.int64
+        actions = np.empty(size, dtype=dtype)
+        with torch.no_grad():
+            for start in range(0, size, batch_size):
+                index = np.unravel_index(
+                    np.arange(start, min(start + batch_size, size)), shape
+                )
+                states = np.stack(
+                    [points[i] for points, i in zip(grids, index)], axis=1
+                )
+                q_values = network(torch.as_tensor(states, dtype=torch.float32))
+                actions[start : start + len(states)] = torch.argmax(
+                    q_values, dim=1
+                ).numpy()
+        return cls(grids, actions.reshape(shape))
+
+    def quantize(self, state):
+        """Index of the nearest representative value of every state dimension
+
+        :param state: state of the environment
+        :type state: array-like
+        :rtype: numpy.ndarray
+        """
+        state = np.reshape(np.asarray(state, dtype=np.float64), (-1, 1))
+        return np.count_nonzero(state > self._edges, axis=1)
+
+    def select_action(self, state):
+        """Greedy action of the grid point nearest to the state
+
+        :param state: state of the environment
+        :type state: array-like
+        :rtype: int
+        """
+        return int(self._flat[self.quantize(state) @ self._strides])
+
+    def select_actions(self, states):
+        """Greedy actions of a batch of states
+
+        :param states: one state per row
+        :type states: array-like
+        :rtype: numpy.ndarray
+        """
+        states = np.asarray(states, dtype=np.float64)
+        states = np.reshape(states, (len(states), -1, 1))
+        return self._flat[
+            np.count_nonzero(states > self._edges, axis=2) @ self._strides
+        ]
+
+    def save(self, path):
+        """Write the table to a .npz file
+
+        :param path: file name
+        :type path: str
+        """
+        np.savez_compressed(
+            path,
+            actions=self.actions,
+            grid_sizes=np.array([len(points) for points in self.grids]),
+            grid_points=np.concatenate(self.grids),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Read a table written by save
+
+        :param path: file name
+        :type path: str
+        :rtype: class:'PolicyTable'
+        """
+        with np.load(path) as data:
+            splits = np.cumsum(data["grid_sizes"])[:-1]
+            return cls(np.split(data["grid_points"], splits), data["actions"])
+
+
+class TableBuilder(threading.Thread):
+    """Evaluates lookup tables again in a thread of its own, evaluating all grid points takes far longer than a
+    decision. The agent keeps deciding with the old table until the new one is handed to done. Requests for a table
+    that is not built yet replace each other, only the latest network is evaluated
+
+    :param done: called with the key and the new table once a table is built
+    :type done: function
+    """
+
+    def __init__(self, done):
+        threading.Thread.__init__(self, daemon=True)
+        self.done = done
+        self.requests = {}
+        self.lock = threading.Condition()
+
+    def request(self, key, network, grids):
+        """Build the table of a network, the network is copied so that it can be trained further meanwhile
+
+        :param key: passed to done with the table, e.g. the path characteristics of the meta model
+        :type key: hashable
+        :param network: policy network of a meta model
+        :type network: class:'DQN.DQN_Network'
+        :param grids: sorted representative values of every state dimension
+        :type grids: list
+        """
+        network = deepcopy(network)
+        with self.lock:
+            self.requests[key] = (network, grids)
+            self.lock.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.requests:
+                    self.lock.wait()
+                key = next(iter(self.requests))
+                network, grids = self.requests.pop(key)
+            try:
+                table = PolicyTable.build(network, grids)
+            except Exception as e:
+                print(f"Failed to build lookup table {key}: {e}")
+                continue
+            self.done(key, table)
@@ -0,0 +1,123 @@
+import numpy as np
+
+
+class SubflowSnapshot:
+    """Raw subflow measurements of the current and the previous call to mpsched.get_sub_info, kept in two
+    preallocated arrays that swap roles on every load. Rows of subflows that are not reported are zero.
+
+    :param max_flows: Maximum possible number of available subflows
+    :type max_flows: int
+    :param num_fields: Number of values reported per subflow by mpsched.get_sub_info
+    :type num_fields: int
+    """
+
+    def __init__(self, max_flows, num_fields):
+        self.current = np.zeros((max_flows, num_fields))
+        self.last = np.zeros((max_flows, num_fields))
+        self.num_active = 0
+
+    @property
+    def active(self):
+        """Boolean mask of the subflows reported by the last load"""
+        return np.arange(len(self.current)) < self.num_active
+
+    def load(self, subs):
+        """Store a new measurement, the current one becomes the previous one
+
+        :param subs: Raw observations from socket api with mpsched extension, a list of rows or an array with one row
+            per subflow as filled by mpsched.get_sub_info_into
+        :type subs: list or numpy.ndarray
+        """
+        self.current, self.last = self.last, self.current
+        self.current[:] = 0
+        self.num_active = min(len(subs), len(self.current))
+        if isinstance(subs, np.ndarray):
+            width = min(subs.shape[1], self.current.shape[1])
+            self.current[: self.num_active, :width] = subs[: self.num_active, :width]
+            return
+        for i in range(self.num_active):
+            row = subs[i]
+            self.current[i, : len(row)] = row
+
+    def delta(self, field):
+        """Absolute change of a counter of every subflow since the previous measurement
+
+        :param field: index of the value in the rows reported by mpsched.get_sub_info
+        :type field: int
+        :rtype: numpy.ndarray
+        """
+        return np.abs(self.current[:, field] - self.last[:, field])
+
+    def reset(self):
+        self.current[:] = 0
+        self.last[:] = 0
+        self.num_active = 0
+
+
+class RingWindow:
+    """Sliding window over the last k observations, stored in a preallocated ring buffer.
+
+    Every observation is written twice, k columns apart, so that the window in chronological order is always a
+    contiguous slice of the buffer and can be returned as a view without copying. A view returned by window()
+    stays valid until the next push, one returned by latest() for k - 1 further pushes.
+
+    :param size: Number of values per observation
+    :type size: int
+    :param k: Number of observations in the window
+    :type k: int
+    """
+
+    def __init__(self, size, k):
+        self.k = k
+        self._buffer = np.zeros((size, 2 * k))
+        self._head = 0  # column of the oldest observation
+
+    def push(self, observation):
+        self._buffer[:, self._head] = observation
+        self._buffer[:, self._head + self.k] = observation
+        self._head = (self._head + 1) % self.k
+
+    def window(self):
+        """Last k observations, oldest first
+
+        :rtype: numpy.ndarray of shape (size, k)
+        """
+        return self._buffer[:, self._head : self._head + self.k]
+
+    def latest(self):
+        """Most recent observation
+
+        :rtype: numpy.ndarray of shape (size,)
+        """
+        return self._buffer[:, self._head + self.k - 1]
+
+    def reset(self):
+        self._buffer[:] = 0
+        self._head = 0
+
+
+class RunningMean:
+    """Incremental mean of every subflow, replaces keeping all past values to average them
+
+    :param size: Number of independent means
+    :type size: int
+    """
+
+    def __init__(self, size):
+        self.count = np.zeros(size, dtype=np.int64)
+        self.mean = np.zeros(size)
+
+    def update(self, values, mask):
+        """Add one value to the means selected by mask
+
+        :param values: New value of every mean
+        :type values: numpy.ndarray
+        :param mask: Boolean mask of the means to update
+        :type mask: numpy.ndarray
+        """
+        self.count[mask] += 1
+        self.mean[mask] += (values[mask] - self.mean[mask]) / self.count[mask]
+
+    def reset(self):
+        self.count[:] = 0
+        self.mean[:] = 0
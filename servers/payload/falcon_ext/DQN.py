@@ -38,6 +38,66 @@ class DQN_Network(nn.Module):
         return action
 
 
+class DQN_NumpyPolicy:
+    """Copy of the weights of a DQN_Network as contiguous NumPy arrays for single state decisions.
+
+    For a network this small the dispatch overhead of a torch forward pass dominates the latency of a
+    decision, the same forward pass with NumPy matmuls on preallocated arrays is several times faster.
+    The copy does not follow changes of the network, call load after the weights changed.
+
+    :param network: network to copy the weights from
+    :type network: class:'DQN_Network'
+    """
+
+    def __init__(self, network):
+        self.load(network)
+
+    def load(self, network):
+        """Copy the current weights of the network
+
+        :param network: network to copy the weights from
+        :type network: class:'DQN_Network'
+        """
+        layers = [network.linear1, network.linear3, network.linear4, network.linear5]
+        # stored transposed so that a layer is x @ W + b
+        self.weights = [
+            np.ascontiguousarray(layer.weight.detach().cpu().numpy().T)
+            for layer in layers
+        ]
+        self.biases = [layer.bias.detach().cpu().numpy().copy() for layer in layers]
+        self.num_inputs = self.weights[0].shape[0]
+        self._input = np.empty((1, self.num_inputs), dtype=self.weights[0].dtype)
+        self._outputs = [np.empty((1, w.shape[1]), dtype=w.dtype) for w in self.weights]
+
+    def q_values(self, state):
+        """Q-values of all actions for a single state
+
+        :param state: state of the environment
+        :type state: array-like
+        :return: Q-values, the array is reused by the next call
+        :rtype: numpy.ndarray of shape (1, num_outputs)
+        """
+        self._input[0] = np.reshape(state, self.num_inputs)
+        out = self._input
+        last = len(self.weights) - 1
+        for i, (w, b, o) in enumerate(zip(self.weights, self.biases, self._outputs)):
+            np.matmul(out, w, out=o)
+            o += b
+            if i < last:
+                np.maximum(o, 0, out=o)
+            out = o
+        return out
+
+    def select_action(self, state):
+        """Greedy action for a single state
+
+        :param state: state of the environment
+        :type state: array-like
+        :rtype: int
+        """
+        return int(np.argmax(self.q_values(state)))
+
+
 class DQN_Agent:
     def __init__(self, num_inputs, hidden_size, num_outputs, gamma):
         self.policy_network = DQN_Network(num_inputs, hidden_size, num_outputs)
@@ -50,13 +110,31 @@ class DQN_Agent:
         self.eps_l = 0.3
         self.eps_s = 0.1
         self.train_steps = 0
-
-    def train(self, batch, k):
-        batch_state = Variable(torch.cat(batch.state))
-        batch_next_state = Variable(torch.cat(batch.next_state))
-        batch_action = Variable(torch.cat(batch.action)).unsqueeze(1)
-        batch_reward = Variable(torch.cat(batch.reward)).unsqueeze(1)
-        batch_mask = Variable(torch.cat(batch.mask)).unsqueeze(1)
+        # NumPy copy of policy_network for select_action, rebuilt after the weights changed
+        self.numpy_policy = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["numpy_policy"] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault("numpy_policy", None)
+        self.__dict__.update(state)
+
+    def train(self, batch, k, weights=None):
+        """k gradient steps on a batch
+
+        :param weights: importance sampling weights of the transitions for prioritized replay
+        :type weights: torch.Tensor
+        :return: loss and td errors of the transitions in the last step
+        :rtype: float, torch.Tensor
+        """
+        batch_state = Variable(batch.state)
+        batch_next_state = Variable(batch.next_state)
+        batch_action = Variable(batch.action).unsqueeze(1)
+        batch_reward = Variable(batch.reward).unsqueeze(1)
+        batch_mask = Variable(batch.mask).unsqueeze(1)
         # k-steps of adam
 
         for i in range(k):
@@ -69,18 +147,29 @@ class DQN_Agent:
                     * torch.max(q_val_next, dim=1, keepdim=True)[0]
                 )
 
-            loss = F.mse_loss(
-                self.policy_network(batch_state).gather(1, batch_action.long()), preds
-            )
+            q_values = self.policy_network(batch_state).gather(1, batch_action.long())
+            if weights is None:
+                loss = F.mse_loss(q_values, preds)
+            else:
+                loss = torch.mean(weights.unsqueeze(1) * (q_values - preds) ** 2)
             self.optimizer.zero_grad()
             loss.backward()
             self.optimizer.step()
 
         self.train_steps += 1
+        self.numpy_policy = None
 
-        return loss.item()
+        return loss.item(), (preds - q_values).detach().squeeze(1)
 
-    def select_action(self, state):
+    def select_action(self, state, cache=None):
+        """Epsilon greedy action for a single state
+
+        :param state: state of the environment
+        :type state: array-like
+        :param cache: action cache of the connection, the policy network is only evaluated for states it has no action for
+        :type cache: class:'action_cache.ActionCache'
+        :rtype: int
+        """
         # epsilon greedy exploration
         random_n = random.random()
 
@@ -89,14 +178,22 @@ class DQN_Agent:
             eps_threshold = self.eps_s
 
         if random_n < eps_threshold:
-            random_action = random.randint(0, self.num_outputs - 1)
-            action = torch.tensor([random_action])
-        else:
-            with torch.no_grad():
-                action = torch.argmax(self.policy_network(state), dim=1)
-        return action.item()
+            return random.randint(0, self.num_outputs - 1)
+        if self.numpy_policy is None:
+            self.numpy_policy = DQN_NumpyPolicy(self.policy_network)
+        if isinstance(state, torch.Tensor):
+            state = state.detach().cpu().numpy()
+        if cache is None:
+            return self.numpy_policy.select_action(state)
+        signature = cache.signature(state)
+        action = cache.get(signature, self.numpy_policy)
+        if action is None:
+            action = self.numpy_policy.select_action(state)
+            cache.put(signature, self.numpy_policy, action)
+        return action
 
     def update_state_dict(self, state_dict, iteration):
         self.policy_network.load_state_dict(state_dict)
         self.target_network.load_state_dict(state_dict)
+        self.numpy_policy = None
         self.optimizer = Adam(self.policy_network.parameters(), lr=1e-3)
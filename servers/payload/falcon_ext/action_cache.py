@@ -0,0 +1,116 @@
+"""Memoization of the actions of the online agents
+
+During a bulk transfer the state of a connection often barely changes from
+one decision to the next, and the forward pass of the policy network yields
+the same action again. The cache of a connection keeps the last action of the
+policy network together with the signature of the state it was computed for,
+the state on a logarithmic scale. The action is reused while every variable of
+the state stays within a relative tolerance of that state (an absolute one
+for values close to 0), for at most ttl seconds and only as long as the policy
+that computed it is in use, a fine tuned or reloaded model computes a new
+action. The tolerance is checked against the state of the computed action and
+not against bins of a fixed grid, a state with many variables would almost
+always have one of them on the other side of a bin boundary. Exploration is
+applied to cached actions like to computed ones.
+"""
+
+import math
+import time
+
+import numpy as np
+
+
+def create_action_cache(cfg):
+    """Action cache with the parameters of the [action_cache] section of config.ini
+
+    :param cfg: contains all the neccessary parameters read from config.ini
+    :type cfg: configParser
+    :return: None if the cache is disabled
+    :rtype: class:'ActionCache'
+    """
+    section = "action_cache"
+    if not cfg.getboolean(section, "enabled"):
+        return None
+    return ActionCache(
+        tolerance=cfg.getfloat(section, "tolerance"),
+        ttl=cfg.getfloat(section, "ttl"),
+    )
+
+
+class ActionCache:
+    """Last action of the policy network for a connection
+
+    :param tolerance: relative change of a state variable that still counts as the same state
+    :type tolerance: float
+    :param ttl: seconds an action is reused at most
+    :type ttl: float
+    """
+
+    def __init__(self, tolerance=0.05, ttl=0.5):
+        self.tolerance = tolerance
+        self.ttl = ttl
+        self._step = math.log1p(tolerance)
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def signature(self, state):
+        """State on a logarithmic scale, a difference of log1p(tolerance) is a relative change of tolerance
+
+        :param state: state of the environment
+        :type state: array-like
+        :rtype: numpy.ndarray
+        """
+        state = np.asarray(state, dtype=np.float64).reshape(-1)
+        return np.copysign(np.log1p(np.abs(state)), state)
+
+    def get(self, signature, policy):
+        """Cached action for a state
+
+        :param signature: signature of the state
+        :type signature: numpy.ndarray
+        :param policy: policy the action has to come from
+        :return: action, None if the state moved or the action expired
+        """
+        if (
+            self._action is None
+            or policy is not self._policy
+            or self._expires < time.monotonic()
+            or signature.shape != self._signature.shape
+            or np.max(np.abs(signature - self._signature)) > self._step
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._action
+
+    def put(self, signature, policy, action):
+        """Remember the action the policy computed for a state
+
+        :param signature: signature of the state
+        :type signature: numpy.ndarray
+        :param policy: policy that computed the action
+        :param action: action of the policy network without exploration
+        """
+        self._signature = signature
+        self._policy = policy
+        self._action = action
+        self._expires = time.monotonic() + self.ttl
+
+    def clear(self):
+        """Forget the action and reset the counters, e.g. for a new connection"""
+        self._signature = None
+        self._policy = None
+        self._action = None
+        self._expires = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def summary(self):
+        """Hit and miss counters
+
+        :rtype: str
+        """
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.1%} hit rate)"
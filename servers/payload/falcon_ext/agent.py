@@ -9,20 +9,25 @@ import time
 from copy import deepcopy
 from functools import partial
 
-import bayesian_changepoint_detection.online_changepoint_detection as oncd
-import falcon_ext_mpsched as mpsched
 import matplotlib.pyplot as plt
+import mpsched_backend as mpsched
 import numpy as np
 import pandas as pd
 import torch
-from bayes_online import BayesOnline
+from action_cache import create_action_cache
+from changepoint import create_detector
+from decision_clock import create_clock
 
 # from env import Env
 from DQN import DQN_Agent
 from env_ext import Env
-from replay_memory import ReplayMemory, Transition
+from model_bank import open_bank
+from policy_table import PolicyTable, TableBuilder
+from replay_memory import ReplayMemory, Transition, anneal_beta
+from telemetry import create_telemetry
 from torch.autograd import Variable
 from torch.optim import Adam
+from training_throttle import create_throttle
 
 CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
 TMP_DIR = CURRENT_DIR / "artifacts"
@@ -38,7 +43,7 @@ class Online_Agent(threading.Thread):
     :param cfg: contains all the neccessary training parameter read from config.ini
     :type cfg: configParser
     :param event: event to inform the online agent of finished MPTCP connection and no need to perform new interactions
-    :type event: class:'threading.event'
+    :type event: class:'multiprocessing.Event'
     """
 
     def __init__(self, fd, cfg, event):
@@ -46,12 +51,13 @@ class Online_Agent(threading.Thread):
         self.fd = fd
         self.cfg = cfg
         self.memory = str((TMP_DIR / cfg.get("replaymemory", "memory")).resolve())
-        self.agent_name = str((TMP_DIR / cfg.get("dqn", "agent")).resolve()) + "/"
+        self.bank = open_bank(cfg, TMP_DIR)
         self.agent = 0
         self.env = Env(
             fd=self.fd,
             time=self.cfg.getfloat("env", "time"),
             max_flows=cfg.getint("train", "max_num_flows"),
+            clock=create_clock(self.cfg),
         )
         self.batch_size = cfg.getint("train", "batch_size")
         self.event = event
@@ -87,26 +93,46 @@ class Online_Agent(threading.Thread):
             self.batch_size
         )  # replay memory for fine tune
         self.fft = 0  # first fine tune after starting testing
+        self.use_table = cfg.getboolean("lookup", "enabled")
+        self.table_name = str((TMP_DIR / cfg.get("lookup", "tables")).resolve()) + "/"
+        self.index = None  # path characteristics of the current meta model
+        # lookup table of every loaded meta model if enabled, None if none was exported
+        self.tables = {}
+        # tables of fine tuned or reloaded meta models are built while the agent keeps deciding
+        self.table_builder = TableBuilder(self.tables.__setitem__)
+        self.telemetry = create_telemetry(cfg, TMP_DIR)
+        self.action_cache = create_action_cache(cfg)
         self.current_file_size = [0] * self.max_flows
 
     def run(self):
         """Override the run method from threading with the desired behaviour of the Online Agent class"""
+        if self.use_table:
+            self.table_builder.start()
         detected_change = 0
         index = "".join(str(x) for x in self.path_char)
-        self.agent = torch.load(self.agent_name + index + ".pkl")
+        self.agent = self.bank.load(index)
+        self.load_table(index)
         self.fft = 0
+        num_streams = self.num_char * self.max_flows
+        # one changepoint detector per characteristic and subflow
+        det = create_detector(self.cfg, num_streams)
         while True:
             self.event.wait()
-            det = []
-            for i in range(self.num_char * self.max_flows):
-                det.append(BayesOnline())
+            det.reset()
+            if self.telemetry is not None:
+                self.env.telemetry = self.telemetry.start(self.env.fd)
             state = self.env.reset()
             start = time.time()
             # if not self.done:
             # print(*(state[0 : self.max_flows]))
             count = 0
             while True:
-                action = self.agent.select_action(torch.FloatTensor(state).unsqueeze(0))
+                # the table builder may replace the table of the current meta model at any time
+                table = self.tables.get(self.index)
+                if table is not None:
+                    action = table.select_action(state)
+                else:
+                    action = self.agent.select_action(state, self.action_cache)
                 end = time.time()
                 active = [0] * self.max_flows
                 active[action] = 1
@@ -118,6 +144,12 @@ class Online_Agent(threading.Thread):
 
                 if self.done or (not self.event.is_set()):
                     self.fft += 1
+                    print(f"decision clock: {self.env.clock.summary()}")
+                    if self.action_cache is not None:
+                        print(f"action cache: {self.action_cache.summary()}")
+                        self.action_cache.clear()
+                    if self.telemetry is not None:
+                        self.telemetry.stop()
                     break
                 cond = np.concatenate((cond, self.current_file_size))
                 # print(cond)
@@ -129,21 +161,22 @@ class Online_Agent(threading.Thread):
                 if len(self.ft_replay_memory) >= 32:
                     if self.fft == 11:
                         index = "".join(str(x) for x in self.path_char)
-                        self.agent = torch.load(self.agent_name + index + ".pkl")
+                        self.agent = self.bank.load(index)
+                        self.load_table(index)
                         if len(self.ft_replay_memory) >= self.batch_size:
                             # print("first fine tune for static scenario")
-                            transitions = self.ft_replay_memory.sample(self.batch_size)
-                            batch = Transition(*zip(*transitions))
-                            loss = self.agent.train(batch, int(self.k))
+                            batch = self.ft_replay_memory.sample(self.batch_size)
+                            loss, _ = self.agent.train(batch, int(self.k))
+                            self.rebuild_table()
                             # print(loss)
                             self.fft = 12
                     self.ft_replay_memory = ReplayMemory(self.batch_size)
 
                 self.ft_replay_memory.push(
-                    torch.FloatTensor(state).unsqueeze(0),
+                    torch.as_tensor(state, dtype=torch.float32).unsqueeze(0),
                     torch.Tensor([float(action)]),
                     torch.FloatTensor([mask]),
-                    torch.FloatTensor(state_nxt).unsqueeze(0),
+                    torch.as_tensor(state_nxt, dtype=torch.float32).unsqueeze(0),
                     torch.FloatTensor([float(reward)]),
                 )
 
@@ -161,14 +194,8 @@ class Online_Agent(threading.Thread):
 
                 df.to_csv(self.memory, mode="a+", index=False, header=False)
 
-                for m in range(self.num_char * self.max_flows):
-                    det[m].update(cond[m])
-                    prob = det[m].get_probabilities(
-                        32
-                    )  # changepoint over the last 32 points (batch_size)
-                    if len(prob) >= 1 and np.any(prob[1:] > 0.95):
-                        det[m] = BayesOnline()
-                        detected_change = 1
+                if np.any(det.update(cond[:num_streams])):
+                    detected_change = 1
                 if detected_change:
                     detected_change = 0
                     last_path_char = self.path_char
@@ -178,15 +205,48 @@ class Online_Agent(threading.Thread):
                                 self.path_char[i] = k
                     if np.any(last_path_char != self.path_char):
                         index = "".join(str(x) for x in self.path_char)
-                        self.agent = torch.load(self.agent_name + index + ".pkl")
+                        self.agent = self.bank.load(index)
+                        self.load_table(index)
                         if len(self.ft_replay_memory) > self.batch_size:
-                            transitions = self.ft_replay_memory.sample(self.batch_size)
-                            batch = Transition(*zip(*transitions))
-                            loss = self.agent.train(batch, int(self.k))
+                            batch = self.ft_replay_memory.sample(self.batch_size)
+                            loss, _ = self.agent.train(batch, int(self.k))
+                            self.rebuild_table()
 
                 # print(self.path_char)
                 state = state_nxt
 
+    def load_table(self, index):
+        """Lookup table of the meta model that was just loaded if the lookup mode is enabled. The exported table is used
+        the first time, the table of a reloaded model is evaluated again from the loaded network since the exported one
+        may be older than the model. Without an exported table the meta model decides.
+        Tables hold the greedy policy, there is no exploration while deciding by lookup
+
+        :param index: path characteristics of the meta model
+        :type index: str
+        """
+        self.index = index
+        if not self.use_table:
+            return
+        if index in self.tables:
+            self.rebuild_table()
+            return
+        path = self.table_name + index + ".npz"
+        if os.path.exists(path):
+            self.tables[index] = PolicyTable.load(path)
+        else:
+            print(f"Warning: no lookup table {path}, deciding with the meta model")
+            self.tables[index] = None
+
+    def rebuild_table(self):
+        """Evaluate the lookup table again after the current model was fine tuned or reloaded. The table is built by
+        the table builder, the agent decides with the old table until it is done
+        """
+        table = self.tables.get(self.index)
+        if table is not None:
+            self.table_builder.request(
+                self.index, self.agent.policy_network, table.grids
+            )
+
     def update_fd(self, fd):
         """Update the current file descriptor used in the Environment Class for reading information from subflows with socket options"""
         self.env.update_fd(fd)
@@ -205,15 +265,15 @@ class Offline_Agent(multiprocessing.Process):
 
     :param cfg: contains all the neccessary training parameter read from config.ini
     :type cfg: configParser
-    :param event: event indicating start/end of episode
-    :type event: class:'threading.event'
+    :param event: set while a transfer is in flight, training is throttled meanwhile (training_throttle.py)
+    :type event: class:'multiprocessing.Event'
     """
 
     def __init__(self, cfg, event):
         """Constructor Method"""
         multiprocessing.Process.__init__(self)
         self.memory_name = str((TMP_DIR / cfg.get("replaymemory", "memory")).resolve())
-        self.nn = str((TMP_DIR / cfg.get("dqn", "agent")).resolve()) + "/"
+        self.bank = open_bank(cfg, TMP_DIR)
         self.cfg = cfg
         self.episode = cfg.getint("train", "episode")
         self.batch_size = cfg.getint("train", "batch_size")
@@ -260,8 +320,21 @@ class Offline_Agent(multiprocessing.Process):
         self.replay_memory = []
         for i in range(len(self.ALL_CHAR)):
             self.replay_memory.append(
-                ReplayMemory(cfg.getint("replaymemory", "capacity"))
+                ReplayMemory(
+                    cfg.getint("replaymemory", "capacity"),
+                    dtype=getattr(torch, cfg.get("replaymemory", "dtype")),
+                )
             )
+        # prioritized replay, samples uniformly for priority_alpha = 0
+        priority_alpha = cfg.getfloat("replaymemory", "priority_alpha")
+        self.priority_beta = cfg.getfloat("replaymemory", "priority_beta")
+        self.beta_steps = cfg.getint("replaymemory", "beta_steps")
+        if priority_alpha > 0:
+            for memory in self.replay_memory:
+                memory.enable_priorities(priority_alpha)
+        # number of transitions each partition received since its meta model was last
+        # updated, partitions without new experience are neither trained nor saved
+        self.new_transitions = np.zeros(len(self.ALL_CHAR), dtype=np.int64)
 
     def run(self):
         """Override the run method from threading with the desired behaviour of the Online Agent class"""
@@ -272,6 +345,8 @@ class Offline_Agent(multiprocessing.Process):
         )
         checkpoint = 0
         weights_before = None
+        # created in the process of the offline agent, the policy applies to its threads
+        throttle = create_throttle(self.cfg, self.event)
         Exp = [[0]]
         print("start server")
         while True:
@@ -304,23 +379,37 @@ class Offline_Agent(multiprocessing.Process):
                     ).unsqueeze(0),
                     torch.FloatTensor([float(Exp.iloc[t - 1][0])]),
                 )
+                self.new_transitions[combination_index] += 1
                 t += 6
                 if t >= len(Exp[0]):
                     break
 
             # reptile learning loop using openai/research/reptile as reference
-            # do n_iteration for ever partitioned group to create all meta models
-            for k in range(len(self.ALL_CHAR)):
+            # do n_iteration for every partitioned group with new experience to update its
+            # meta model, partitions with the most new transitions first
+            for k in self.dirty_partitions():
                 number_of_convergence_points = 0
                 index = "".join(str(x) for x in self.ALL_CHAR[k])
-                agent_name = self.nn + index + ".pkl"
-                agent = torch.load(agent_name)
+                agent = self.bank.load(index)
                 for i in range(n_iterations):
                     weights_before = deepcopy(agent.policy_network.state_dict())
                     if len(self.replay_memory[k]) > self.batch_size * 1000:
-                        transitions = self.replay_memory[k].sample(self.batch_size)
-                        batch = Transition(*zip(*transitions))
-                        loss = agent.train(batch, self.k)
+                        throttle.step()
+                        memory = self.replay_memory[k]
+                        if memory.priorities is not None:
+                            batch, positions, weights = memory.sample_prioritized(
+                                self.batch_size,
+                                anneal_beta(
+                                    self.priority_beta,
+                                    agent.train_steps,
+                                    self.beta_steps,
+                                ),
+                            )
+                            loss, td_errors = agent.train(batch, self.k, weights)
+                            memory.update_priorities(positions, td_errors)
+                        else:
+                            batch = memory.sample(self.batch_size)
+                            loss, _ = agent.train(batch, self.k)
                         # print(loss)
                         weights_after = agent.policy_network.state_dict()
 
@@ -334,5 +423,19 @@ class Offline_Agent(multiprocessing.Process):
                         # for the next k step of optimization in the following episode
                         agent.update_state_dict(weights_before, i)
 
-                torch.save(agent, agent_name)
+                self.bank.save(index, agent)
+                self.new_transitions[k] = 0
             time.sleep(5)
+
+    def dirty_partitions(self):
+        """Partitions that received new transitions since their last meta update and hold enough experience
+        to be trained, ordered by the number of new transitions (largest first)
+
+        :return: indices into ALL_CHAR of the partitions to update in this cycle
+        :rtype: numpy.ndarray
+        """
+        sizes = np.array([len(memory) for memory in self.replay_memory])
+        ready = np.flatnonzero(
+            (self.new_transitions > 0) & (sizes > self.batch_size * 1000)
+        )
+        return ready[np.argsort(-self.new_transitions[ready], kind="stable")]
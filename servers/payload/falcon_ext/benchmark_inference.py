@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+# Compares the decision latency of the torch forward pass of the FALCON DQN with its NumPy copy
+
+import argparse
+import pathlib
+import time
+from configparser import ConfigParser
+
+import numpy as np
+import torch
+from DQN import DQN_Agent, DQN_NumpyPolicy
+from model_bank import open_bank
+
+CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
+
+
+def torch_decision(network, state):
+    """Greedy decision as taken by the online agent before the NumPy copy existed"""
+    with torch.no_grad():
+        return torch.argmax(
+            network(torch.FloatTensor(state).unsqueeze(0)), dim=1
+        ).item()
+
+
+def measure(decide, states, repeat):
+    """Time single state decisions
+
+    :return: median and 99th percentile latency in microseconds and the decisions of the first pass
+    :rtype: float, float, list
+    """
+    actions = [decide(state) for state in states]
+    latencies = np.empty(repeat * len(states))
+    n = 0
+    for _ in range(repeat):
+        for state in states:
+            start = time.perf_counter()
+            decide(state)
+            latencies[n] = time.perf_counter() - start
+            n += 1
+    latencies *= 1e6
+    return np.median(latencies), np.percentile(latencies, 99), actions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the decision latency of the FALCON DQN"
+    )
+    parser.add_argument(
+        "--partition",
+        help="Meta model of the model bank to benchmark, e.g. 0101, untrained network if omitted",
+    )
+    parser.add_argument(
+        "--states", type=int, default=1000, help="Number of random states"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=10, help="Passes over the random states"
+    )
+    parser.add_argument("--threads", type=int, help="Torch intra-op threads")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random states")
+    args = parser.parse_args()
+
+    cfg = ConfigParser()
+    cfg.read(CURRENT_DIR / "config.ini")
+    max_flows = cfg.getint("train", "max_num_flows")
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.partition:
+        agent = open_bank(cfg, CURRENT_DIR / "artifacts").load(args.partition)
+    else:
+        agent = DQN_Agent(
+            hidden_size=3,
+            num_inputs=4 * max_flows,
+            num_outputs=max_flows,
+            gamma=cfg.getfloat("dqn", "gamma"),
+        )
+    network = agent.policy_network
+    numpy_policy = DQN_NumpyPolicy(network)
+
+    # rtt, cwnd, unacked and send window of every path, the ranges seen by the online agent
+    rng = np.random.default_rng(args.seed)
+    states = rng.uniform(0, 500, (args.states, 4 * max_flows))
+
+    print(
+        f"{args.states} states, {args.repeat} passes, {torch.get_num_threads()} threads"
+    )
+    print(f"{'backend':<10}{'median [us]':>14}{'p99 [us]':>12}")
+    results = {}
+    for name, decide in (
+        ("torch", lambda state: torch_decision(network, state)),
+        ("numpy", numpy_policy.select_action),
+    ):
+        median, p99, actions = measure(decide, states, args.repeat)
+        results[name] = actions
+        print(f"{name:<10}{median:>14.1f}{p99:>12.1f}")
+    agree = np.mean(np.array(results["torch"]) == np.array(results["numpy"]))
+    print(f"decisions equal: {agree:.2%}")
+
+
+if __name__ == "__main__":
+    main()
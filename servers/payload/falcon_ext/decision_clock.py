@@ -0,0 +1,145 @@
+"""Pacing of the decisions of the online agents
+
+The state interval (SI) between two decisions should be a few RTTs: shorter
+and the measurements of a decision do not yet show its effect, longer and the
+agent reacts late. The clock derives the interval from the smoothed RTT the
+kernel reports per subflow with mpsched.get_sub_info and sleeps until the
+next tick on the monotonic clock. Ticks are scheduled on a fixed grid, time
+spent deciding and training between two ticks is not added to the interval.
+The delay of every wake up against its tick (jitter) is recorded.
+"""
+
+import time
+
+import numpy as np
+
+
+def create_clock(cfg):
+    """Decision clock with the parameters of the [env] section of config.ini
+
+    :param cfg: contains all the neccessary parameters read from config.ini
+    :type cfg: configParser
+    :rtype: class:'DecisionClock'
+    """
+    return DecisionClock(
+        interval=cfg.getfloat("env", "time"),
+        rtt_multiple=cfg.getfloat("env", "rtt_multiple"),
+        min_interval=cfg.getfloat("env", "min_time"),
+        max_interval=cfg.getfloat("env", "max_time"),
+    )
+
+
+class DecisionClock:
+    """Monotonic clock that ticks every rtt_multiple smoothed RTTs
+
+    :param interval: interval in seconds until the first RTT is known, and always if rtt_multiple is 0
+    :type interval: float
+    :param rtt_multiple: number of RTTs per interval
+    :type rtt_multiple: float
+    :param min_interval: lower bound of the interval in seconds
+    :type min_interval: float
+    :param max_interval: upper bound of the interval in seconds
+    :type max_interval: float
+    :param gain: weight of a new RTT in the moving average, 1/8 like the srtt of TCP
+    :type gain: float
+    :param history: number of jitter samples kept for the statistics
+    :type history: int
+    """
+
+    def __init__(
+        self,
+        interval,
+        rtt_multiple=0,
+        min_interval=0,
+        max_interval=float("inf"),
+        gain=0.125,
+        history=1024,
+    ):
+        self.default = interval
+        self.rtt_multiple = rtt_multiple
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.gain = gain
+        self._jitter = np.zeros(history)
+        self.reset()
+        self.start()
+
+    def reset(self):
+        """Forget the RTT of the last connection"""
+        self.interval = self.default
+        self.srtt = 0.0
+
+    def start(self):
+        """Restart the ticks and the statistics, the first tick is one interval from now"""
+        self.ticks = 0
+        self.overruns = 0  # ticks that were already over when wait was called
+        self._next = time.monotonic() + self.interval
+
+    def update(self, rtts):
+        """Adapt the interval to new RTT measurements. The interval follows the slowest subflow, a decision only shows
+        in the measurements once every subflow carried data with it
+
+        :param rtts: smoothed RTT in seconds of every reported subflow, 0 if not measured yet
+        :type rtts: numpy.ndarray
+        """
+        if self.rtt_multiple <= 0 or len(rtts) == 0:
+            return
+        rtt = float(np.max(rtts))
+        if rtt <= 0:
+            return
+        if self.srtt == 0:
+            self.srtt = rtt
+        else:
+            self.srtt += self.gain * (rtt - self.srtt)
+        self.interval = min(
+            max(self.rtt_multiple * self.srtt, self.min_interval), self.max_interval
+        )
+
+    def wait(self):
+        """Sleep until the next tick
+
+        If the clock fell behind by more than an interval it does not try to catch up with a burst of decisions, the
+        grid restarts at the current time.
+
+        :return: jitter of the tick in seconds
+        :rtype: float
+        """
+        remaining = self._next - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        else:
+            self.overruns += 1
+        now = time.monotonic()
+        jitter = now - self._next
+        self._jitter[self.ticks % len(self._jitter)] = jitter
+        self.ticks += 1
+        self._next += self.interval
+        if self._next <= now:
+            self._next = now + self.interval
+        return jitter
+
+    def stats(self):
+        """Jitter of the recorded ticks in milliseconds
+
+        :return: number of ticks, overruns, current interval, mean, 99th percentile and maximum jitter
+        :rtype: dict
+        """
+        samples = self._jitter[: min(self.ticks, len(self._jitter))] * 1000
+        if len(samples) == 0:
+            samples = np.zeros(1)
+        return {
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "interval": self.interval * 1000,
+            "mean": float(np.mean(samples)),
+            "p99": float(np.percentile(samples, 99)),
+            "max": float(np.max(samples)),
+        }
+
+    def summary(self):
+        """One line of the statistics for the log"""
+        s = self.stats()
+        return (
+            f"{s['ticks']} decisions every {s['interval']:.1f}ms, {s['overruns']} overruns, "
+            f"jitter mean {s['mean']:.3f}ms p99 {s['p99']:.3f}ms max {s['max']:.3f}ms"
+        )
@@ -1,8 +1,15 @@
-import statistics
 import time
 
-import falcon_ext_mpsched as mpsched
+import mpsched_backend as mpsched
 import numpy as np
+from decision_clock import DecisionClock
+from state_buffer import RingWindow, RunningMean, SubflowSnapshot
+
+# position of the values reported per subflow by mpsched.get_sub_info
+SEGS_OUT, RTT, CWND, UNACKED, TOTAL_RETRANS, DST_ADDR, SND_WND = range(7)
+NUM_FIELDS = 9
+# destination address of every path, in the order the paths appear in the state
+PATH_ADDRS = (16842762, 33685514, 50528266)  # 2785061056, 3892357312, 2868947136
 
 
 class Env:
@@ -16,88 +23,124 @@ class Env:
     :param k: int
     :param max_flows: Maximum possible number of available subflows
     :type max_flows: int
+    :param clock: clock that paces the decisions, a fixed SI of time if None
+    :type clock: class:'decision_clock.DecisionClock'
     """
 
-    def __init__(self, fd, time, max_flows):
+    def __init__(self, fd, time, max_flows, clock=None):
         self.fd = fd
         self.time = time
+        self.clock = clock if clock is not None else DecisionClock(time)
         self.num_segments = 20
         self.k = 8
         self.max_num_flows = max_flows
         self.alpha = 0.3
         self.b = 0.5
 
-        self.last = [[0] * 5 for _ in range(self.max_num_flows)]
-        self.tp = [
-            0
-        ] * self.max_num_flows  # number of segs sent(Max number of subflows)
-        self.rtt = [0] * self.max_num_flows  # snapshot of rtt
-        self.drtt = [0] * self.max_num_flows  # ratio of RTT deviation to mean RTTT
-        self.cwnd = [0] * self.max_num_flows  # cwnd
-        self.rr = [0] * self.max_num_flows  # number of packets in flight
-        self.in_flight = [
-            0
-        ] * self.max_num_flows  # number of total retransmission (packets_lost)
-        self.packet_loss = [
-            0
-        ] * self.max_num_flows  # packet loss in percent compared to segs_out(tp)
-        self.send_wnd = [0] * self.max_num_flows  # SWND in bytes
-        self.rtts = [[] for _ in range(self.max_num_flows)]
-        self.mean_RTT = [
-            0
-        ] * self.max_num_flows  # current mean RTT of paths to calculate deviation to current RTT
+        self.subflows = SubflowSnapshot(self.max_num_flows, NUM_FIELDS)
+        # raw observations are read into this buffer instead of a new list per call
+        self._raw = np.zeros((self.max_num_flows, NUM_FIELDS), dtype=np.uint32)
+        # the k + 1 observations of reset are taken with a single call
+        self._samples = np.zeros(
+            (self.k + 1, mpsched.NUM_SUBFLOWS, NUM_FIELDS), dtype=np.uint32
+        )
+        self._sample_times = np.zeros(self.k + 1)
+        self._sample_counts = np.zeros(self.k + 1, dtype=np.int32)
+        # ring buffer of a background sampler of the connection, replaces reading the subflows in step
+        self.telemetry = None
+        # subflow set in the kernel scheduler
+        self.segments = np.zeros(self.max_num_flows, dtype=np.int32)
+        # state and network condition of all paths are preallocated once, the per characteristic
+        # attributes are views into them
+        self._state = np.zeros(4 * self.max_num_flows)
+        self._cond = np.zeros(2 * self.max_num_flows)
+        (
+            self.rtt,  # snapshot of rtt
+            self.cwnd,  # cwnd
+            self.rr,  # number of packets in flight
+            self.send_wnd,  # SWND in bytes
+        ) = np.split(self._state, 4)
+        (
+            self.packet_loss,  # packet loss in percent compared to segs_out(tp)
+            self.mean_RTT,  # current mean RTT of paths to calculate deviation to current RTT
+        ) = np.split(self._cond, 2)
+        self.tp = np.zeros(
+            self.max_num_flows
+        )  # number of segs sent(Max number of subflows)
+        self.in_flight = np.zeros(
+            self.max_num_flows
+        )  # number of total retransmission (packets_lost)
+        self.rtts = RunningMean(self.max_num_flows)
+        self.states = RingWindow(len(self._state), self.k)  # last k states
         self.path_mask = [
             0
         ] * self.max_num_flows  # path mask for ordering from user space to kernel space
 
-    def adjust(self, state):
-        for m in range(self.max_num_flows):
-            # adjust initial values to represent worst case for each characteristic (e.g RTT->inf) s.t path is unfavorable for decision
-            self.tp[m] = 0
-            self.rtt[m] = 0
-            self.cwnd[m] = 0
-            self.rr[m] = 0
-            self.in_flight[m] = 0
-            self.packet_loss[m] = 0
-            self.send_wnd[m] = 0
-        for i in range(len(state)):
-            if len(self.last) < (len(state)):
-                self.last.append([0, 0, 0, 0, 0, 0])
-            if state[i][5] == 16842762:  # 2785061056 ,16842762
-                self.path_mask[0] = i
-                k = 0
-            elif state[i][5] == 33685514:  # 3892357312 ,33685514
-                self.path_mask[1] = i
-                k = 1
-            elif state[i][5] == 50528266:  # 2868947136,50528266
-                self.path_mask[2] = i
-                k = 2
-            else:  # if not intf 1 or intf 2 skip
-                continue
-            self.tp[k] = (
-                np.abs(state[i][0] - self.last[i][0]) * 1440
-            )  # 1440 is MSS taken from kernel information sudo dmesg
-            self.rtt[k] = state[i][1] / 1000
-            if self.rtt[k] != 0:
-                self.rtts[k].append(self.rtt[k])
-            else:
-                self.rtts[k].append(self.mean_RTT[k])
-            self.mean_RTT[k] = statistics.fmean(self.rtts[k])
-
-            self.cwnd[k] = state[i][2] / self.rtt[k]
-            self.rr[k] = np.abs(state[i][3] - self.last[i][3]) / self.rtt[k]
-            self.in_flight[k] = np.abs(state[i][4] - self.last[i][4])
-            self.send_wnd[k] = state[i][6] / (self.rtt[k] * 1000)
-            if self.tp[k] != 0:
-                self.packet_loss[k] = (self.in_flight[k] / self.tp[k]) * 100
-            else:
-                self.packet_loss[k] = 0
-            # print(state[i][5])
-        self.last = state
-        return (
-            list(np.concatenate((self.rtt, self.cwnd, self.rr, self.send_wnd))),
-            list(np.concatenate((self.packet_loss, self.mean_RTT))),
+    def map_paths(self):
+        """Assigns the reported subflows to paths by their destination address, subflows of unknown interfaces are skipped
+
+        :return: rows of the reported subflows and the paths they belong to
+        :rtype: numpy.ndarray, numpy.ndarray
+        """
+        rows = []
+        paths = []
+        for i in range(self.subflows.num_active):
+            addr = self.subflows.current[i, DST_ADDR]
+            if addr in PATH_ADDRS[: self.max_num_flows]:
+                k = PATH_ADDRS.index(addr)
+                self.path_mask[k] = i
+                rows.append(i)
+                paths.append(k)
+        return np.array(rows, dtype=np.intp), np.array(paths, dtype=np.intp)
+
+    def measure(self, subs):
+        """Loads a raw observation and calculates throughput, state variables and packet loss of all paths
+
+        :param subs: Raw observations from socket api with mpsched extension
+        :type subs: list
+        :return: paths that were measured
+        :rtype: numpy.ndarray
+        """
+        self.subflows.load(subs)
+        self.clock.update(self.subflows.current[: self.subflows.num_active, RTT] / 1e6)
+        rows, paths = self.map_paths()
+        current = self.subflows.current[rows]
+        rtt = current[:, RTT] / 1000
+        tp = self.subflows.delta(SEGS_OUT)[rows] * 1440
+        in_flight = self.subflows.delta(TOTAL_RETRANS)[rows]
+
+        for values in (self.tp, self.rtt, self.cwnd, self.rr, self.in_flight):
+            values[:] = 0
+        self.tp[paths] = tp
+        self.rtt[paths] = rtt
+        self.in_flight[paths] = in_flight
+        self.cwnd[paths] = current[:, CWND] / rtt
+        self.rr[paths] = self.subflows.delta(UNACKED)[rows] / rtt
+        self.send_wnd[paths] = current[:, SND_WND] / (rtt * 1000)
+        self.packet_loss[paths] = np.where(
+            tp != 0, in_flight / np.where(tp != 0, tp, 1) * 100, 0
         )
+        return paths
+
+    def adjust(self, state):
+        """Converts the raw observations collected with mpsched socket api into appropriate values for state information and reward
+        calculation
+
+        :param state: Raw observations from socket api with mpsched extension
+        :type state: list
+        :return: All values for state infomration from socket api measurments as well as current network condition.
+            Both are views into preallocated buffers, the state stays valid for k - 1 further steps, the network
+            condition until the next step
+        :type: numpy.ndarray, numpy.ndarray
+        """
+        paths = self.measure(state)
+        measured = np.zeros(self.max_num_flows, dtype=bool)
+        measured[paths] = True
+        # a path without rtt measurement keeps its mean
+        self.rtts.update(np.where(self.rtt != 0, self.rtt, self.rtts.mean), measured)
+        self.mean_RTT[:] = self.rtts.mean
+        self.states.push(self._state)
+        return self.states.latest(), self._cond
 
     def reward(self):
         """Calculates the reward of FALCON which is the Throughput of all subflows since the last measurment
@@ -105,13 +148,11 @@ class Env:
         :return: Reward value
         :type: float
         """
-        rewards = sum(np.array(self.tp))
+        rewards = np.sum(self.tp)
         if rewards != 0:
-            rewards = rewards - (1 / rewards) * self.alpha * sum(
-                np.array(self.rtt) * (np.array(self.tp))
-            )
-            rewards = rewards - self.b * (1 / sum(np.array(self.tp))) * sum(
-                np.array(self.rr) * (np.array(self.tp))
+            rewards = rewards - (1 / rewards) * self.alpha * np.sum(self.rtt * self.tp)
+            rewards = rewards - self.b * (1 / np.sum(self.tp)) * np.sum(
+                self.rr * self.tp
             )
         else:
             rewards = 0
@@ -122,49 +163,49 @@ class Env:
         """Initialization of the Environment variables with the last of k measurments where k is a user defined parameter
 
         :return: State parameters
+        :rtype: numpy.ndarray
+        """
+        self.clock.reset()
+        observations = self.sample(0)
+        self.subflows.load(observations[0])
+        self.rtts.reset()
+        self.mean_RTT[:] = 0
+        for subs in observations[1:]:
+            self.measure(subs)
+            self.states.push(self._state)
+        self.clock.start()
+        return self.states.latest()
+
+    def sub_info(self):
+        """Raw observation of all subflows with the socket api of the mpsched extension, the newest snapshot of the
+        background sampler if there is one
+
+        :return: one row per reported subflow, a view into a preallocated buffer that stays valid until the next call
+        :rtype: numpy.ndarray
+        """
+        if self.telemetry is not None:
+            subs = self.telemetry.latest(self._raw)
+            if subs is not None:
+                return subs
+        return self._raw[: mpsched.get_sub_info_into(self.fd, self._raw)]
+
+    def sample(self, interval):
+        """k + 1 raw observations of all subflows interval seconds apart, taken with a single call of the mpsched
+        extension that does not hold the GIL while it waits
+
+        :param interval: seconds between two observations
+        :type interval: float
+        :return: reported subflows of every observation, views into a preallocated buffer that stay valid until the next
+            call
         :rtype: list
         """
-        self.last = mpsched.get_sub_info(self.fd)
-        self.rtts = [[] for _ in range(self.max_num_flows)]
-        self.mean_RTT = [0] * self.max_num_flows
-        for i in range(self.k):
-            subs = mpsched.get_sub_info(self.fd)
-            for m in range(self.max_num_flows):
-                self.tp[m] = 0
-                self.rtt[m] = 0
-                self.cwnd[m] = 0
-                self.rr[m] = 0
-                self.in_flight[m] = 0
-                self.packet_loss[m] = 0
-                self.send_wnd[m] = 0
-            for j in range(len(subs)):
-                if len(self.last) < (len(subs)):
-                    self.last.append([0, 0, 0, 0, 0, 0])
-                if subs[j][5] == 16842762:  # 2785061056 ,16842762
-                    self.path_mask[0] = j
-                    k = 0
-                elif subs[j][5] == 33685514:  # 3892357312 ,33685514
-                    self.path_mask[1] = j
-                    k = 1
-                elif subs[j][5] == 50528266:  # 2868947136,50528266
-                    self.path_mask[2] = j
-                    k = 2
-                else:
-                    continue
-                self.tp[k] = (np.abs(subs[j][0] - self.last[j][0])) * 1440
-                self.rtt[k] = subs[j][1] / 1000
-                self.cwnd[k] = subs[j][2] / self.rtt[k]
-                self.rr[k] = np.abs(subs[j][3] - self.last[j][3]) / self.rtt[k]
-                self.in_flight[k] = np.abs(subs[j][4] - self.last[j][4])
-                self.send_wnd[k] = subs[j][6] / (self.rtt[k] * 1000)
-                if self.tp[k] != 0:
-                    self.packet_loss[k] = (self.in_flight[k] / self.tp[k]) * 100
-                else:
-                    self.packet_loss[k] = 0
-                # print(subs[j][5])
-            self.last = subs
-
-        return list(np.concatenate((self.rtt, self.cwnd, self.rr, self.send_wnd)))
+        mpsched.sample_sub_info(
+            self.fd, interval, self._samples, self._sample_times, self._sample_counts
+        )
+        return [
+            samples[:count]
+            for samples, count in zip(self._samples, self._sample_counts)
+        ]
 
     def update_fd(self, fd):
         self.fd = fd
@@ -174,27 +215,26 @@ class Env:
         Actions include among other things:
         -setting the desired subflow in the kernel scheduler using socket api with mpsched extension
         -calculated the reward of the action using reward method
+        -wait on the decision clock until the begin of the next state
         -take measurement of the new path characteristics after taking action using socket api with mpsched extension
         -adjust the current environment variables using adjust method
 
         :param action: output of the DQN with position of desired subflow set to one
         :type action: list
         :return: state observation of the next state t+1,reward value, flag to signal end and current network conditions
-        :rtype: list,float,boolean,list
+        :rtype: numpy.ndarray,float,boolean,numpy.ndarray
         """
-        active = [int(0)] * self.max_num_flows
-        active[self.path_mask[action]] = int(1)
-        A = [self.fd]
-
-        A = list(np.concatenate((A, active)))
+        self.segments[:] = 0
+        self.segments[self.path_mask[action]] = 1
 
-        # print(active)
-        mpsched.set_seg(A)
+        # print(self.segments)
+        mpsched.set_seg_array(self.fd, self.segments)
 
-        state_nxt = mpsched.get_sub_info(self.fd)
+        self.clock.wait()
+        state_nxt = self.sub_info()
         # print(state_nxt)
         done = False
-        if not state_nxt:
+        if len(state_nxt) == 0:
             done = True
 
         state_nxt, cond = self.adjust(state_nxt)
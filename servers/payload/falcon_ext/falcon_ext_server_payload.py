@@ -18,15 +18,15 @@ import threading
 import time
 from configparser import ConfigParser
 from datetime import datetime
-from threading import Event
 from urllib.parse import parse_qs, urlparse
 
-import falcon_ext_mpsched as mpsched
+import mpsched_backend as mpsched
 import numpy as np
 import torch
 from agent import Offline_Agent, Online_Agent
-from DQN import DQN_Agent
 from gym import spaces
+from jit_warmup import warmup
+from model_bank import open_bank
 from replay_memory import ReplayMemory
 
 CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
@@ -147,13 +147,14 @@ def main():
     IP = args.ip
     PORT = args.port
     MEMORY_FILE = str((TMP_DIR / cfg.get("replaymemory", "memory")).resolve())
-    AGENT_FILE = str((TMP_DIR / cfg.get("dqn", "agent")).resolve()) + "/"
+    AGENT_FILE = str((TMP_DIR / cfg.get("dqn", "agent")).resolve())
     INTERVAL = cfg.getint("train", "interval")
     EPISODE = cfg.getint("train", "episode")
     BATCH_SIZE = cfg.getint("train", "batch_size")
     MAX_NUM_FLOWS = cfg.getint("train", "max_num_flows")
     K = cfg.getint("dqn", "k")
-    transfer_event = Event()
+    # shared with the offline agent, which throttles its training while a transfer is in flight
+    transfer_event = multiprocessing.Event()
     NUM_CHAR = cfg.getint("train", "num_characteristics")
     NUM_RANGES = cfg.getint("train", "num_ranges")
     CONTINUE_TRAIN = args.continue_train
@@ -161,35 +162,40 @@ def main():
     now = datetime.now().replace(microsecond=0)
     start_train = now.strftime("%Y-%m-%d %H:%M:%S")
 
-    path_char = list(itertools.product(list(range(0, NUM_RANGES)), repeat=NUM_CHAR))
-    ALL_CHAR = np.array(
-        list(map(list, (itertools.product(path_char, repeat=MAX_NUM_FLOWS))))
-    ).reshape((-1, MAX_NUM_FLOWS * NUM_CHAR))
+    # meta models pickled per partition by earlier versions are converted once
+    legacy = pathlib.Path(AGENT_FILE).with_suffix("")
+    if not os.path.exists(AGENT_FILE) and legacy.is_dir():
+        bank = open_bank(cfg, TMP_DIR)
+        for index in bank.indices():
+            pickled = legacy / f"{index}.pkl"
+            if pickled.exists():
+                bank.save(index, torch.load(pickled))
+        os.makedirs(TMP_DIR / "trained_models", exist_ok=True)
+        shutil.move(
+            str(legacy), str(TMP_DIR / f"trained_models/meta_models_{start_train}")
+        )
+        print(f"Converted {legacy} into {AGENT_FILE}")
 
-    agent_name = []
     if CONTINUE_TRAIN != 1 and os.path.exists(AGENT_FILE):
         try:
             os.remove(MEMORY_FILE)
         except FileNotFoundError:
             print("MEMORY file does not exist yet")
-        os.makedirs("trained_models/", exist_ok=True)
+        os.makedirs(TMP_DIR / "trained_models", exist_ok=True)
         shutil.move(
-            AGENT_FILE, str(TMP_DIR / f"trained_models/meta_models_{start_train}")
+            AGENT_FILE,
+            str(TMP_DIR / f"trained_models/meta_models_{start_train}.npy"),
         )
 
-    os.makedirs(AGENT_FILE, exist_ok=True)
-    for i in range(len(ALL_CHAR)):
-        index = "".join(str(x) for x in ALL_CHAR[i])
-        agent_name.append(AGENT_FILE + index + ".pkl")
-        if not os.path.exists(agent_name[i]) or CONTINUE_TRAIN != 1:
-            agent = DQN_Agent(
-                hidden_size=3,
-                num_inputs=4 * MAX_NUM_FLOWS,
-                num_outputs=MAX_NUM_FLOWS,
-                gamma=cfg.getfloat("dqn", "gamma"),
-            )
-            torch.save(agent, agent_name[i])
+    # meta models of partitions that were never trained are only created when they are first used
+    open_bank(cfg, TMP_DIR)
+    # compile the numba kernels before the first transfer
+    for kernel, seconds in warmup(cfg).items():
+        print(f"Compiled {kernel} in {seconds:.2f}s")
 
+    # always in the server process: the process mode of the FALCON payload hands connections to its inference engine
+    # for many connections, this payload still has a single online agent that follows the socket and the file size of
+    # the latest request
     online_process = Online_Agent(fd=0, cfg=cfg, event=transfer_event)
     online_process.daemon = True
     online_process.start()
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+# Compiles the numba kernels of the payload before the first transfer
+
+import argparse
+import pathlib
+import time
+from configparser import ConfigParser
+
+import numba_compat
+import numpy as np
+from bayes_online import BayesOnline, t_pdf
+from changepoint import create_detector
+
+CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
+
+
+def warmup(cfg, full=False):
+    """Call the numba kernels once with the types the agents use, so that the first transfer does not compile them
+
+    numba compiles a kernel on its first call, which is the first update of the changepoint detectors in the middle
+    of the first transfer. Kernels that are cached on disk are only compiled by the first warmup after installing,
+    later warmups load them from __pycache__. Kernels that take jitclass instances (BayesOnline) are compiled again
+    in every process.
+
+    :param cfg: contains all the neccessary parameters read from config.ini
+    :type cfg: configParser
+    :param full: also compile the kernels the agents do not use, i.e. those of BayesOnline and numba_compat
+    :type full: bool
+    :return: seconds spent per kernel
+    :rtype: dict
+    """
+    if not numba_compat.numba_available:
+        return {}
+    timings = {}
+    rng = np.random.default_rng(0)
+
+    # same detector as the one of every connection, one stream per characteristic and subflow
+    start = time.perf_counter()
+    det = create_detector(
+        cfg,
+        cfg.getint("train", "num_characteristics")
+        * cfg.getint("train", "max_num_flows"),
+    )
+    for x in rng.random((2, det.num_streams)):
+        det.update(x)
+    det.reset()
+    timings["detector"] = time.perf_counter() - start
+
+    if full:
+        start = time.perf_counter()
+        t_pdf(0.5, 2.0, 0.0, 1.0)
+        numba_compat.logsumexp(rng.random(4))
+        numba_compat.multigammaln(1.5, 2)
+        timings["numba_compat"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        detector = BayesOnline()
+        detector.update(0.5)
+        detector.find_changepoints(rng.random(8))
+        timings["bayes_online"] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compile the numba kernels of the payload and fill the cache in __pycache__"
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Also compile the kernels the agents do not use",
+    )
+    args = parser.parse_args()
+
+    cfg = ConfigParser()
+    cfg.read(CURRENT_DIR / "config.ini")
+    if not numba_compat.numba_available:
+        print("numba is not installed, nothing to compile")
+        return
+    for kernel, seconds in warmup(cfg, full=args.all).items():
+        print(f"{kernel:<14} {seconds * 1e3:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,26 +3,246 @@ import random
 import threading
 from collections import namedtuple
 
+import numpy as np
+import torch
+
 Transition = namedtuple(
     "Transition", ("state", "action", "mask", "next_state", "reward")
 )
 
+# replaymemory implementation copied from github.com/gaogogo/Experiment
+
+
+class SumTree(object):
+    """Binary tree over the priorities of the transitions of a replay memory in which every node holds the sum of its
+    two children, for proportional sampling in O(log n). Node 1 is the root, the leaves start at num_leaves.
+
+    :param capacity: number of priorities
+    :type capacity: int
+    """
 
-class ReplayMemory(object):
     def __init__(self, capacity):
+        self.num_leaves = 1 << max(capacity - 1, 0).bit_length()
+        self.nodes = np.zeros(2 * self.num_leaves)
+        self.max_priority = 1.0  # priority of new transitions
+
+    @property
+    def total(self):
+        return self.nodes[1]
+
+    def leaves(self, indices):
+        return self.nodes[np.asarray(indices) + self.num_leaves]
+
+    def set(self, index, priority):
+        """Change a single priority"""
+        node = index + self.num_leaves
+        nodes = self.nodes
+        nodes[node] = priority
+        node //= 2
+        while node:
+            nodes[node] = nodes[2 * node] + nodes[2 * node + 1]
+            node //= 2
+
+    def update(self, indices, priorities):
+        """Change the priorities of a batch of indices"""
+        node = np.asarray(indices, dtype=np.int64) + self.num_leaves
+        self.nodes[node] = priorities
+        while node[0] > 1:  # all leaves have the same depth
+            node //= 2
+            self.nodes[node] = self.nodes[2 * node] + self.nodes[2 * node + 1]
+
+    def find(self, values):
+        """Indices of the leaves in which the prefix sums of the priorities reach values
+
+        :param values: prefix sums in [0, total)
+        :type values: numpy.ndarray
+        :rtype: numpy.ndarray
+        """
+        values = np.array(values, dtype=np.float64)
+        node = np.ones(len(values), dtype=np.int64)
+        while node[0] < self.num_leaves:
+            left = 2 * node
+            left_sum = self.nodes[left]
+            # never descend into an empty subtree, rounding may push values past the last priority
+            right = (values > left_sum) & (self.nodes[left + 1] > 0)
+            values -= np.where(right, left_sum, 0)
+            node = left + right
+        return node - self.num_leaves
+
+    def grow(self, capacity):
+        """Make room for capacity priorities, keeping the existing ones"""
+        if capacity <= self.num_leaves:
+            return
+        leaves = self.nodes[self.num_leaves :]
+        self.num_leaves = 1 << (capacity - 1).bit_length()
+        self.nodes = np.zeros(2 * self.num_leaves)
+        self.nodes[self.num_leaves : self.num_leaves + len(leaves)] = leaves
+        level = self.num_leaves // 2
+        while level:
+            self.nodes[level : 2 * level] = (
+                self.nodes[2 * level : 4 * level : 2]
+                + self.nodes[2 * level + 1 : 4 * level : 2]
+            )
+            level //= 2
+
+
+def anneal_beta(beta, step, beta_steps):
+    """Importance sampling exponent of prioritized replay, annealed linearly from beta to 1 over beta_steps
+
+    :rtype: float
+    """
+    if beta_steps <= 0:
+        return 1.0
+    return min(1.0, beta + (1.0 - beta) * step / beta_steps)
+
+
+class ReplayMemory(object):
+    """Circular buffer of transitions backed by one preallocated tensor per field of Transition.
+
+    Storage is allocated on the first push, when the shapes of the fields are known, and grows geometrically up to
+    capacity so that a large capacity does not reserve memory that is never used.
+
+    :param capacity: maximum number of transitions, the oldest transitions are overwritten
+    :type capacity: int
+    :param dtype: dtype the transitions are stored in, batches are always returned as float32
+    :type dtype: torch.dtype
+    :param cat_dims: dimension of every field along which the transitions of a batch are concatenated
+    :type cat_dims: class:'Transition'
+    """
+
+    num_pushed = 0  # transitions pushed since creation, class default for memories pickled without it
+    initial_size = 1024  # transitions allocated by the first push
+    priorities = None  # class:'SumTree' of enable_priorities
+
+    def __init__(
+        self, capacity, dtype=torch.float32, cat_dims=Transition(0, 0, 0, 0, 0)
+    ):
         self.capacity = capacity
-        self.memory = []
+        self.dtype = dtype
+        self.cat_dims = Transition(*cat_dims)
+        self.fields = None
+        self.size = 0
         self.position = 0
 
+    def _allocate(self, size, fields):
+        """Move the stored transitions into new tensors of size transitions, shaped like the fields of a transition"""
+        storage = Transition(
+            *(torch.empty((size,) + tuple(f.shape), dtype=self.dtype) for f in fields)
+        )
+        if self.fields is not None:
+            for new, old in zip(storage, self.fields):
+                new[: self.size] = old[: self.size]
+        self.fields = storage
+        if self.priorities is not None:
+            self.priorities.grow(size)
+
     def push(self, *args):
-        if len(self.memory) < self.capacity:
-            self.memory.append(None)
-        self.memory[self.position] = Transition(*args)
+        if self.fields is None:
+            self._allocate(min(self.capacity, self.initial_size), args)
+        elif self.position == len(self.fields.state) < self.capacity:
+            self._allocate(min(self.capacity, 2 * self.position), args)
+        for storage, value in zip(self.fields, args):
+            storage[self.position] = torch.as_tensor(value)
+        if self.priorities is not None:
+            self.priorities.set(self.position, self.priorities.max_priority)
         self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.num_pushed += 1
 
     def sample(self, batch_size):
-        result = random.sample(self.memory, batch_size)
-        return result
+        """Draw batch_size different transitions
+
+        :return: batch with every field concatenated along its dimension in cat_dims, equal to
+            Transition(*(torch.cat(field, dim) for field in zip(*transitions)))
+        :rtype: class:'Transition'
+        """
+        return self._gather(torch.tensor(random.sample(range(self.size), batch_size)))
+
+    def _gather(self, positions):
+        return Transition(
+            *(
+                self._concatenate(storage[positions], dim)
+                for storage, dim in zip(self.fields, self.cat_dims)
+            )
+        )
+
+    def enable_priorities(self, alpha, eps=1e-3):
+        """Sample transitions proportional to their priority (|td error| + eps)^alpha instead of uniformly, see
+        sample_prioritized. Stored transitions start with the same priority.
+
+        :param alpha: how strongly priorities skew the sampling, 0 is uniform
+        :type alpha: float
+        :param eps: keeps transitions with a td error of zero from never being sampled again
+        :type eps: float
+        """
+        self.priority_alpha = alpha
+        self.priority_eps = eps
+        self.priorities = SumTree(
+            len(self.fields.state) if self.fields is not None else 1
+        )
+        if self.size:
+            self.priorities.update(np.arange(self.size), 1.0)
+
+    def sample_prioritized(self, batch_size, beta):
+        """Draw batch_size transitions proportional to their priority, one from each of batch_size equal segments of
+        the total priority
+
+        :param beta: exponent of the importance sampling weights, 1 fully compensates the non-uniform sampling
+        :type beta: float
+        :return: batch as returned by sample, positions of the transitions for update_priorities and the importance
+            sampling weights of the transitions, normalized to a maximum of 1
+        :rtype: class:'Transition', numpy.ndarray, torch.Tensor
+        """
+        tree = self.priorities
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * (
+            tree.total / batch_size
+        )
+        positions = tree.find(values)
+        weights = (self.size * tree.leaves(positions) / tree.total) ** -beta
+        weights = torch.as_tensor(weights / weights.max(), dtype=torch.float32)
+        return self._gather(torch.as_tensor(positions)), positions, weights
+
+    def update_priorities(self, positions, td_errors):
+        """Set the priorities of sampled transitions from their new td errors
+
+        :param positions: positions returned by sample_prioritized
+        :type positions: numpy.ndarray
+        :param td_errors: td error of every transition
+        :type td_errors: torch.Tensor
+        """
+        td_errors = torch.as_tensor(td_errors).detach().reshape(-1).cpu().numpy()
+        priorities = (np.abs(td_errors) + self.priority_eps) ** self.priority_alpha
+        self.priorities.update(positions, priorities)
+        self.priorities.max_priority = max(
+            self.priorities.max_priority, priorities.max()
+        )
+
+    @staticmethod
+    def _concatenate(rows, dim):
+        """Turn stacked transitions of shape (batch, *shape) into their concatenation along dim"""
+        shape = list(rows.shape[1:])
+        shape[dim] *= rows.shape[0]
+        return rows.movedim(0, dim).reshape(shape).to(torch.float32)
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("priorities", None)  # rebuilt by enable_priorities
+        if self.fields is not None:
+            # only the stored transitions, not the unused part of the allocation
+            state["fields"] = Transition(*(f[: self.size].clone() for f in self.fields))
+        return state
+
+    def __setstate__(self, state):
+        if "memory" in state:
+            # memory pickled as a list of transitions before the tensor storage
+            transitions = state["memory"]
+            self.__init__(state["capacity"])
+            for transition in (
+                transitions[state["position"] :] + transitions[: state["position"]]
+            ):
+                self.push(*transition)
+        else:
+            self.__dict__.update(state)
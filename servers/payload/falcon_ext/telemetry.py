@@ -0,0 +1,253 @@
+"""Background sampling of the subflows of a connection
+
+A sampler thread per connection reads the subflows with
+mpsched.sample_sub_info at a configurable rate into a ring buffer, so that
+sampling does not depend on the decision rate and the environment never waits
+on getsockopt. The sampler is the only writer of the ring: it fills the slots
+after the newest snapshot and then publishes them by increasing the number of
+written snapshots. Readers take no lock, they copy published snapshots and
+check that the sampler did not overwrite them meanwhile. The snapshots of a
+connection can be recorded as a binary trace, see load_trace.
+"""
+
+import json
+import struct
+import threading
+import time
+
+import mpsched_backend as mpsched
+import numpy as np
+
+# magic, number of subflows and length of the names of the values, followed by the names as json
+TRACE_MAGIC = b"MPTRACE1"
+TRACE_HEADER = struct.Struct("<8sII")
+
+
+def trace_dtype(num_subflows, num_fields):
+    """Record of one snapshot in a trace
+
+    :rtype: numpy.dtype
+    """
+    return np.dtype(
+        [
+            ("time", "<f8"),
+            ("count", "<i4"),
+            ("values", "<u4", (num_subflows, num_fields)),
+        ]
+    )
+
+
+def load_trace(path):
+    """Read a trace written by the sampler
+
+    :param path: trace file
+    :type path: str
+    :return: names of the values per subflow and the records with time, number of subflows and values of every
+        snapshot
+    :rtype: list, numpy.ndarray
+    """
+    with open(path, "rb") as f:
+        magic, num_subflows, length = TRACE_HEADER.unpack(f.read(TRACE_HEADER.size))
+        if magic != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a subflow trace")
+        fields = json.loads(f.read(length))
+        records = np.fromfile(f, dtype=trace_dtype(num_subflows, len(fields)))
+    return fields, records
+
+
+def create_telemetry(cfg, directory):
+    """Telemetry of an online agent with the parameters of the [telemetry] section of config.ini
+
+    :param cfg: contains all the neccessary parameters read from config.ini
+    :type cfg: configParser
+    :param directory: directory the trace directory of the config is relative to
+    :type directory: pathlib.Path
+    :return: None if telemetry is disabled
+    :rtype: class:'Telemetry'
+    """
+    if not cfg.getboolean("telemetry", "enabled"):
+        return None
+    traces = cfg.get("telemetry", "traces")
+    return Telemetry(
+        capacity=cfg.getint("telemetry", "capacity"),
+        interval=1 / cfg.getfloat("telemetry", "rate"),
+        chunk=cfg.getint("telemetry", "chunk"),
+        trace_dir=directory / traces if traces else None,
+    )
+
+
+class TelemetryRing:
+    """Newest snapshots of the subflows of a connection, written by a single sampler
+
+    :param capacity: number of snapshots kept
+    :type capacity: int
+    :param chunk: maximum number of snapshots the sampler writes before publishing them, these slots are never read
+    :type chunk: int
+    """
+
+    def __init__(self, capacity, chunk):
+        if not 0 < chunk < capacity:
+            raise ValueError("chunk must be smaller than the capacity of the ring")
+        self.capacity = capacity
+        self.chunk = chunk
+        self.samples = np.zeros(
+            (capacity, mpsched.NUM_SUBFLOWS, len(mpsched.FIELDS)), dtype=np.uint32
+        )
+        self.times = np.zeros(capacity)
+        self.counts = np.zeros(capacity, dtype=np.int32)
+        self.written = 0  # number of published snapshots
+
+    def reset(self):
+        self.written = 0
+
+    def _overwritten(self, oldest):
+        # the sampler may be writing up to chunk slots after the newest published snapshot
+        return self.written + self.chunk - oldest > self.capacity
+
+    def latest(self, out):
+        """Copy the newest snapshot into out without waiting for the sampler
+
+        :param out: array with one row per subflow
+        :type out: numpy.ndarray
+        :return: rows of the reported subflows in out, None if nothing was sampled yet
+        :rtype: numpy.ndarray
+        """
+        while True:
+            written = self.written
+            if written == 0:
+                return None
+            i = (written - 1) % self.capacity
+            count = min(int(self.counts[i]), len(out))
+            out[:count] = self.samples[i, :count, : out.shape[1]]
+            if not self._overwritten(written - 1):
+                return out[:count]
+
+    def window(self, n):
+        """Copy of the newest n snapshots, oldest first
+
+        :param n: number of snapshots, at most capacity - chunk
+        :type n: int
+        :return: times, number of reported subflows and values of the snapshots
+        :rtype: numpy.ndarray, numpy.ndarray, numpy.ndarray
+        """
+        n = min(n, self.capacity - self.chunk)
+        while True:
+            written = self.written
+            index = np.arange(max(written - n, 0), written) % self.capacity
+            window = self.times[index], self.counts[index], self.samples[index]
+            if not self._overwritten(written - len(index)):
+                return window
+
+
+class TelemetrySampler(threading.Thread):
+    """Thread that samples the subflows of a connection until it is stopped or the connection is closed
+
+    :param fd: socket file descriptor
+    :type fd: int
+    :param ring: ring buffer the snapshots are written to
+    :type ring: class:'TelemetryRing'
+    :param interval: seconds between two snapshots
+    :type interval: float
+    :param trace: binary file every snapshot is appended to, no trace if None
+    :type trace: file
+    """
+
+    def __init__(self, fd, ring, interval, trace=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.fd = fd
+        self.ring = ring
+        self.interval = interval
+        self.trace = trace
+        self.stopped = threading.Event()
+        if trace is not None:
+            fields = json.dumps(mpsched.FIELDS).encode()
+            trace.write(
+                TRACE_HEADER.pack(TRACE_MAGIC, mpsched.NUM_SUBFLOWS, len(fields))
+            )
+            trace.write(fields)
+            self._records = np.zeros(
+                ring.chunk, dtype=trace_dtype(mpsched.NUM_SUBFLOWS, len(mpsched.FIELDS))
+            )
+
+    def run(self):
+        ring = self.ring
+        deadline = time.monotonic()
+        while not self.stopped.is_set():
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            i = ring.written % ring.capacity
+            end = min(i + ring.chunk, ring.capacity)
+            # waits between the snapshots of a chunk happen in the extension without the GIL
+            taken = mpsched.sample_sub_info(
+                self.fd,
+                self.interval,
+                ring.samples[i:end],
+                ring.times[i:end],
+                ring.counts[i:end],
+            )
+            ring.written += taken
+            if self.trace is not None:
+                self.record(i, taken)
+            if ring.counts[i + taken - 1] == 0:
+                # connection closed
+                break
+            deadline = ring.times[i + taken - 1] + self.interval
+
+    def record(self, i, n):
+        records = self._records[:n]
+        records["time"] = self.ring.times[i : i + n]
+        records["count"] = self.ring.counts[i : i + n]
+        records["values"] = self.ring.samples[i : i + n]
+        records.tofile(self.trace)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        if self.trace is not None:
+            self.trace.close()
+
+
+class Telemetry:
+    """Sampler of the connections of an online agent, one connection at a time. The ring buffer is allocated once and
+    reused for every connection.
+
+    :param capacity: number of snapshots kept in the ring buffer
+    :type capacity: int
+    :param interval: seconds between two snapshots
+    :type interval: float
+    :param chunk: snapshots taken per call of the extension, the newest snapshot is published after a whole chunk
+    :type chunk: int
+    :param trace_dir: directory for a binary trace per connection, no traces if None
+    :type trace_dir: pathlib.Path
+    """
+
+    def __init__(self, capacity, interval, chunk, trace_dir=None):
+        self.ring = TelemetryRing(capacity, chunk)
+        self.interval = interval
+        self.trace_dir = trace_dir
+        self.sampler = None
+
+    def start(self, fd):
+        """Start sampling a new connection, the sampler of the last one is stopped
+
+        :param fd: socket file descriptor
+        :type fd: int
+        :return: ring buffer of the connection
+        :rtype: class:'TelemetryRing'
+        """
+        self.stop()
+        self.ring.reset()
+        trace = None
+        if self.trace_dir is not None:
+            self.trace_dir.mkdir(parents=True, exist_ok=True)
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{fd}.trace"
+            trace = open(self.trace_dir / name, "wb")
+        self.sampler = TelemetrySampler(fd, self.ring, self.interval, trace)
+        self.sampler.start()
+        return self.ring
+
+    def stop(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
@@ -0,0 +1,137 @@
+"""Throttling of the meta training while transfers are in flight
+
+The offline agent trains the meta models in a process of its own and would
+compete with the threads sending the files for the CPU during the
+measurements. The transfer event is a multiprocessing.Event shared with that
+process, set while a connection is active. Before every training step the
+offline agent calls TrainingThrottle.step, which applies the configured policy
+when a transfer starts and lifts it once the transfers are over:
+
+- pause: no training while a transfer is in flight
+- affinity: train on at most `cores` cores, with as many torch threads
+- nice: train with the niceness `nice`
+- none: train as if there were no transfers
+
+Affinity and niceness are per thread on Linux, they are applied to every
+thread of the process, including the ones torch already started.
+"""
+
+import os
+import time
+
+import torch
+
+POLICIES = ("none", "pause", "affinity", "nice")
+
+
+def create_throttle(cfg, event):
+    """Throttle configured in the [throttle] section of config.ini
+
+    :param cfg: contains all the neccessary parameters read from config.ini
+    :type cfg: configParser
+    :param event: set while a transfer is in flight
+    :type event: class:'multiprocessing.Event'
+    :rtype: class:'TrainingThrottle'
+    """
+    section = "throttle"
+    return TrainingThrottle(
+        event,
+        policy=cfg.get(section, "policy"),
+        cores=cfg.getint(section, "cores"),
+        nice=cfg.getint(section, "nice"),
+        poll=cfg.getfloat(section, "poll"),
+    )
+
+
+def _thread_ids():
+    """Ids of all threads of the process"""
+    try:
+        return [int(tid) for tid in os.listdir("/proc/self/task")]
+    except OSError:
+        return [0]
+
+
+class TrainingThrottle:
+    """Applies a policy to the training of the calling process while a transfer is in flight
+
+    :param event: set while a transfer is in flight
+    :type event: class:'multiprocessing.Event'
+    :param policy: one of POLICIES
+    :type policy: str
+    :param cores: cores used for training while throttled by affinity
+    :type cores: int
+    :param nice: niceness while throttled by nice
+    :type nice: int
+    :param poll: seconds between two checks whether the transfers are over while paused
+    :type poll: float
+    """
+
+    def __init__(self, event, policy="pause", cores=1, nice=19, poll=0.05):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown throttle policy {policy}")
+        self.event = event
+        self.policy = policy
+        self.cores = cores
+        self.nice = nice
+        self.poll = poll
+        self.throttled = False
+        self.paused = 0.0  # seconds spent paused
+        self._affinity = None
+        self._num_threads = None
+        self._priority = None
+
+    def step(self):
+        """Apply or lift the policy depending on whether a transfer is in flight, blocks while the policy pauses"""
+        active = self.event.is_set()
+        if self.policy == "pause":
+            if active:
+                start = time.monotonic()
+                while self.event.is_set():
+                    time.sleep(self.poll)
+                self.paused += time.monotonic() - start
+            return
+        if active == self.throttled or self.policy == "none":
+            return
+        if active:
+            self.throttle()
+        else:
+            self.release()
+
+    def throttle(self):
+        if self.policy == "affinity":
+            self._affinity = os.sched_getaffinity(0)
+            self._num_threads = torch.get_num_threads()
+            cores = sorted(self._affinity)[-self.cores :]
+            torch.set_num_threads(len(cores))
+            self._set_all(os.sched_setaffinity, cores)
+        elif self.policy == "nice":
+            self._priority = os.getpriority(os.PRIO_PROCESS, 0)
+            self._set_all(
+                lambda tid, nice: os.setpriority(os.PRIO_PROCESS, tid, nice),
+                self.nice,
+            )
+        self.throttled = True
+
+    def release(self):
+        try:
+            if self.policy == "affinity":
+                self._set_all(os.sched_setaffinity, self._affinity)
+                torch.set_num_threads(self._num_threads)
+            elif self.policy == "nice":
+                self._set_all(
+                    lambda tid, nice: os.setpriority(os.PRIO_PROCESS, tid, nice),
+                    self._priority,
+                )
+        except PermissionError:
+            # lowering the niceness again needs CAP_SYS_NICE, train on with the lower priority
+            print("Could not lift the training throttle, policy set to none")
+            self.policy = "none"
+        self.throttled = False
+
+    @staticmethod
+    def _set_all(setter, value):
+        for tid in _thread_ids():
+            try:
+                setter(tid, value)
+            except ProcessLookupError:
+                pass  # thread ended meanwhile
@@ -1,96 +1,275 @@
+import copy
 import os
 import pathlib
+import queue
 import threading
 import time
 
+import mpsched_backend as mpsched
 import numpy as np
-import reles_mpsched as mpsched
 import torch
+from action_cache import create_action_cache
+from checkpoint import load_agent, save_agent
+from decision_clock import create_clock
 from env import Env
 
 # from env import Env
 from naf_lstm import NAF_LSTM
 from ounoise import OUNoise
-from replay_memory import ReplayMemory, Transition
+from replay_memory import ReplayMemory, Transition, anneal_beta
+from telemetry import create_telemetry
 from torch.autograd import Variable
-from util import locked_open
 
 CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
 TMP_DIR = CURRENT_DIR / "artifacts"
 
 
+def set_torch_threads(num_threads):
+    """Set the torch intra-op threads of the calling process. The setting is process wide, every thread of the
+    process reads back the value set last, so it is set once per process and not per online or offline agent
+
+    :param num_threads: torch intra-op threads, torch default if 0
+    :type num_threads: int
+    """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+
+def inference_cores(cfg):
+    """Cores the online agents are pinned to, see the [inference] section of config.ini
+
+    :return: cores, empty for all cores
+    :rtype: list
+    """
+    return [int(core) for core in cfg.get("inference", "cores").split(",") if core]
+
+
+def pin_thread(cores):
+    """Pin the calling thread to cores, so that the decisions do not compete with the threads sending the data.
+    Affinity is per thread on Linux, the rest of the process is not pinned
+
+    :param cores: cores the thread runs on, all if empty
+    :type cores: list
+    """
+    if cores:
+        os.sched_setaffinity(0, cores)
+
+
+class SharedModel(object):
+    """ReLeS NN used by all online agents. Loaded once from the checkpoint of the offline agent and replaced by a copy of
+    the offline agent's model every time it finishes training, instead of every online agent loading the checkpoint.
+
+    :param path: checkpoint file of the ReLeS NN
+    :type path: str
+    :param state_shape: shape of a state, used to build the caches of the model before the first connection
+    :type state_shape: tuple
+    :param inference: model the online agents decide with, int8 or float for an InferencePolicy copy (see
+        NAF_LSTM.prepare_inference), training for the model itself
+    :type inference: str
+    """
+
+    def __init__(self, path, state_shape, inference="training"):
+        self.path = path
+        self.state_shape = state_shape
+        self.inference = inference
+        self.reload()
+
+    def reload(self):
+        """Publish the model saved in the checkpoint"""
+        self.publish(load_agent(self.path), copy_model=False)
+
+    def publish(self, agent, copy_model=True):
+        """Make agent the model of all connections started from now on, connections in progress keep their model
+
+        :param agent: ReLeS NN
+        :type agent: class:'NAF_LSTM'
+        :param copy_model: publish a copy that further training does not change
+        :type copy_model: bool
+        """
+        if copy_model:
+            agent = copy.deepcopy(agent)
+        if self.inference != "training":
+            agent.prepare_inference(quantize=self.inference == "int8")
+        agent.select_action(torch.zeros(self.state_shape))
+        self.agent = agent
+
+
+class AgentPool(object):
+    """Online agents that are started ahead of the connections they serve. A connection takes an idle agent and hands
+    it its socket, the agent returns to the pool when the connection is over. Agents are added when all are busy.
+
+    :param size: number of agents started up front
+    :type size: int
+    :param slots: slot table the agents record their decisions in, see engine_ipc
+    :type slots: class:'engine_ipc.SlotTable'
+    """
+
+    def __init__(self, size, cfg, memory, event, model, explore=True, slots=None):
+        self.cfg = cfg
+        self.memory = memory
+        self.event = event
+        self.model = model
+        self.explore = explore
+        self.slots = slots
+        self.idle = queue.LifoQueue()
+        for __ in range(size):
+            self.idle.put(self.create())
+
+    def create(self):
+        agent = Online_Agent(
+            cfg=self.cfg,
+            memory=self.memory,
+            event=self.event,
+            model=self.model,
+            pool=self,
+            explore=self.explore,
+            slots=self.slots,
+        )
+        agent.start()
+        return agent
+
+    def acquire(self):
+        """Idle online agent, a new one if all are busy
+
+        :rtype: class:'Online_Agent'
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            print("All online agents busy, starting another one")
+            return self.create()
+
+    def release(self, agent):
+        self.idle.put(agent)
+
+
 class Online_Agent(threading.Thread):
     """Class for Online Agent thread that calls evnironment step to perform agent<->enviornment interaction as expected in reinforcement
     learning. Adjusts the split factor using the policy network of the ReLes NN after every SI until the end of the MPTCP connection
-    At the start of every MPTCP connection synchronize ReLes NN (NAF+stacked LSTM) with the "offline agent" using torch.load
-    Saves collected experience in replay buffer for the offline agent to use for training
+    At the start of every MPTCP connection the agent takes the current ReLes NN (NAF+stacked LSTM) of the shared model, which is
+    kept in sync with the "offline agent". Saves collected experience in replay buffer for the offline agent to use for training.
+    The agent serves one connection after the other, see attach.
 
-    :param fd: socket file descriptor
-    :type fd: int
     :param cfg: contains all the neccessary training parameter read from config.ini
     :type cfg: configParser
     :param memory: replaymemory used for adding online experience
     :type memory: class:'ReplayMemory'
-    :param event: event to inform the online agent of finished MPTCP connection and no need to perform new interactions
+    :param event: set while a connection is transferred, the agent waits for it before the first decision. It stays
+        set as long as any connection is active, the agent ends a connection on its kill_event, see attach
     :type event: class:'threading.event'
+    :param model: ReLeS NN shared by all online agents
+    :type model: class:'SharedModel'
+    :param pool: pool the agent returns to after every connection
+    :type pool: class:'AgentPool'
     :param explore: Whether or not to use action exploration
     :explore type: boolean
+    :param slots: slot table the agent records its decisions in, see engine_ipc
+    :type slots: class:'engine_ipc.SlotTable'
     """
 
-    def __init__(self, fd, cfg, memory, event, kill_event, explore=True):
+    def __init__(self, cfg, memory, event, model, pool=None, explore=True, slots=None):
         """Constructor Method"""
-        threading.Thread.__init__(self)
-        self.fd = fd
+        threading.Thread.__init__(self, daemon=True)
         self.cfg = cfg
+        self.slots = slots
         self.memory = memory
-        self.agent_name = str((TMP_DIR / cfg.get("nafcnn", "agent")).resolve())
+        self.model = model
+        self.pool = pool
         self.ounoise = OUNoise(action_dimension=1)
         self.explore = explore
         self.max_flows = cfg.getint("env", "max_num_subflows")
-        self.kill_event = kill_event
+        self.connections = queue.Queue()
 
-        with locked_open(self.agent_name, "rb") as f:
-            self.agent = torch.load(f)
-
-        mpsched.persist_state(fd)
         self.env = Env(
-            fd=self.fd,
+            fd=None,
             time=self.cfg.getfloat("env", "time"),
             k=self.cfg.getint("env", "k"),
             alpha=self.cfg.getfloat("env", "alpha"),
             b=self.cfg.getfloat("env", "b"),
             c=self.cfg.getfloat("env", "c"),
             max_flows=self.max_flows,
+            clock=create_clock(self.cfg),
         )
+        self.telemetry = create_telemetry(cfg, TMP_DIR)
+        self.action_cache = create_action_cache(cfg)
+        self.cores = inference_cores(cfg)
         self.event = event
 
+    def attach(self, fd, kill_event, slot=None):
+        """Serve the MPTCP connection of a socket until kill_event is set
+
+        :param fd: socket file descriptor
+        :type fd: int
+        :param kill_event: event that ends the interaction with the connection
+        :type kill_event: class:'threading.event'
+        :param slot: slot of the connection in the slot table
+        :type slot: int
+        :return: event set once the agent is done with the connection
+        :rtype: class:'threading.event'
+        """
+        mpsched.persist_state(fd)
+        done = threading.Event()
+        self.connections.put((fd, kill_event, slot, done))
+        return done
+
     def run(self):
         """Override the run method from threading with the desired behaviour of the Online Agent class"""
-        if True:
-            self.event.wait()
-            state = self.env.reset()
-            # print(*(np.array(state)[self.max_flows : self.max_flows * 2, 7]))
-            state = torch.FloatTensor(state).view(-1, 1, 8, 1)
-            while not self.kill_event.is_set():
-                start = time.time()
-                if self.explore:
-                    action = self.agent.select_action(state, self.ounoise)
-                else:
-                    action = self.agent.select_action(state)
-                end = time.time()
-                # print(action)
-                # print(end - start)
-                state_nxt, reward, done = self.env.step((action))
-                # print(reward)
-                if done or not self.event.is_set():
-                    break
-                # print(*(np.array(state_nxt)[self.max_flows : self.max_flows * 2, 7]))
-                action = torch.FloatTensor(action)
-                mask = torch.Tensor([not done])
-                state_nxt = torch.FloatTensor(state_nxt).view(-1, 1, 8, 1)
-                reward = torch.FloatTensor([float(reward)])
-                self.memory.push(state, action, mask, state_nxt, reward)
-                state = state_nxt
+        pin_thread(self.cores)
+        while True:
+            fd, kill_event, slot, done = self.connections.get()
+            try:
+                self.serve(fd, kill_event, slot)
+            except Exception as e:
+                print(f"Failed in online agent run: {e}")
+            finally:
+                if self.telemetry is not None:
+                    self.telemetry.stop()
+                    self.env.telemetry = None
+                if self.pool is not None:
+                    self.pool.release(self)
+                done.set()
+
+    def serve(self, fd, kill_event, slot=None):
+        """Interaction with a single MPTCP connection"""
+        self.agent = self.model.agent
+        self.env.update_fd(fd)
+        self.ounoise.reset()
+        self.event.wait()
+        if self.telemetry is not None:
+            self.env.telemetry = self.telemetry.start(fd)
+        state = self.env.reset()
+        # print(*(np.array(state)[self.max_flows : self.max_flows * 2, 7]))
+        state = torch.as_tensor(state, dtype=torch.float32).view(-1, 1, 8, 1)
+        while not kill_event.is_set():
+            start = time.time()
+            if self.explore:
+                action = self.agent.select_action(
+                    state, self.ounoise, self.action_cache
+                )
+            else:
+                action = self.agent.select_action(state, cache=self.action_cache)
+            if slot is not None:
+                self.slots.record(slot, action.reshape(-1).numpy())
+            end = time.time()
+            # print(action)
+            # print(end - start)
+            state_nxt, reward, done = self.env.step((action))
+            # print(reward)
+            if done:
+                break
+            # print(*(np.array(state_nxt)[self.max_flows : self.max_flows * 2, 7]))
+            action = torch.FloatTensor(action)
+            mask = torch.Tensor([not done])
+            state_nxt = torch.as_tensor(state_nxt, dtype=torch.float32).view(
+                -1, 1, 8, 1
+            )
+            reward = torch.FloatTensor([float(reward)])
+            self.memory.push(state, action, mask, state_nxt, reward, producer=self.name)
+            state = state_nxt
+        print(f"decision clock: {self.env.clock.summary()}")
+        if self.action_cache is not None:
+            print(f"action cache: {self.action_cache.summary()}")
+            self.action_cache.clear()
 
     def update_fd(self, fd):
         """Update the current file descriptor used in the Environment Class for reading information from subflows with socket options"""
@@ -101,7 +280,7 @@ class Offline_Agent(threading.Thread):
     """Class for Offline Agent that is solely resposible for training the ReLes neural network on already collected
     experience saved in the replay buffer.
 
-    :param nn: path to pkl file to save updated NN parameters
+    :param nn: checkpoint file to save updated NN parameters
     :type nn: string
     :param cfg: contains all the neccessary training parameter read from config.ini
     :type cfg: configParser
@@ -109,41 +288,102 @@ class Offline_Agent(threading.Thread):
     :type memory: class:'ReplayMemory'
     :param event: event indicating start/end of episode
     :type event: class:'threading.event'
+    :param shared_model: model of the online agents, replaced with the trained model after every episode
+    :type shared_model: class:'SharedModel'
     """
 
-    def __init__(self, cfg, model, memory, event):
+    def __init__(self, cfg, model, memory, event, shared_model=None):
         """Constructor Method"""
         threading.Thread.__init__(self)
         self.memory = memory
         self.model = model
+        self.shared_model = shared_model
         # self.episode = cfg.getint("train","episode")
         self.batch_size = cfg.getint("train", "batch_size")
         self.event = event
         max_flows = cfg.getint("env", "max_num_subflows")
+        self.utd_ratio = cfg.getfloat("train", "utd_ratio")
+        self.burst = cfg.getint("train", "burst")
+        self.log_interval = cfg.getfloat("train", "log_interval")
+        self.poll = cfg.getfloat("env", "time")
+        # prioritized replay, enabled on the memory by the server for priority_alpha > 0
+        self.priority_beta = cfg.getfloat("replaymemory", "priority_beta")
+        self.beta_steps = cfg.getint("replaymemory", "beta_steps")
+
+    def pending_updates(self, new_transitions):
+        """Number of training steps to perform for the transitions added since the last call, at most one burst.
+        Steps that do not fit into the burst are carried over to the next call
+
+        :param new_transitions: number of transitions added to the replay memory since the last call
+        :type new_transitions: int
+        :rtype: int
+        """
+        if self.utd_ratio <= 0:  # no ratio, train continuously during connections
+            return self.burst if self.event.is_set() else 0
+        self.credit += new_transitions * self.utd_ratio
+        steps = min(int(self.credit), self.burst)
+        self.credit -= steps
+        return steps
 
     def run(self):
         """Starts the training loop for the ReLes NN. Start of an episode is at the beggining of a new MPTCP connection and the end
-        is defined at the tear down of said MPTCP connection. Saves updated model in pkl file using torch save for the online agent
-        to read and update its paramters.
+        is defined at the tear down of said MPTCP connection. While the connection is active the agent performs utd_ratio training
+        steps per new transition in bursts of at most burst steps. The updated model is saved in a checkpoint for
+        the online agent to read and update its paramters once the connection is over.
         """
         # subject to change
-        with locked_open(self.model, "rb") as f:
-            agent = torch.load(f)
+        agent = load_agent(self.model)
 
         print("start offline agent")
+        self.credit = 0.0
+        seen = self.memory.num_pushed
+        unsaved = False
+        steps = 0
+        updates = 0
+        loss = float("nan")
+        last_log = time.time()
         while True:
             try:
-                self.event.wait(timeout=10)
-
+                active = self.event.is_set()
+                n = 0
                 if len(self.memory) > self.batch_size:
-                    print("enough memory available")
-                    for __ in range(1):
-                        transitions = self.memory.sample(self.batch_size)
-                        batch = Transition(*zip(*transitions))
-                        print(agent.update_parameters(batch))
-                        if not self.event.is_set():
-                            with locked_open(self.model, "wb") as f:
-                                torch.save(agent, f)
-                            break
+                    pushed = self.memory.num_pushed
+                    n = self.pending_updates(pushed - seen)
+                    seen = pushed
+                for __ in range(n):
+                    if self.memory.priorities is not None:
+                        beta = anneal_beta(self.priority_beta, updates, self.beta_steps)
+                        batch, positions, weights = self.memory.sample_prioritized(
+                            self.batch_size, beta
+                        )
+                        loss, td_errors = agent.update_parameters(batch, weights)
+                        self.memory.update_priorities(positions, td_errors)
+                    else:
+                        batch = self.memory.sample(self.batch_size)
+                        loss, _ = agent.update_parameters(batch)
+                    updates += 1
+                steps += n
+
+                if n > 0:
+                    unsaved = True
+                elif not active and unsaved:
+                    # episode over and all steps done, hand the model over to the next online agent
+                    save_agent(self.model, agent)
+                    if self.shared_model is not None:
+                        self.shared_model.publish(agent)
+                    unsaved = False
+                elif active:
+                    time.sleep(self.poll)
+                else:
+                    self.event.wait(timeout=10)
+
+                now = time.time()
+                if now - last_log >= self.log_interval:
+                    if steps:
+                        print(
+                            f"offline agent: {steps / (now - last_log):.1f} training steps/s, loss {loss:.4f}"
+                        )
+                    steps = 0
+                    last_log = now
             except Exception as e:
                 print(f"Failed in offline agent run: {e}")
@@ -0,0 +1,297 @@
+"""Communication between the HTTP server process and the decision engine process
+
+In process mode the online agents run in a decision engine process of their
+own, so that neither training nor decisions compete with the sending threads
+of the HTTP server for the GIL. The server hands the socket of every
+connection to the engine over a Unix socket (SCM_RIGHTS) together with the
+index of a slot in a shared memory table. The engine reports in the slot when
+it is done with the connection and writes the last action of every decision
+into it, the server never waits on a decision or a training step.
+"""
+
+import array
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from multiprocessing import get_start_method, resource_tracker, shared_memory
+
+import numpy as np
+
+# states of a slot
+FREE = 0  # no connection, may be taken by the server
+ACTIVE = 1  # connection handed to the engine
+FINISHED = 2  # transfer over, the engine still has to release the slot
+
+# messages from the server to the engine, kind and slot
+ATTACH = 0  # carries the socket of the connection
+FINISH = 1
+MESSAGE = struct.Struct("qq")
+
+
+class SlotTable(object):
+    """Connection slots in shared memory, every slot holds the state of the connection, the number of decisions made
+    for it and the last action
+
+    :param num_slots: number of connections that can be served at the same time
+    :type num_slots: int
+    :param action_size: number of values of an action
+    :type action_size: int
+    :param name: name of the shared memory of an existing table to attach to, a new table is created if None
+    :type name: str
+    """
+
+    def __init__(self, num_slots, action_size, name=None):
+        self.num_slots = num_slots
+        self.action_size = action_size
+        size = num_slots * (2 + action_size) * 8
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.status = np.ndarray((num_slots,), dtype=np.int64, buffer=self.shm.buf)
+        self.decisions = np.ndarray(
+            (num_slots,), dtype=np.int64, buffer=self.shm.buf, offset=num_slots * 8
+        )
+        self.actions = np.ndarray(
+            (num_slots, action_size),
+            dtype=np.float64,
+            buffer=self.shm.buf,
+            offset=num_slots * 16,
+        )
+        if self.owner:
+            self.status[:] = FREE
+        elif get_start_method() != "fork":
+            # attaching registers the memory with the resource tracker of the attaching process too, which would unlink
+            # it when that process exits. A forked process shares the tracker of its parent, unregistering would drop
+            # the registration of the owner, which then leaks the memory if the server crashes
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def acquire(self):
+        """Take a free slot for a new connection, server side
+
+        :return: index of the slot, None if all slots are in use
+        :rtype: int
+        """
+        with self.lock:
+            free = np.flatnonzero(self.status == FREE)
+            if len(free) == 0:
+                return None
+            slot = int(free[0])
+            self.decisions[slot] = 0
+            self.actions[slot] = 0
+            self.status[slot] = ACTIVE
+            return slot
+
+    def record(self, slot, action):
+        """Store the action of a decision, engine side"""
+        self.actions[slot, : len(action)] = action
+        self.decisions[slot] += 1
+
+    def wait_free(self, slot, timeout, interval=0.001):
+        """Wait until the engine released a slot
+
+        :return: False on timeout
+        :rtype: bool
+        """
+        deadline = time.monotonic() + timeout
+        while self.status[slot] != FREE:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(interval)
+        return True
+
+    def close(self):
+        # the arrays point into the shared memory, which can only be closed without them
+        del self.status, self.decisions, self.actions
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def channel():
+    """Pair of connected Unix sockets that keep message boundaries, for the server and the engine
+
+    :rtype: socket.socket, socket.socket
+    """
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+
+def send_message(sock, kind, slot, fd=None):
+    """Send a message, with a duplicate of the file descriptor fd for the receiving process"""
+    ancdata = []
+    if fd is not None:
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))]
+    sock.sendmsg([MESSAGE.pack(kind, slot)], ancdata)
+
+
+def receive_message(sock):
+    """Receive a message of send_message
+
+    :return: kind, slot and the received file descriptor or None, or None if the other side closed the channel
+    :rtype: tuple
+    """
+    fds = array.array("i")
+    data, ancdata, flags, addr = sock.recvmsg(
+        MESSAGE.size, socket.CMSG_SPACE(fds.itemsize)
+    )
+    if not data:
+        return None
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[: len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+    kind, slot = MESSAGE.unpack(data)
+    return kind, slot, fds[0] if len(fds) else None
+
+
+class EngineClient(object):
+    """Server side of the decision engine
+
+    :param sock: server end of the channel
+    :type sock: socket.socket
+    :param slots: slot table shared with the engine
+    :type slots: class:'SlotTable'
+    """
+
+    def __init__(self, sock, slots):
+        self.sock = sock
+        self.slots = slots
+        self.lock = threading.Lock()
+
+    def attach(self, fd):
+        """Hand the socket of a new connection to the engine
+
+        :return: slot of the connection, None if all slots are in use or the engine is gone
+        :rtype: int
+        """
+        slot = self.slots.acquire()
+        if slot is not None:
+            try:
+                with self.lock:
+                    send_message(self.sock, ATTACH, slot, fd)
+            except OSError as e:
+                # the transfer goes ahead without an online agent, the slot must not stay taken
+                print(f"Warning: decision engine not reachable: {e}")
+                self.slots.status[slot] = FREE
+                return None
+        return slot
+
+    def finish(self, slot):
+        """Tell the engine that the transfer of a connection is over"""
+        self.slots.status[slot] = FINISHED
+        try:
+            with self.lock:
+                send_message(self.sock, FINISH, slot)
+        except OSError as e:
+            print(f"Warning: decision engine not reachable: {e}")
+            self.slots.status[slot] = FREE
+
+    def wait(self, slot, timeout):
+        """Wait until the engine is done with a connection
+
+        :return: False on timeout
+        :rtype: bool
+        """
+        return self.slots.wait_free(slot, timeout)
+
+
+def serve_engine(sock, slots, attach):
+    """Engine side: receive connections from the server until it closes the channel
+
+    :param sock: engine end of the channel
+    :type sock: socket.socket
+    :param slots: slot table shared with the server
+    :type slots: class:'SlotTable'
+    :param attach: called with slot and file descriptor of a new connection, returns a function that is called once
+        the transfer is over and returns when the engine is done with the connection
+    :type attach: function
+    """
+    finishers = {}
+
+    def finish(slot, fd, end):
+        try:
+            end()
+        finally:
+            os.close(fd)
+            slots.status[slot] = FREE
+
+    while True:
+        message = receive_message(sock)
+        if message is None:
+            return
+        kind, slot, fd = message
+        if kind == ATTACH:
+            try:
+                finishers[slot] = (fd, attach(slot, fd))
+            except Exception as e:
+                print(f"Failed to attach connection: {e}")
+                os.close(fd)
+                slots.status[slot] = FREE
+        elif kind == FINISH and slot in finishers:
+            fd, end = finishers.pop(slot)
+            threading.Thread(target=finish, args=(slot, fd, end), daemon=True).start()
+
+
+class QueueMemory(object):
+    """Stand-in for the replay memory in a process that only produces transitions, forwards them to the process that
+    owns the replay memory. Tensors are sent as numpy arrays, which are cheaper to pickle than tensors in shared
+    memory. Transitions are dropped instead of waiting when the queue is full.
+
+    :param transitions: queue read by the process that owns the replay memory
+    :type transitions: class:'multiprocessing.Queue'
+    """
+
+    def __init__(self, transitions):
+        self.transitions = transitions
+        self.dropped = 0
+
+    def push(self, *args, producer=None):
+        try:
+            self.transitions.put_nowait(
+                (tuple(np.asarray(value) for value in args), producer)
+            )
+        except queue.Full:
+            self.dropped += 1
+
+
+class ModelVersion(object):
+    """Counter in shared memory that is increased every time the learner saved a new model
+
+    :param version: shared counter
+    :type version: class:'multiprocessing.Value'
+    """
+
+    def __init__(self, version):
+        self.version = version
+
+    def publish(self, agent):
+        with self.version.get_lock():
+            self.version.value += 1
+
+    def watch(self, callback, interval):
+        """Call callback in a daemon thread every time the version changed
+
+        :param interval: seconds between two checks
+        :type interval: float
+        """
+
+        def run():
+            seen = self.version.value
+            while True:
+                time.sleep(interval)
+                version = self.version.value
+                if version != seen:
+                    seen = version
+                    try:
+                        callback()
+                    except Exception as e:
+                        print(f"Failed to load new model: {e}")
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
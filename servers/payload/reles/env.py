@@ -1,7 +1,11 @@
-import time
-
+import mpsched_backend as mpsched
 import numpy as np
-import reles_mpsched as mpsched
+from decision_clock import DecisionClock
+from state_buffer import RingWindow, SubflowSnapshot
+
+# position of the values reported per subflow by mpsched.get_sub_info
+SEGS_OUT, RTT, CWND, UNACKED, TOTAL_RETRANS, DST_ADDR, RCV_OOOPACK, SND_WND = range(8)
+NUM_FIELDS = 8
 
 
 class Env:
@@ -17,12 +21,15 @@ class Env:
     :type alpha: float
     :param beta: second parameter of reward function to scale number of loss packets (reflects network congetsion|min->favors less congested paths)
     :type beta: float
+    :param clock: clock that paces the decisions, a fixed SI of time if None
+    :type clock: class:'decision_clock.DecisionClock'
     """
 
-    def __init__(self, fd, time, k, alpha, b, c, max_flows):
+    def __init__(self, fd, time, k, alpha, b, c, max_flows, clock=None):
         """Constructor method"""
         self.fd = fd
         self.time = time
+        self.clock = clock if clock is not None else DecisionClock(time)
         self.k = k
         self.alpha = alpha
         self.b = b
@@ -30,19 +37,47 @@ class Env:
         self.num_segments = 10
         self.max_num_flows = max_flows
 
-        self.last = [[0] * 5 for _ in range(self.max_num_flows)]
-        self.tp = [
-            [] for _ in range(self.max_num_flows)
-        ]  # num of segments out (MSS=1440B)
-        self.rtt = [[] for _ in range(self.max_num_flows)]  # snapshot of rtt
-        self.dRtt = [[] for _ in range(self.max_num_flows)]
-        self.cwnd = [[] for _ in range(self.max_num_flows)]  # cwnd sender
-        self.rr = [
-            [] for _ in range(self.max_num_flows)
-        ]  # number of unacked packets (in flight)
-        self.in_flight = [
-            [] for _ in range(self.max_num_flows)
-        ]  # number of TOTAL retransmissions
+        self.subflows = SubflowSnapshot(self.max_num_flows, NUM_FIELDS)
+        # raw observations are read into this buffer instead of a new list per call
+        self._raw = np.zeros((self.max_num_flows, NUM_FIELDS), dtype=np.uint32)
+        # the k + 1 observations of reset are taken with a single call
+        self._samples = np.zeros(
+            (self.k + 1, mpsched.NUM_SUBFLOWS, NUM_FIELDS), dtype=np.uint32
+        )
+        self._sample_times = np.zeros(self.k + 1)
+        self._sample_counts = np.zeros(self.k + 1, dtype=np.int32)
+        # ring buffer of a background sampler of the connection, replaces reading the subflows in step
+        self.telemetry = None
+        # measurements of all paths are preallocated once, the per characteristic attributes are views into them
+        self._state = np.zeros(5 * self.max_num_flows)
+        (
+            self.tp,  # num of segments out (MSS=1440B)
+            self.rtt,  # snapshot of rtt
+            self.cwnd,  # cwnd sender
+            self.rr,  # number of unacked packets (in flight)
+            self.in_flight,  # number of TOTAL retransmissions
+        ) = np.split(self._state, 5)
+        self.states = RingWindow(len(self._state), self.k)  # last k measurements
+
+    def measure(self, subs):
+        """Loads a raw observation and appends throughput and state variables of all paths to the last k measurements,
+        paths that are not reported are zero
+
+        :param subs: Raw observations from socket api with mpsched extension
+        :type subs: list
+        """
+        self.subflows.load(subs)
+        self.clock.update(self.subflows.current[: self.subflows.num_active, RTT] / 1e6)
+        self.tp[:] = self.subflows.delta(SEGS_OUT) * 1.44
+        self.rtt[:] = self.subflows.current[:, RTT] / 1000
+        self.cwnd[:] = (
+            self.subflows.current[:, CWND] + self.subflows.last[:, CWND]
+        ) / 2
+        self.rr[:] = self.subflows.delta(UNACKED)
+        self.in_flight[:] = self.subflows.delta(
+            TOTAL_RETRANS
+        )  # look at wording in reles paper
+        self.states.push(self._state)
 
     def adjust(self, state):
         """Converts the raw observations collected with mpsched socket api into appropriate values for state information and reward
@@ -50,45 +85,12 @@ class Env:
 
         :param state: Raw observations from socket api with mpsched extension
         :type state: list
-        :return: State parameters
-        :rtype: list
+        :return: State parameters of the last k measurements, one row per characteristic and path. The array is a view
+            into a preallocated buffer and stays valid until the next measurement
+        :rtype: numpy.ndarray
         """
-        for i in range(len(state)):  # in range 2 if len sate < 2 etc.
-            if len(self.tp[i]) == self.k:
-                self.tp[i].pop(0)
-                self.rtt[i].pop(0)
-                self.dRtt[i].pop(0)
-                self.cwnd[i].pop(0)
-                self.rr[i].pop(0)
-                self.in_flight[i].pop(0)
-            if len(self.last) < self.max_num_flows:
-                # if not all subflows appeared yet set rest to 0
-                for _ in range(self.max_num_flows - len(self.last)):
-                    self.last.append([0, 0, 0, 0, 0])
-            if len(state) < self.max_num_flows:
-                for _ in range(self.max_num_flows - len(state)):
-                    state.append([0, 0, 0, 0, 0])
-            self.tp[i].append(np.abs(state[i][0] - self.last[i][0]) * 1.44)
-            self.rtt[i].append((state[i][1]) / 1000)
-            self.dRtt[i].append(state[i][1] - self.last[i][1])
-            self.cwnd[i].append((state[i][2] + self.last[i][2]) / 2)
-            self.rr[i].append(np.abs(state[i][3] - self.last[i][3]))
-            self.in_flight[i].append(
-                np.abs(state[i][4] - self.last[i][4])
-            )  # look at wording in reles paper
-        self.last = state
-        return [
-            self.tp[0],
-            self.tp[1],
-            self.rtt[0],
-            self.rtt[1],
-            self.cwnd[0],
-            self.cwnd[1],
-            self.rr[0],
-            self.rr[1],
-            self.in_flight[0],
-            self.in_flight[1],
-        ]
+        self.measure(state)
+        return self.states.window()
 
     def reward(self):
         """Calculates the reward of the last SI using the ReLes reward function which consideres multiple QoS parameters
@@ -98,19 +100,12 @@ class Env:
         :return: Reward value
         :type: float
         """
-        rewards = (self.tp[0][self.k - 1]) + (self.tp[1][self.k - 1])
+        rewards = np.sum(self.tp)
         if rewards != 0:
-            rewards = rewards - (1 / rewards) * self.alpha * (
-                (
-                    self.rtt[0][self.k - 1] * self.tp[0][self.k - 1]
-                    + self.rtt[1][self.k - 1] * self.tp[1][self.k - 1]
-                )
-            )
+            rewards = rewards - (1 / rewards) * self.alpha * np.sum(self.rtt * self.tp)
         else:
             rewards = 0
-        rewards = rewards - self.b * (
-            self.in_flight[0][self.k - 1] + self.in_flight[1][self.k - 1]
-        )
+        rewards = rewards - self.b * np.sum(self.in_flight)
 
         return rewards
 
@@ -119,45 +114,49 @@ class Env:
         the stacked LSTM part of the NAF Q-network
 
         :return: State parameters
-        :rtype: list
+        :rtype: numpy.ndarray
         """
-        self.last = mpsched.get_sub_info(self.fd)
+        # the environment is reused across connections by the online agents of the pool
+        self.subflows.reset()
+        self.states.reset()
+        self.clock.reset()
+        observations = self.sample((self.clock.interval) / 10)
+        self.subflows.load(observations[0])
         # record k measurements
-        for i in range(self.k):
-            subs = mpsched.get_sub_info(self.fd)
-            for j in range(self.max_num_flows):
-                if len(self.tp[j]) == self.k:
-                    self.tp[j].pop(0)
-                    self.rtt[j].pop(0)
-                    self.dRtt[j].pop(0)
-                    self.cwnd[j].pop(0)
-                    self.rr[j].pop(0)
-                    self.in_flight[j].pop(0)
-                if len(self.last) < (self.max_num_flows):
-                    for _ in range(self.max_num_flows - len(self.last)):
-                        self.last.append([0, 0, 0, 0, 0])
-                if len(subs) < self.max_num_flows:
-                    for _ in range(self.max_num_flows - len(subs)):
-                        subs.append([0, 0, 0, 0, 0])
-                self.tp[j].append(np.abs(subs[j][0] - self.last[j][0]) * 1.44)
-                self.rtt[j].append((subs[j][1] / 1000))
-                self.dRtt[j].append(np.abs(subs[j][1] - self.last[j][1]))
-                self.cwnd[j].append((subs[j][2] + self.last[j][2]) / 2)
-                self.rr[j].append(np.abs(subs[j][3] - self.last[j][3]))
-                self.in_flight[j].append(np.abs(subs[j][4] - self.last[j][4]))
-            self.last = subs
-            time.sleep((self.time) / 10)
+        for subs in observations[1:]:
+            self.measure(subs)
+        self.clock.start()
+        return self.states.window()
+
+    def sub_info(self):
+        """Raw observation of all subflows with the socket api of the mpsched extension, the newest snapshot of the
+        background sampler if there is one
+
+        :return: one row per reported subflow, a view into a preallocated buffer that stays valid until the next call
+        :rtype: numpy.ndarray
+        """
+        if self.telemetry is not None:
+            subs = self.telemetry.latest(self._raw)
+            if subs is not None:
+                return subs
+        return self._raw[: mpsched.get_sub_info_into(self.fd, self._raw)]
+
+    def sample(self, interval):
+        """k + 1 raw observations of all subflows interval seconds apart, taken with a single call of the mpsched
+        extension that does not hold the GIL while it waits
+
+        :param interval: seconds between two observations
+        :type interval: float
+        :return: reported subflows of every observation, views into a preallocated buffer that stay valid until the next
+            call
+        :rtype: list
+        """
+        mpsched.sample_sub_info(
+            self.fd, interval, self._samples, self._sample_times, self._sample_counts
+        )
         return [
-            self.tp[0],
-            self.tp[1],
-            self.rtt[0],
-            self.rtt[1],
-            self.cwnd[0],
-            self.cwnd[1],
-            self.rr[0],
-            self.rr[1],
-            self.in_flight[0],
-            self.in_flight[1],
+            samples[:count]
+            for samples, count in zip(self._samples, self._sample_counts)
         ]
 
     def update_fd(self, fd):
@@ -168,34 +167,31 @@ class Env:
         Actions include among other things:
         -setting the split factor for the kernel scheduler using socket api with mpsched extension
         -calculated the reward of the action of state t using reward method
-        -wait SI until the begin of the next state t+1
+        -wait on the decision clock until the begin of the next state t+1
         -take measurement of the new path characteristics after taking action t using socket api with mpsched extension
         -adjust the current environment variables using adjust method
 
         :param action: split factor derived using the current policy network of the ReLes NAF NN
         :type action: list
         :return: state observation of the next state t+1,reward value and boolean indication whether bulk transfer is over
-        :rtype: list,float,boolean
+        :rtype: numpy.ndarray,float,boolean
         """
-
-        splits = []
-        A = [self.fd]
-
-        for k in range(self.max_num_flows):
-            kaction = (action[0][k] + 1) / 2  # high = 10 low = 1
-            kaction *= self.num_segments - 1
-            kaction += 1
-            splits.append(int(np.round(kaction)))
-        A = list(np.concatenate((A, splits)))
+        # high = 10 low = 1
+        splits = np.round(
+            (np.asarray(action[0][: self.max_num_flows]) + 1)
+            / 2
+            * (self.num_segments - 1)
+            + 1
+        ).astype(int)
         # print(*splits)
 
-        mpsched.set_seg(A)
+        mpsched.set_seg_array(self.fd, splits)
 
-        time.sleep(self.time)
-        state_nxt = mpsched.get_sub_info(self.fd)
+        self.clock.wait()
+        state_nxt = self.sub_info()
         # print(state_nxt)
         done = False
-        if not state_nxt:
+        if len(state_nxt) == 0:
             done = True
         state_nxt = self.adjust(state_nxt)
         reward = self.reward()
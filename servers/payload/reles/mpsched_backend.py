@@ -0,0 +1,28 @@
+"""Socket api of the reles_mpsched extension
+
+The extension needs the MPTCP kernel. With the environment variable MPSCHED_STUB set, the pure Python stub of
+mpsched_stub with the same functions is used instead, to benchmark and test the payload without it.
+"""
+
+import os
+
+# NUM_SUBFLOWS of reles_mpsched/setup.py and the values reported per subflow by get_sub_info, in order
+NUM_SUBFLOWS = 2
+FIELDS = (
+    "segs_out",
+    "rtt",
+    "snd_cwnd",
+    "unacked",
+    "total_retrans",
+    "dst_addr",
+    "rcv_ooopack",
+    "snd_wnd",
+)
+
+if os.environ.get("MPSCHED_STUB"):
+    import mpsched_stub
+
+    mpsched_stub.configure(NUM_SUBFLOWS, FIELDS)
+    from mpsched_stub import *  # noqa: F401, F403
+else:
+    from reles_mpsched import *  # noqa: F401, F403
@@ -0,0 +1,208 @@
+"""Pure Python stand-in for the mpsched C extensions
+
+Same functions as the extension built from mpsched.c, backed by simulated
+subflows instead of the MPTCP kernel, so that the environments and agents can
+be benchmarked and tested on any machine. Every file descriptor is a
+connection whose subflows send with the wall clock: a subflow sends cwnd
+segments per RTT, scaled by its share of the segments set with set_seg, with
+a noisy RTT and a small loss rate. close ends a connection, after which
+get_sub_info reports no subflows like for a closed socket.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+__all__ = [
+    "persist_state",
+    "get_sub_info",
+    "get_sub_info_into",
+    "set_seg",
+    "set_seg_array",
+    "sample_sub_info",
+    "close",
+]
+
+# values that can be reported per subflow, the order is set by configure
+FIELDS = (
+    "segs_out",
+    "rtt",
+    "snd_cwnd",
+    "unacked",
+    "total_retrans",
+    "dst_addr",
+    "rcv_ooopack",
+    "snd_wnd",
+    "src_addr",
+)
+
+_num_subflows = 2
+_fields = FIELDS[:8]
+_connections = {}
+_lock = threading.Lock()
+
+
+def configure(num_subflows, fields):
+    """Set the number of subflows and the values reported per subflow, as compiled into the extension
+
+    :param num_subflows: NUM_SUBFLOWS of the extension
+    :type num_subflows: int
+    :param fields: names of FIELDS in the order of get_sub_info
+    :type fields: tuple
+    """
+    global _num_subflows, _fields
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown subflow values {sorted(unknown)}")
+    with _lock:
+        _num_subflows = num_subflows
+        _fields = tuple(fields)
+        _connections.clear()
+
+
+class _Connection:
+    """Simulated subflows of one MPTCP connection, seeded by the file descriptor"""
+
+    def __init__(self, fd):
+        n = _num_subflows
+        self.rng = np.random.default_rng(fd)
+        self.base_rtt = self.rng.uniform(10000, 60000, n)  # us
+        self.loss = self.rng.uniform(0, 0.02, n)
+        self.counters = {name: np.zeros(n) for name in FIELDS}
+        self.counters["snd_cwnd"][:] = self.rng.integers(10, 100, n)
+        self.counters["rtt"][:] = self.base_rtt
+        self.counters["snd_wnd"][:] = 65535
+        # 10.0.i.i and 10.0.i.10 in network byte order, the addresses of the client interfaces
+        index = np.arange(1, n + 1)
+        self.counters["dst_addr"][:] = (index << 24) + (index << 16) + 10
+        self.counters["src_addr"][:] = (10 << 24) + (index << 16) + 10
+        self.segments = np.ones(n)
+        self.columns = [self.counters[name] for name in _fields]
+        self.closed = False
+        self.last = time.monotonic()
+
+    def advance(self):
+        now = time.monotonic()
+        dt, self.last = now - self.last, now
+        c = self.counters
+        c["rtt"][:] = self.base_rtt * self.rng.uniform(0.9, 1.3, len(self.base_rtt))
+        share = self.segments / max(self.segments.sum(), 1)
+        sent = dt / (c["rtt"] / 1e6) * c["snd_cwnd"] * share * len(share)
+        lost = self.rng.binomial(sent.astype(np.int64), self.loss)
+        c["segs_out"] += sent
+        c["total_retrans"] += lost
+        c["rcv_ooopack"] += lost
+        c["unacked"][:] = np.minimum(sent, c["snd_cwnd"])
+
+    def read(self, rows):
+        """Advance the subflows and write the reported values into rows
+
+        :return: number of subflows written
+        :rtype: int
+        """
+        if self.closed:
+            return 0
+        self.advance()
+        count = min(len(rows), _num_subflows)
+        for k, column in enumerate(self.columns):
+            rows[:count, k] = column[:count]
+        return count
+
+
+def _connection(fd):
+    connection = _connections.get(fd)
+    if connection is None:
+        connection = _connections[fd] = _Connection(fd)
+    return connection
+
+
+def persist_state(fd):
+    # a new connection, the file descriptor of a closed one may be reused
+    with _lock:
+        _connections[fd] = _Connection(fd)
+    return fd
+
+
+def get_sub_info(fd):
+    rows = np.zeros((_num_subflows, len(_fields)), dtype=np.uint32)
+    with _lock:
+        count = _connection(fd).read(rows)
+    return rows[:count].tolist()
+
+
+def get_sub_info_into(fd, buffer):
+    """Write the values of get_sub_info into a writable buffer of uint32, see mpsched.c
+
+    :return: number of subflows written
+    :rtype: int
+    """
+    flat = np.frombuffer(buffer, dtype=np.uint32)
+    if not flat.flags.writeable:
+        raise TypeError("buffer must be writable")
+    if len(flat) < len(_fields):
+        raise ValueError("buffer too small for one subflow")
+    rows = flat[: len(flat) // len(_fields) * len(_fields)].reshape(-1, len(_fields))
+    with _lock:
+        return _connection(fd).read(rows)
+
+
+def sample_sub_info(fd, interval, samples, times, counts):
+    """Snapshots of the subflows interval seconds apart into buffers, see mpsched.c
+
+    :return: number of snapshots taken
+    :rtype: int
+    """
+    for buffer, kinds, itemsize, message in (
+        (samples, "IL", 4, "samples must be unsigned 32 bit integers"),
+        (times, "d", 8, "times must be doubles"),
+        (counts, "i", 4, "counts must be 32 bit integers"),
+    ):
+        view = memoryview(buffer)
+        if view.format[-1:] not in kinds or view.itemsize != itemsize:
+            raise TypeError(message)
+    width = _num_subflows * len(_fields)
+    flat = np.frombuffer(samples, dtype=np.uint32)
+    n = len(flat) // width
+    snapshots = flat[: n * width].reshape(n, _num_subflows, len(_fields))
+    times = np.frombuffer(times, dtype=np.float64)
+    counts = np.frombuffer(counts, dtype=np.int32)
+    if len(times) < n or len(counts) < n:
+        raise ValueError("times and counts need one value per snapshot")
+    snapshots[:] = 0
+    counts[:n] = 0
+    deadline = time.monotonic()
+    taken = 0
+    while taken < n:
+        if taken > 0 and interval > 0:
+            deadline += interval
+            time.sleep(max(deadline - time.monotonic(), 0))
+        with _lock:
+            count = _connection(fd).read(snapshots[taken])
+        times[taken] = time.monotonic()
+        counts[taken] = count
+        taken += 1
+        if count == 0:
+            break
+    return taken
+
+
+def set_seg(args):
+    return set_seg_array(args[0], args[1:])
+
+
+def set_seg_array(fd, segments):
+    segments = np.asarray(segments)
+    if not np.issubdtype(segments.dtype, np.integer):
+        raise TypeError("segments must be integers")
+    with _lock:
+        connection = _connection(fd)
+        count = min(len(segments), _num_subflows)
+        connection.segments[:count] = segments[:count]
+    return fd
+
+
+def close(fd):
+    """End the connection of a file descriptor, only in the stub"""
+    with _lock:
+        _connection(fd).closed = True
@@ -10,6 +10,7 @@ import pathlib
 import pickle
 import re
 import shutil
+import signal
 import socket
 import socketserver
 import sys
@@ -21,13 +22,22 @@ from os import path
 from threading import Event
 from urllib.parse import parse_qs, urlparse
 
+import mpsched_backend as mpsched  # Install reles_mpsched beforehand in systems
 import numpy as np
-import reles_mpsched as mpsched  # Install this beforehand in systems
 import torch
-from agent import Offline_Agent, Online_Agent
+from agent import AgentPool, Offline_Agent, SharedModel, set_torch_threads
+from checkpoint import ModelRegistry, save_agent
+from engine_ipc import (
+    EngineClient,
+    ModelVersion,
+    QueueMemory,
+    SlotTable,
+    channel,
+    serve_engine,
+)
 from gym import spaces
 from naf_lstm import NAF_LSTM
-from replay_memory import ReplayMemory
+from replay_memory import FrameReplayMemory, MemmapStore, ReplayMemory, Transition
 from util import locked_open
 
 CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
@@ -41,18 +51,46 @@ class MyHTTPHandler(http.server.SimpleHTTPRequestHandler):
 
     def do_GET(self):
         sock = self.request
-        kill_event = threading.Event()
-        agent = Online_Agent(
-            fd=sock.fileno(),
-            cfg=self.server.cfg,
-            memory=self.server.replay_memory,
-            kill_event=kill_event,
-            event=self.server.event,
-        )
-
-        agent.start()
-        self.server.event.set()
-
+        engine = self.server.engine
+        if engine is not None:
+            # process mode, the online agent runs in the decision engine process
+            slot = engine.attach(sock.fileno())
+            if slot is None:
+                print("Warning: no engine slot, no online agent for connection")
+        else:
+            kill_event = threading.Event()
+            agent = self.server.agents.acquire()
+            agent_done = agent.attach(sock.fileno(), kill_event)
+        self.transfer_started()
+
+        try:
+            self.send_file()
+        finally:
+            self.transfer_ended()
+            if engine is not None:
+                if slot is not None:
+                    engine.finish(slot)
+                    if not engine.wait(slot, timeout=5):
+                        print("Warning: Online Agent did not terminate in time")
+            else:
+                kill_event.set()
+                if not agent_done.wait(timeout=5):
+                    print("Warning: Online Agent thread did not terminate in time")
+
+    def transfer_started(self):
+        """Count the connection, the first one sets the event of the online and offline agents"""
+        with self.server.lock:
+            self.server.connections += 1
+            self.server.event.set()
+
+    def transfer_ended(self):
+        """Clear the event once the last connection is over, the agents of the other connections keep deciding"""
+        with self.server.lock:
+            self.server.connections -= 1
+            if self.server.connections == 0:
+                self.server.event.clear()
+
+    def send_file(self):
         file_size, file_name = self.parse_file_size()
         if file_size is None:
             self.send_error(400, "Bad Request: Invalid file size specifier")
@@ -75,12 +113,6 @@ class MyHTTPHandler(http.server.SimpleHTTPRequestHandler):
 
         print(f"Done sending {file_path}")
 
-        self.server.event.clear()
-        kill_event.set()
-        agent.join(timeout=5)
-        if agent.is_alive():
-            print("Warning: Online Agent thread did not terminate in time")
-
     def parse_file_size(self):
         # Extract the file size specifier from the query parameter
         parsed_url = urlparse(self.path)
@@ -125,6 +157,204 @@ class MyHTTPHandler(http.server.SimpleHTTPRequestHandler):
         return file_path
 
 
+# NAF_LSTM.update_parameters expects the state windows of a batch along dim 1
+MEMORY_CAT_DIMS = Transition(state=1, action=0, mask=0, next_state=1, reward=0)
+
+
+def create_memory(cfg, store=None):
+    """Create an empty replay memory with the storage configured in config.ini
+
+    :param cfg: contains all the neccessary parameters read from config.ini
+    :type cfg: configParser
+    :param store: store that keeps the tensors of the memory in memory-mapped files
+    :type store: class:'MemmapStore'
+    :rtype: class:'ReplayMemory' or class:'FrameReplayMemory'
+    """
+    capacity = cfg.getint("replaymemory", "capacity")
+    dtype = getattr(torch, cfg.get("replaymemory", "dtype"))
+    if cfg.get("replaymemory", "storage") == "frames":
+        return FrameReplayMemory(
+            capacity,
+            dtype=dtype,
+            store=store,
+            max_gap=cfg.getint("replaymemory", "max_gap"),
+        )
+    return ReplayMemory(capacity, dtype=dtype, cat_dims=MEMORY_CAT_DIMS, store=store)
+
+
+def load_memory(cfg, memory_file, store_dir, continue_train):
+    """Attach to the replay memory of the memory-mapped store. A replay memory pickled by earlier versions is moved
+    into the store once. Without continue_train the store starts empty.
+
+    :param cfg: contains all the neccessary parameters read from config.ini
+    :type cfg: configParser
+    :param memory_file: pickled replay memory of earlier versions
+    :type memory_file: str
+    :param store_dir: directory of the memory-mapped store
+    :type store_dir: str
+    :param continue_train: keep the transitions of previous runs
+    :type continue_train: bool
+    :rtype: class:'ReplayMemory' or class:'FrameReplayMemory'
+    """
+    if not continue_train and os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    store = MemmapStore(store_dir)
+    if continue_train and store.exists():
+        memory = store.load()
+        print(f"Attached to replay memory with {len(memory)} transitions")
+        return memory
+
+    memory = create_memory(cfg, store)
+    if continue_train and os.path.exists(memory_file):
+        with locked_open(memory_file, "rb") as f:
+            try:
+                pickled = pickle.load(f)
+            except EOFError:
+                print("memory EOF error not saved properly")
+                pickled = None
+        if pickled is not None:
+            if isinstance(pickled, ReplayMemory):
+                # memories pickled as a list of transitions do not know the layout
+                pickled.cat_dims = MEMORY_CAT_DIMS
+            memory.extend(pickled)
+            store.flush()
+            print(f"Moved {len(memory)} transitions of {memory_file} into {store_dir}")
+    return memory
+
+
+def run_learner(
+    cfg, agent_file, memory_file, store_dir, continue_train, transitions, event, version
+):
+    """Learner process of process mode. Owns the replay memory, adds the transitions of the decision engine to it
+    and runs the offline agent
+
+    :param transitions: transitions sent by engine_ipc.QueueMemory
+    :type transitions: class:'multiprocessing.Queue'
+    :param event: set while a connection is active
+    :type event: class:'multiprocessing.Event'
+    :param version: increased after every saved model
+    :type version: class:'multiprocessing.Value'
+    """
+    set_torch_threads(cfg.getint("train", "num_threads"))
+    memory = load_memory(cfg, memory_file, store_dir, continue_train)
+    memory.store.flush_periodically(cfg.getfloat("replaymemory", "flush_interval"))
+    if cfg.getfloat("replaymemory", "priority_alpha") > 0:
+        memory.enable_priorities(cfg.getfloat("replaymemory", "priority_alpha"))
+
+    def terminate(signum, frame):
+        memory.store.flush()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    off_agent = Offline_Agent(
+        cfg=cfg,
+        model=agent_file,
+        memory=memory,
+        event=event,
+        shared_model=ModelVersion(version),
+    )
+    off_agent.daemon = True
+    batch_size = cfg.getint("train", "batch_size")
+    while True:
+        transition, producer = transitions.get()
+        memory.push(
+            *(torch.from_numpy(value) for value in transition), producer=producer
+        )
+        if off_agent.ident is None and len(memory) > batch_size:
+            print("Off agent offline, starting")
+            off_agent.start()
+
+
+def run_engine(cfg, agent_file, sock, slots_name, event, transitions, version):
+    """Decision engine process of process mode. Runs the online agents for the connections handed over by the server
+
+    :param sock: engine end of the channel to the server
+    :type sock: socket.socket
+    :param slots_name: shared memory of the slot table
+    :type slots_name: str
+    """
+    set_torch_threads(cfg.getint("inference", "num_threads"))
+    max_flows = cfg.getint("env", "max_num_subflows")
+    slots = SlotTable(cfg.getint("engine", "slots"), max_flows, name=slots_name)
+    shared_model = SharedModel(
+        agent_file,
+        (5 * max_flows, 1, cfg.getint("env", "k"), 1),
+        cfg.get("inference", "model"),
+    )
+    # new models are saved between connections, when there is time to load them
+    ModelVersion(version).watch(shared_model.reload, interval=1.0)
+    agents = AgentPool(
+        cfg.getint("env", "pool_size"),
+        cfg,
+        QueueMemory(transitions),
+        event,
+        shared_model,
+        slots=slots,
+    )
+
+    def attach(slot, fd):
+        kill_event = threading.Event()
+        agent_done = agents.acquire().attach(fd, kill_event, slot)
+
+        def end():
+            kill_event.set()
+            if not agent_done.wait(timeout=5):
+                print("Warning: Online Agent thread did not terminate in time")
+
+        return end
+
+    serve_engine(sock, slots, attach)
+
+
+def start_processes(cfg, agent_file, memory_file, store_dir, continue_train, event):
+    """Start decision engine and learner process
+
+    :param event: set while a connection is active
+    :type event: class:'multiprocessing.Event'
+    :return: server side of the engine and the processes
+    :rtype: class:'engine_ipc.EngineClient', list
+    """
+    transitions = multiprocessing.Queue(cfg.getint("engine", "queue_size"))
+    version = multiprocessing.Value("q", 0)
+    slots = SlotTable(
+        cfg.getint("engine", "slots"), cfg.getint("env", "max_num_subflows")
+    )
+    server_sock, engine_sock = channel()
+    processes = [
+        multiprocessing.Process(
+            target=run_learner,
+            args=(
+                cfg,
+                agent_file,
+                memory_file,
+                store_dir,
+                continue_train,
+                transitions,
+                event,
+                version,
+            ),
+            daemon=True,
+        ),
+        multiprocessing.Process(
+            target=run_engine,
+            args=(
+                cfg,
+                agent_file,
+                engine_sock,
+                slots.name,
+                event,
+                transitions,
+                version,
+            ),
+            daemon=True,
+        ),
+    ]
+    for process in processes:
+        process.start()
+    engine_sock.close()
+    return EngineClient(server_sock, slots), processes
+
+
 class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
     """ThreadedHTTPServer class initialized with (IP,PORT),HTTPRequestHandler"""
 
@@ -141,6 +371,11 @@ def main():
         default=1,
         help="Continue training from previous state (0: No, 1: Yes)",
     )
+    parser.add_argument(
+        "--model_version",
+        type=int,
+        help="Start from this version of artifacts/trained_models/registry.json instead of the last model",
+    )
 
     parser.add_argument(
         "--debug", action="store_true", help="Enable remote debugging with debugpy"
@@ -160,6 +395,7 @@ def main():
     IP = args.ip
     PORT = args.port
     MEMORY_FILE = str((TMP_DIR / cfg.get("replaymemory", "memory")).resolve())
+    STORE_DIR = str((TMP_DIR / cfg.get("replaymemory", "store")).resolve())
     AGENT_FILE = str((TMP_DIR / cfg.get("nafcnn", "agent")).resolve())
     INTERVAL = cfg.getint("train", "interval")
     EPISODE = cfg.getint("train", "episode")
@@ -171,21 +407,22 @@ def main():
     now = datetime.now().replace(microsecond=0)
     start_train = now.strftime("%Y-%m-%d %H:%M:%S")
 
-    if os.path.exists(MEMORY_FILE) and CONTINUE_TRAIN:
-        with locked_open(MEMORY_FILE, "rb") as f:
-            try:
-                memory = pickle.load(f)
-                f.close()
-            except EOFError:
-                print("memory EOF error not saved properly")
-                memory = ReplayMemory(cfg.getint("replaymemory", "capacity"))
-    else:
-        memory = ReplayMemory(cfg.getint("replaymemory", "capacity"))
-
-    if CONTINUE_TRAIN != 1 and os.path.exists(AGENT_FILE):
-        os.makedirs("trained_models/", exist_ok=True)
-        shutil.move(AGENT_FILE, "trained_models/agent" + start_train + ".pkl")
-    if not os.path.exists(AGENT_FILE) or CONTINUE_TRAIN != 1:
+    # a model pickled by earlier versions is converted once
+    legacy = str(pathlib.Path(AGENT_FILE).with_suffix(".pkl"))
+    if not os.path.exists(AGENT_FILE) and os.path.exists(legacy):
+        save_agent(AGENT_FILE, torch.load(legacy))
+        os.remove(legacy)
+        print(f"Converted {legacy} into {AGENT_FILE}")
+    registry = ModelRegistry(str(TMP_DIR / "trained_models"))
+    if os.path.exists(AGENT_FILE) and (
+        CONTINUE_TRAIN != 1 or args.model_version is not None
+    ):
+        version = registry.register(AGENT_FILE)
+        print(f"Model of the last run is version {version}")
+    if args.model_version is not None:
+        version = registry.restore(args.model_version, AGENT_FILE)
+        print(f"Starting from model version {version}")
+    elif not os.path.exists(AGENT_FILE) or CONTINUE_TRAIN != 1:
         pathlib.Path(AGENT_FILE).parent.mkdir(parents=True, exist_ok=True)
         agent = NAF_LSTM(
             gamma=cfg.getfloat("nafcnn", "gamma"),
@@ -194,35 +431,70 @@ def main():
             num_inputs=cfg.getint("env", "k") * MAX_NUM_FLOWS * 5,
             action_space=MAX_NUM_FLOWS,
         )  # 5 is the size of state space (TP,RTT,CWND,unACK,retrans)
-        with locked_open(AGENT_FILE, "wb") as f:
-            torch.save(agent, f)
+        save_agent(AGENT_FILE, agent)
 
-    off_agent = Offline_Agent(
-        cfg=cfg, model=AGENT_FILE, memory=memory, event=transfer_event
-    )
-    off_agent.daemon = True
+    if cfg.get("engine", "mode") == "process":
+        transfer_event = multiprocessing.Event()
+        engine, processes = start_processes(
+            cfg, AGENT_FILE, MEMORY_FILE, STORE_DIR, CONTINUE_TRAIN, transfer_event
+        )
+        memory = agents = None
+    else:
+        engine = None
+        # one process for online and offline agents, they share the torch threads
+        set_torch_threads(cfg.getint("train", "num_threads"))
+        memory = load_memory(cfg, MEMORY_FILE, STORE_DIR, CONTINUE_TRAIN)
+        memory.store.flush_periodically(cfg.getfloat("replaymemory", "flush_interval"))
+        if cfg.getfloat("replaymemory", "priority_alpha") > 0:
+            memory.enable_priorities(cfg.getfloat("replaymemory", "priority_alpha"))
+
+        # online agents are started before the first connection and share one model
+        shared_model = SharedModel(
+            AGENT_FILE,
+            (5 * MAX_NUM_FLOWS, 1, cfg.getint("env", "k"), 1),
+            cfg.get("inference", "model"),
+        )
+        agents = AgentPool(
+            cfg.getint("env", "pool_size"), cfg, memory, transfer_event, shared_model
+        )
+        off_agent = Offline_Agent(
+            cfg=cfg,
+            model=AGENT_FILE,
+            memory=memory,
+            event=transfer_event,
+            shared_model=shared_model,
+        )
+        off_agent.daemon = True
     server = ThreadedHTTPServer((IP, PORT), MyHTTPHandler)
     server.event = transfer_event
+    # connections being transferred, the event is set while there is at least one
+    server.connections = 0
+    server.lock = threading.Lock()
     server.cfg = cfg
     server.replay_memory = memory
+    server.agents = agents
+    server.engine = engine
     server_thread = threading.Thread(target=server.serve_forever)
     server_thread.daemon = True
     server_thread.start()
 
     try:
         while transfer_event.wait(timeout=20):  # only returns false in case of timeout
-            if len(memory) > BATCH_SIZE and not off_agent.is_alive():
+            if engine is None and len(memory) > BATCH_SIZE and not off_agent.is_alive():
                 print("Off agent offline, starting")
                 off_agent.start()
             time.sleep(25)
             pass
-        with locked_open(MEMORY_FILE, "wb") as f:
-            pickle.dump(memory, f)
-            f.close()
     except (KeyboardInterrupt, SystemExit):
-        with locked_open(MEMORY_FILE, "wb") as f:
-            pickle.dump(memory, f)
-            f.close()
+        pass
+    if engine is None:
+        memory.store.flush()
+    else:
+        # the learner flushes the replay memory when terminated
+        for process in processes:
+            process.terminate()
+            process.join(timeout=10)
+        engine.slots.close()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,15 @@
+import json
+import os
+import pathlib
 import pickle
 import random
 import threading
+import time
 from collections import namedtuple
+from contextlib import nullcontext
+
+import numpy as np
+import torch
 
 Transition = namedtuple(
     "Transition", ("state", "action", "mask", "next_state", "reward")
@@ -10,22 +18,719 @@ Transition = namedtuple(
 # replaymemory implementation copied from github.com/gaogogo/Experiment
 
 
-class ReplayMemory(object):
+class SumTree(object):
+    """Binary tree over the priorities of the transitions of a replay memory in which every node holds the sum of its
+    two children, for proportional sampling in O(log n). Node 1 is the root, the leaves start at num_leaves.
+
+    :param capacity: number of priorities
+    :type capacity: int
+    """
 
     def __init__(self, capacity):
+        self.num_leaves = 1 << max(capacity - 1, 0).bit_length()
+        self.nodes = np.zeros(2 * self.num_leaves)
+        self.max_priority = 1.0  # priority of new transitions
+
+    @property
+    def total(self):
+        return self.nodes[1]
+
+    def leaves(self, indices):
+        return self.nodes[np.asarray(indices) + self.num_leaves]
+
+    def set(self, index, priority):
+        """Change a single priority"""
+        node = index + self.num_leaves
+        nodes = self.nodes
+        nodes[node] = priority
+        node //= 2
+        while node:
+            nodes[node] = nodes[2 * node] + nodes[2 * node + 1]
+            node //= 2
+
+    def update(self, indices, priorities):
+        """Change the priorities of a batch of indices"""
+        node = np.asarray(indices, dtype=np.int64) + self.num_leaves
+        self.nodes[node] = priorities
+        while node[0] > 1:  # all leaves have the same depth
+            node //= 2
+            self.nodes[node] = self.nodes[2 * node] + self.nodes[2 * node + 1]
+
+    def find(self, values):
+        """Indices of the leaves in which the prefix sums of the priorities reach values
+
+        :param values: prefix sums in [0, total)
+        :type values: numpy.ndarray
+        :rtype: numpy.ndarray
+        """
+        values = np.array(values, dtype=np.float64)
+        node = np.ones(len(values), dtype=np.int64)
+        while node[0] < self.num_leaves:
+            left = 2 * node
+            left_sum = self.nodes[left]
+            # never descend into an empty subtree, rounding may push values past the last priority
+            right = (values > left_sum) & (self.nodes[left + 1] > 0)
+            values -= np.where(right, left_sum, 0)
+            node = left + right
+        return node - self.num_leaves
+
+    def grow(self, capacity):
+        """Make room for capacity priorities, keeping the existing ones"""
+        if capacity <= self.num_leaves:
+            return
+        leaves = self.nodes[self.num_leaves :]
+        self.num_leaves = 1 << (capacity - 1).bit_length()
+        self.nodes = np.zeros(2 * self.num_leaves)
+        self.nodes[self.num_leaves : self.num_leaves + len(leaves)] = leaves
+        level = self.num_leaves // 2
+        while level:
+            self.nodes[level : 2 * level] = (
+                self.nodes[2 * level : 4 * level : 2]
+                + self.nodes[2 * level + 1 : 4 * level : 2]
+            )
+            level //= 2
+
+
+def anneal_beta(beta, step, beta_steps):
+    """Importance sampling exponent of prioritized replay, annealed linearly from beta to 1 over beta_steps
+
+    :rtype: float
+    """
+    if beta_steps <= 0:
+        return 1.0
+    return min(1.0, beta + (1.0 - beta) * step / beta_steps)
+
+
+class ReplayMemory(object):
+    """Circular buffer of transitions backed by one preallocated tensor per field of Transition.
+
+    Storage is allocated on the first push, when the shapes of the fields are known, and grows geometrically up to
+    capacity so that a large capacity does not reserve memory that is never used.
+
+    :param capacity: maximum number of transitions, the oldest transitions are overwritten
+    :type capacity: int
+    :param dtype: dtype the transitions are stored in, batches are always returned as float32
+    :type dtype: torch.dtype
+    :param cat_dims: dimension of every field along which the transitions of a batch are concatenated
+    :type cat_dims: class:'Transition'
+    :param store: keep the transitions in the memory-mapped files of a store, allocates capacity at once
+    :type store: class:'MemmapStore'
+    """
+
+    num_pushed = 0  # transitions pushed since creation, class default for memories pickled without it
+    store = None
+    initial_size = 1024  # transitions allocated by the first push
+    priorities = None  # class:'SumTree' of enable_priorities
+
+    def __init__(
+        self,
+        capacity,
+        dtype=torch.float32,
+        cat_dims=Transition(0, 0, 0, 0, 0),
+        store=None,
+    ):
         self.capacity = capacity
-        self.memory = []
+        self.dtype = dtype
+        self.cat_dims = Transition(*cat_dims)
+        self.fields = None
+        self.size = 0
         self.position = 0
+        self.store = store
+        if store is not None:
+            store.memory = self
+
+    def _allocate(self, size, fields):
+        """Move the stored transitions into new tensors of size transitions, shaped like the fields of a transition"""
+        if self.store is not None:
+            # files are sparse, unused transitions do not take up space
+            storage = Transition(
+                *(
+                    self.store.tensor(
+                        name, (self.capacity,) + tuple(f.shape), self.dtype
+                    )
+                    for name, f in zip(Transition._fields, fields)
+                )
+            )
+            self.fields = storage
+            if self.priorities is not None:
+                self.priorities.grow(self.capacity)
+            return
+        storage = Transition(
+            *(torch.empty((size,) + tuple(f.shape), dtype=self.dtype) for f in fields)
+        )
+        if self.fields is not None:
+            for new, old in zip(storage, self.fields):
+                new[: self.size] = old[: self.size]
+        self.fields = storage
+        if self.priorities is not None:
+            self.priorities.grow(size)
+
+    def _locked(self):
+        """Lock of the store, held while transitions or priorities are read or written since online agents push from
+        other threads while the offline agent samples. A memory without a store is used by a single thread
+
+        :rtype: context manager
+        """
+        return self.store.lock if self.store is not None else nullcontext()
+
+    def push(self, *args, producer=None):
+        with self._locked():
+            if self.fields is None:
+                self._allocate(min(self.capacity, self.initial_size), args)
+            elif self.position == len(self.fields.state) < self.capacity:
+                self._allocate(min(self.capacity, 2 * self.position), args)
+            for storage, value in zip(self.fields, args):
+                storage[self.position] = torch.as_tensor(value)
+            if self.priorities is not None:
+                self.priorities.set(self.position, self.priorities.max_priority)
+            self.position = (self.position + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+            self.num_pushed += 1
+
+    def sample(self, batch_size):
+        """Draw batch_size different transitions
+
+        :return: batch with every field concatenated along its dimension in cat_dims, equal to
+            Transition(*(torch.cat(field, dim) for field in zip(*transitions)))
+        :rtype: class:'Transition'
+        """
+        with self._locked():
+            return self._gather(
+                torch.tensor(random.sample(range(self.size), batch_size))
+            )
+
+    def _gather(self, positions):
+        return Transition(
+            *(
+                self._concatenate(storage[positions], dim)
+                for storage, dim in zip(self.fields, self.cat_dims)
+            )
+        )
+
+    def enable_priorities(self, alpha, eps=1e-3):
+        """Sample transitions proportional to their priority (|td error| + eps)^alpha instead of uniformly, see
+        sample_prioritized. Stored transitions start with the same priority.
+
+        :param alpha: how strongly priorities skew the sampling, 0 is uniform
+        :type alpha: float
+        :param eps: keeps transitions with a td error of zero from never being sampled again
+        :type eps: float
+        """
+        self.priority_alpha = alpha
+        self.priority_eps = eps
+        with self._locked():
+            self.priorities = SumTree(
+                len(self.fields.state) if self.fields is not None else 1
+            )
+            if self.size:
+                self.priorities.update(np.arange(self.size), 1.0)
+
+    def sample_prioritized(self, batch_size, beta):
+        """Draw batch_size transitions proportional to their priority, one from each of batch_size equal segments of
+        the total priority
+
+        :param beta: exponent of the importance sampling weights, 1 fully compensates the non-uniform sampling
+        :type beta: float
+        :return: batch as returned by sample, positions of the transitions for update_priorities and the importance
+            sampling weights of the transitions, normalized to a maximum of 1
+        :rtype: class:'Transition', numpy.ndarray, torch.Tensor
+        """
+        with self._locked():
+            tree = self.priorities
+            values = (np.arange(batch_size) + np.random.random(batch_size)) * (
+                tree.total / batch_size
+            )
+            positions = tree.find(values)
+            weights = (self.size * tree.leaves(positions) / tree.total) ** -beta
+            batch = self._gather(torch.as_tensor(positions))
+        weights = torch.as_tensor(weights / weights.max(), dtype=torch.float32)
+        return batch, positions, weights
+
+    def update_priorities(self, positions, td_errors):
+        """Set the priorities of sampled transitions from their new td errors
+
+        :param positions: positions returned by sample_prioritized
+        :type positions: numpy.ndarray
+        :param td_errors: td error of every transition
+        :type td_errors: torch.Tensor
+        """
+        td_errors = torch.as_tensor(td_errors).detach().reshape(-1).cpu().numpy()
+        priorities = (np.abs(td_errors) + self.priority_eps) ** self.priority_alpha
+        positions = np.asarray(positions)
+        with self._locked():
+            # transitions dropped since they were sampled keep their priority of 0
+            stored = self._stored(positions)
+            if np.any(stored):
+                self.priorities.update(positions[stored], priorities[stored])
+            self.priorities.max_priority = max(
+                self.priorities.max_priority, priorities.max()
+            )
+
+    def _stored(self, positions):
+        """Whether positions hold a transition"""
+        return positions < self.size
+
+    @staticmethod
+    def _concatenate(rows, dim):
+        """Turn stacked transitions of shape (batch, *shape) into their concatenation along dim"""
+        shape = list(rows.shape[1:])
+        shape[dim] *= rows.shape[0]
+        return rows.movedim(0, dim).reshape(shape).to(torch.float32)
+
+    def __len__(self):
+        return self.size
+
+    def transitions(self):
+        """Iterate over the stored transitions, oldest first"""
+        start = self.position if self.size == self.capacity else 0
+        for i in range(self.size):
+            position = (start + i) % self.capacity
+            yield Transition(*(field[position] for field in self.fields))
+
+    def extend(self, memory):
+        """Push all transitions of another replay memory, oldest first"""
+        for transition in memory.transitions():
+            self.push(*transition)
+
+    def meta(self):
+        """Everything but the tensors, as stored in the meta.json of a MemmapStore"""
+        return {
+            "type": "ReplayMemory",
+            "capacity": self.capacity,
+            "dtype": str(self.dtype).replace("torch.", ""),
+            "cat_dims": list(self.cat_dims),
+            "allocated": self.fields is not None,
+            "size": self.size,
+            "position": self.position,
+            "num_pushed": self.num_pushed,
+        }
+
+    @classmethod
+    def attach(cls, store, meta):
+        """Continue with the transitions of a MemmapStore"""
+        memory = cls(
+            meta["capacity"],
+            dtype=getattr(torch, meta["dtype"]),
+            cat_dims=Transition(*meta["cat_dims"]),
+            store=store,
+        )
+        if meta["allocated"]:
+            memory.fields = Transition(
+                *(store.open(name) for name in Transition._fields)
+            )
+            memory.size = meta["size"]
+            memory.position = meta["position"]
+            memory.num_pushed = meta["num_pushed"]
+        return memory
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("priorities", None)  # rebuilt by enable_priorities
+        state["store"] = None
+        if self.fields is not None:
+            # only the stored transitions, not the unused part of the allocation
+            state["fields"] = Transition(*(f[: self.size].clone() for f in self.fields))
+        return state
 
-    def push(self, *args):
-        if len(self.memory) < self.capacity:
-            self.memory.append(None)
-        self.memory[self.position] = Transition(*args)
-        self.position = (self.position + 1) % self.capacity
+    def __setstate__(self, state):
+        if "memory" in state:
+            # memory pickled as a list of transitions before the tensor storage
+            transitions = state["memory"]
+            self.__init__(state["capacity"])
+            for transition in (
+                transitions[state["position"] :] + transitions[: state["position"]]
+            ):
+                self.push(*transition)
+        else:
+            self.__dict__.update(state)
+
+
+class FrameReplayMemory(object):
+    """Replay memory for transitions whose states are sliding windows over the last k observations.
+
+    Consecutive states of an episode share all but one observation, so every observation (frame) is stored once in a
+    circular frame store and transitions only keep the positions of the k + 1 frames of their state and next state.
+    The state and next state windows are gathered from the frames when sampling. The online agents of concurrent
+    connections push their transitions interleaved, so the memory keeps the last next state of every producer. A
+    transition whose state continues the last next state of its producer only stores its newest frame, any other
+    transition starts a new episode and stores all frames of its state.
+
+    Frames are overwritten in the order they were pushed. A window reuses frames of its producer only while at most
+    max_gap frames of other producers were pushed in between, and a transition is dropped once a frame it may use could
+    have been overwritten. Every new episode stores k - 1 additional frames, so slightly fewer than capacity
+    transitions may be available.
+
+    :param capacity: maximum number of transitions
+    :type capacity: int
+    :param dtype: dtype the frames and transitions are stored in, batches are always returned as float32
+    :type dtype: torch.dtype
+    :param store: keep frames and transitions in the memory-mapped files of a store
+    :type store: class:'MemmapStore'
+    :param max_gap: frames other producers may push between two transitions of an episode without its frames being
+        stored again
+    :type max_gap: int
+    """
+
+    num_pushed = 0
+    store = None
+    priorities = None  # class:'SumTree' of enable_priorities
+    max_gap = 256
+
+    def __init__(self, capacity, dtype=torch.float32, store=None, max_gap=256):
+        self.capacity = capacity
+        self.dtype = dtype
+        self.max_gap = max_gap
+        self.frames = None
+        self.num_frames = 0  # frames pushed since creation
+        self.fields = None
+        self.size = 0
+        self.start = 0  # position of the oldest transition
+        # last next state of every producer and the frames of its window
+        self.last_windows = {}
+        self.store = store
+        if store is not None:
+            store.memory = self
+
+    def _empty(self, name, shape, dtype):
+        if self.store is not None:
+            return self.store.tensor(name, shape, dtype)
+        return torch.empty(shape, dtype=dtype)
+
+    def _allocate(self, state, action, mask, reward):
+        num_features, self.k = state.shape[0], state.shape[2]
+        self.frame_capacity = self.capacity + self.k + self.max_gap
+        self.frames = self._empty(
+            "frames", (self.frame_capacity, num_features), self.dtype
+        )
+        self.frame_index = self._empty(
+            "frame_index", (self.capacity, self.k + 1), torch.int64
+        )
+        self.fields = Transition(
+            state=None,
+            action=self._empty(
+                "action", (self.capacity,) + tuple(action.shape), self.dtype
+            ),
+            mask=self._empty("mask", (self.capacity,) + tuple(mask.shape), self.dtype),
+            next_state=None,
+            reward=self._empty(
+                "reward", (self.capacity,) + tuple(reward.shape), self.dtype
+            ),
+        )
+
+    def _push_frames(self, frames):
+        """Append frames of shape (n, num_features) and drop the transitions that may have lost a frame
+
+        :return: numbers of the pushed frames
+        :rtype: torch.Tensor
+        """
+        index = torch.arange(self.num_frames, self.num_frames + len(frames))
+        self.frames[index % self.frame_capacity] = frames.to(self.dtype)
+        self.num_frames += len(frames)
+        oldest_frame = self.num_frames - self.frame_capacity
+        # the newest frames of the transitions grow with their position, a transition never uses a frame older than
+        # k + max_gap frames before its newest one
+        while (
+            self.size > 0
+            and self.frame_index[self.start, -1].item() - self.k - self.max_gap
+            < oldest_frame
+        ):
+            if self.priorities is not None:
+                self.priorities.set(self.start, 0.0)
+            self.start = (self.start + 1) % self.capacity
+            self.size -= 1
+        return index
+
+    def push(self, state, action, mask, next_state, reward, producer=None):
+        """Store a transition
+
+        :param state: window of shape (num_features, 1, k, 1)
+        :type state: torch.Tensor
+        :param next_state: window of shape (num_features, 1, k, 1), the state shifted by one observation
+        :type next_state: torch.Tensor
+        :param producer: id of the online agent or connection that pushes the transition
+        :type producer: hashable
+        """
+        with self._locked():
+            if self.frames is None:
+                self._allocate(state, action, mask, reward)
+            state = state.reshape(state.shape[0], -1)
+            next_state = next_state.reshape(next_state.shape[0], -1)
+            last_state, window = self.last_windows.get(producer, (None, None))
+            if (
+                last_state is None
+                or window[0].item() < self.num_frames - self.k - self.max_gap
+                or not torch.equal(state, last_state)
+            ):
+                window = self._push_frames(state.t())
+            if self.size == self.capacity:
+                self.start = (self.start + 1) % self.capacity
+                self.size -= 1
+            position = (self.start + self.size) % self.capacity
+            # written before the frame is pushed, the transition is dropped like the others if that overwrites a frame
+            self.frame_index[position, :-1] = window
+            self.frame_index[position, -1] = self.num_frames
+            self.fields.action[position] = action
+            self.fields.mask[position] = mask
+            self.fields.reward[position] = reward
+            if self.priorities is not None:
+                self.priorities.set(position, self.priorities.max_priority)
+            self.size += 1
+            self.num_pushed += 1
+            self._push_frames(next_state[:, -1:].t())
+            if producer not in self.last_windows:
+                # producers that are gone, e.g. the agent of a finished connection, would otherwise stay forever
+                self.last_windows = {
+                    other: (last, frames)
+                    for other, (last, frames) in self.last_windows.items()
+                    if frames[0].item() >= self.num_frames - self.k - self.max_gap
+                }
+            self.last_windows[producer] = (
+                next_state.clone(),
+                self.frame_index[position, 1:].clone(),
+            )
+
+    def _windows(self, index):
+        """States of shape (num_features, batch, k, 1) of the frames of shape (batch, k)"""
+        windows = self.frames[index % self.frame_capacity]  # (batch, k, num_features)
+        return windows.permute(2, 0, 1).unsqueeze(-1).to(torch.float32)
 
     def sample(self, batch_size):
-        result = random.sample(self.memory, batch_size)
-        return result
+        """Draw batch_size different transitions
+
+        :return: batch with states concatenated along dim 1 and all other fields along dim 0,
+            the layout of ReplayMemory.sample with cat_dims Transition(1, 0, 0, 1, 0)
+        :rtype: class:'Transition'
+        """
+        with self._locked():
+            index = torch.tensor(random.sample(range(self.size), batch_size))
+            return self._gather((self.start + index) % self.capacity)
+
+    def _gather(self, positions):
+        index = self.frame_index[positions]
+        return Transition(
+            state=self._windows(index[:, :-1]),
+            action=self.fields.action[positions]
+            .reshape(len(positions), -1)
+            .to(torch.float32),
+            mask=self.fields.mask[positions].reshape(-1).to(torch.float32),
+            next_state=self._windows(index[:, 1:]),
+            reward=self.fields.reward[positions].reshape(-1).to(torch.float32),
+        )
+
+    def enable_priorities(self, alpha, eps=1e-3):
+        """Sample transitions proportional to their priority, see ReplayMemory.enable_priorities"""
+        self.priority_alpha = alpha
+        self.priority_eps = eps
+        with self._locked():
+            self.priorities = SumTree(self.capacity)
+            if self.size:
+                self.priorities.update(
+                    (self.start + np.arange(self.size)) % self.capacity, 1.0
+                )
+
+    _locked = ReplayMemory._locked
+    sample_prioritized = ReplayMemory.sample_prioritized
+    update_priorities = ReplayMemory.update_priorities
+
+    def _stored(self, positions):
+        """Whether positions hold a transition"""
+        return (positions - self.start) % self.capacity < self.size
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
+
+    def transitions(self):
+        """Iterate over the stored transitions, oldest first"""
+        for i in range(self.size):
+            position = (self.start + i) % self.capacity
+            index = self.frame_index[position : position + 1]
+            yield Transition(
+                state=self._windows(index[:, :-1]),
+                action=self.fields.action[position],
+                mask=self.fields.mask[position],
+                next_state=self._windows(index[:, 1:]),
+                reward=self.fields.reward[position],
+            )
+
+    def extend(self, memory):
+        """Push all transitions of another replay memory with the transition layout of ReLeS, oldest first"""
+        for transition in memory.transitions():
+            self.push(*transition)
+
+    def meta(self):
+        """Everything but the tensors, as stored in the meta.json of a MemmapStore"""
+        meta = {
+            "type": "FrameReplayMemory",
+            "capacity": self.capacity,
+            "dtype": str(self.dtype).replace("torch.", ""),
+            "allocated": self.frames is not None,
+            "num_frames": self.num_frames,
+            "size": self.size,
+            "start": self.start,
+            "num_pushed": self.num_pushed,
+            "max_gap": self.max_gap,
+        }
+        if self.frames is not None:
+            meta["k"] = self.k
+            meta["frame_capacity"] = self.frame_capacity
+        return meta
+
+    @classmethod
+    def attach(cls, store, meta):
+        """Continue with the frames and transitions of a MemmapStore. The next push starts a new episode"""
+        memory = cls(
+            meta["capacity"],
+            dtype=getattr(torch, meta["dtype"]),
+            store=store,
+            max_gap=meta.get("max_gap", cls.max_gap),
+        )
+        if meta["allocated"]:
+            memory.k = meta["k"]
+            memory.frame_capacity = meta["frame_capacity"]
+            memory.frames = store.open("frames")
+            memory.fields = Transition(
+                state=None,
+                action=store.open("action"),
+                mask=store.open("mask"),
+                next_state=None,
+                reward=store.open("reward"),
+            )
+            memory.num_frames = meta["num_frames"]
+            memory.size = meta["size"]
+            memory.start = meta["start"]
+            memory.num_pushed = meta["num_pushed"]
+            if "max_gap" in meta:
+                memory.frame_index = store.open("frame_index")
+            else:
+                memory._convert_newest_frame(store.open("newest_frame"))
+                store.remove("newest_frame")
+        return memory
+
+    def _convert_newest_frame(self, newest_frame):
+        """Take over the transitions of a memory of earlier versions, which only kept the newest frame of every state
+        and had no room for frames of other producers in its frame store"""
+        frames = self.frames.clone()
+        self.frame_capacity = self.capacity + self.k + self.max_gap
+        self.frames = self._empty(
+            "frames", (self.frame_capacity,) + tuple(frames.shape[1:]), self.dtype
+        )
+        index = torch.arange(max(self.num_frames - len(frames), 0), self.num_frames)
+        self.frames[index % self.frame_capacity] = frames[index % len(frames)]
+        self.frame_index = self._empty(
+            "frame_index", (self.capacity, self.k + 1), torch.int64
+        )
+        self.frame_index[:] = newest_frame.unsqueeze(1) + torch.arange(-self.k + 1, 2)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("priorities", None)  # rebuilt by enable_priorities
+        state["store"] = None
+        state["last_windows"] = {}
+        return state
+
+    def __setstate__(self, state):
+        newest_frame = state.pop("newest_frame", None)
+        state.pop("last_next_state", None)
+        self.__dict__.update(state)
+        self.last_windows = {}
+        if newest_frame is not None:
+            # pickled by earlier versions
+            self.max_gap = 0
+            self.frame_index = newest_frame.unsqueeze(1) + torch.arange(-self.k + 1, 2)
+
+
+class MemmapStore(object):
+    """Directory that keeps the tensors of a replay memory in memory-mapped .npy files and its remaining state in
+    meta.json. Pushed transitions are written straight into the mapped files. flush writes them to disk and records
+    how many transitions are valid, so a restart attaches to the files instead of loading the whole memory and a
+    crash only loses the transitions pushed since the last flush.
+
+    :param directory: directory of the store, created if it does not exist
+    :type directory: str
+    """
+
+    memory_types = {
+        "ReplayMemory": ReplayMemory,
+        "FrameReplayMemory": FrameReplayMemory,
+    }
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.meta_file = self.directory / "meta.json"
+        self.arrays = {}
+        self.memory = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def exists(self):
+        """Whether the directory holds a flushed replay memory"""
+        return self.meta_file.exists()
+
+    def tensor(self, name, shape, dtype):
+        """Create a memory-mapped tensor, replaces an existing file of the same name"""
+        array = np.lib.format.open_memmap(
+            self.directory / (name + ".npy"),
+            mode="w+",
+            dtype=torch.empty(0, dtype=dtype).numpy().dtype,
+            shape=tuple(shape),
+        )
+        self.arrays[name] = array
+        return torch.from_numpy(array)
+
+    def open(self, name):
+        """Map the tensor of an existing file"""
+        array = np.lib.format.open_memmap(self.directory / (name + ".npy"), mode="r+")
+        self.arrays[name] = array
+        return torch.from_numpy(array)
+
+    def remove(self, name):
+        """Delete the file of a tensor that is no longer used"""
+        self.arrays.pop(name, None)
+        os.remove(self.directory / (name + ".npy"))
+
+    def load(self):
+        """Attach to the replay memory of the directory
+
+        :rtype: class:'ReplayMemory' or class:'FrameReplayMemory'
+        """
+        with open(self.meta_file) as f:
+            meta = json.load(f)
+        return self.memory_types[meta["type"]].attach(self, meta)
+
+    def flush(self):
+        """Write the mapped files to disk, then replace meta.json atomically"""
+        if self.memory is None:
+            return
+        with self.flush_lock:
+            with self.lock:  # pushes hold the lock, the snapshot is consistent
+                meta = self.memory.meta()
+                arrays = list(self.arrays.values())
+            # taken before the files are written, so it never counts a transition that is not on disk yet
+            for array in arrays:
+                array.flush()
+            tmp = self.meta_file.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(meta, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.meta_file)
+
+    def flush_periodically(self, interval):
+        """Flush every interval seconds in a daemon thread
+
+        :param interval: seconds between two flushes
+        :type interval: float
+        """
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Failed to flush replay memory: {e}")
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
@@ -3,25 +3,60 @@ import pathlib
 import threading
 import time
 
+import mpsched_backend as mpsched
 import numpy as np
-import reles_ext_mpsched as mpsched
 import torch
+from action_cache import create_action_cache
+from checkpoint import load_agent, save_agent
+from decision_clock import create_clock
 from env_ext import Env
 
 # from env import Env
 from naf_lstm import NAF_LSTM
 from ounoise import OUNoise
 from replay_memory import ReplayMemory, Transition
+from telemetry import create_telemetry
 from torch.autograd import Variable
 
 CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
 TMP_DIR = CURRENT_DIR / "artifacts"
 
 
+def set_torch_threads(num_threads):
+    """Set the torch intra-op threads of the calling process. The setting is process wide, every thread of the
+    process reads back the value set last, so it is set once per process and not per online or offline agent
+
+    :param num_threads: torch intra-op threads, torch default if 0
+    :type num_threads: int
+    """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+
+def inference_cores(cfg):
+    """Cores the online agents are pinned to, see the [inference] section of config.ini
+
+    :return: cores, empty for all cores
+    :rtype: list
+    """
+    return [int(core) for core in cfg.get("inference", "cores").split(",") if core]
+
+
+def pin_thread(cores):
+    """Pin the calling thread to cores, so that the decisions do not compete with the threads sending the data.
+    Affinity is per thread on Linux, the rest of the process is not pinned
+
+    :param cores: cores the thread runs on, all if empty
+    :type cores: list
+    """
+    if cores:
+        os.sched_setaffinity(0, cores)
+
+
 class Online_Agent(threading.Thread):
     """Class for Online Agent thread that calls evnironment step to perform agent<->enviornment interaction as expected in reinforcement
     learning. Adjusts the split factor using the policy network of the ReLes NN after every SI until the end of the MPTCP connection
-    At the start of every MPTCP connection synchronize ReLes NN (NAF+stacked LSTM) with the "offline agent" using torch.load
+    At the start of every MPTCP connection synchronize ReLes NN (NAF+stacked LSTM) with the "offline agent" using its checkpoint
     Saves collected experience in replay buffer for the offline agent to use for training
 
     :param fd: socket file descriptor
@@ -46,7 +81,7 @@ class Online_Agent(threading.Thread):
         self.ounoise = OUNoise(action_dimension=1)
         self.explore = explore
         self.max_flows = cfg.getint("env", "max_num_subflows")
-        self.agent = torch.load(self.agent_name)
+        self.agent = load_agent(self.agent_name)
         mpsched.persist_state(fd)
         self.env = Env(
             fd=self.fd,
@@ -56,22 +91,35 @@ class Online_Agent(threading.Thread):
             b=self.cfg.getfloat("env", "b"),
             c=self.cfg.getfloat("env", "c"),
             max_flows=self.max_flows,
+            clock=create_clock(self.cfg),
         )
+        self.telemetry = create_telemetry(cfg, TMP_DIR)
+        self.action_cache = create_action_cache(cfg)
+        self.inference = cfg.get("inference", "model")
+        self.cores = inference_cores(cfg)
         self.event = event
 
     def run(self):
         """Override the run method from threading with the desired behaviour of the Online Agent class"""
+        pin_thread(self.cores)
+        # in the agent thread, the request handler does not wait for the copy
+        if self.inference != "training":
+            self.agent.prepare_inference(quantize=self.inference == "int8")
         if True:
             self.event.wait()
+            if self.telemetry is not None:
+                self.env.telemetry = self.telemetry.start(self.fd)
             state = self.env.reset()
             # print(*(np.array(state)[self.max_flows : self.max_flows * 2, 7]))
-            state = torch.FloatTensor(state).view(-1, 1, 8, 1)
+            state = torch.as_tensor(state, dtype=torch.float32).view(-1, 1, 8, 1)
             while True:
                 start = time.time()
                 if self.explore:
-                    action = self.agent.select_action(state, self.ounoise)
+                    action = self.agent.select_action(
+                        state, self.ounoise, self.action_cache
+                    )
                 else:
-                    action = self.agent.select_action(state)
+                    action = self.agent.select_action(state, cache=self.action_cache)
                 end = time.time()
                 # print(action)
                 # print(end - start)
@@ -82,10 +130,19 @@ class Online_Agent(threading.Thread):
                 # print(*(np.array(state_nxt)[self.max_flows : self.max_flows * 2, 7]))
                 action = torch.FloatTensor(action)
                 mask = torch.Tensor([not done])
-                state_nxt = torch.FloatTensor(state_nxt).view(-1, 1, 8, 1)
+                state_nxt = torch.as_tensor(state_nxt, dtype=torch.float32).view(
+                    -1, 1, 8, 1
+                )
                 reward = torch.FloatTensor([float(reward)])
-                self.memory.push(state, action, mask, state_nxt, reward)
+                self.memory.push(
+                    state, action, mask, state_nxt, reward, producer=self.name
+                )
                 state = state_nxt
+            print(f"decision clock: {self.env.clock.summary()}")
+            if self.action_cache is not None:
+                print(f"action cache: {self.action_cache.summary()}")
+            if self.telemetry is not None:
+                self.telemetry.stop()
 
     def update_fd(self, fd):
         """Update the current file descriptor used in the Environment Class for reading information from subflows with socket options"""
@@ -96,7 +153,7 @@ class Offline_Agent(threading.Thread):
     """Class for Offline Agent that is solely resposible for training the ReLes neural network on already collected
     experience saved in the replay buffer.
 
-    :param nn: path to pkl file to save updated NN parameters
+    :param nn: checkpoint file to save updated NN parameters
     :type nn: string
     :param cfg: contains all the neccessary training parameter read from config.ini
     :type cfg: configParser
@@ -118,20 +175,19 @@ class Offline_Agent(threading.Thread):
 
     def run(self):
         """Starts the training loop for the ReLes NN. Start of an episode is at the beggining of a new MPTCP connection and the end
-        is defined at the tear down of said MPTCP connection.Saves updated model in pkl file using torch save for the online agent
+        is defined at the tear down of said MPTCP connection.Saves updated model in a checkpoint for the online agent
         to read and update its paramters.
         """
         # subject to change
-        agent = torch.load(self.model)
+        agent = load_agent(self.model)
         print("start offline agent")
         while True:
             self.event.wait(timeout=60)
             if len(self.memory) > self.batch_size:
                 # print("enough memory available")
                 for __ in range(1):
-                    transitions = self.memory.sample(self.batch_size)
-                    batch = Transition(*zip(*transitions))
+                    batch = self.memory.sample(self.batch_size)
                     # print(agent.update_parameters(batch))
                     if not self.event.is_set():
-                        torch.save(agent, self.model)
+                        save_agent(self.model, agent)
                         break
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+# Compares latency and actions of the ReLeS NN with its float and int8 inference copies (naf_lstm.InferencePolicy)
+
+import argparse
+import pathlib
+import time
+from configparser import ConfigParser
+
+import numpy as np
+import torch
+from checkpoint import load_agent
+from naf_lstm import NAF_LSTM, InferencePolicy
+
+CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
+
+
+def training_decision(agent, state):
+    """Action as taken by the online agent with the model itself"""
+    agent.model.eval()
+    with torch.no_grad():
+        mu, _, _ = agent.model((state, None))
+    agent.model.train()
+    return mu
+
+
+def measure(decide, states, repeat):
+    """Time single state decisions
+
+    :return: median and 99th percentile latency in microseconds and the actions of the first pass
+    :rtype: float, float, torch.Tensor
+    """
+    with torch.no_grad():
+        actions = torch.cat([decide(state) for state in states])
+        latencies = np.empty(repeat * len(states))
+        n = 0
+        for _ in range(repeat):
+            for state in states:
+                start = time.perf_counter()
+                decide(state)
+                latencies[n] = time.perf_counter() - start
+                n += 1
+    latencies *= 1e6
+    return np.median(latencies), np.percentile(latencies, 99), actions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the decision latency and accuracy of the ReLeS NN inference copies"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="Checkpoint of the ReLeS NN to benchmark, untrained network if omitted",
+    )
+    parser.add_argument(
+        "--states", type=int, default=500, help="Number of random states"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Passes over the random states"
+    )
+    parser.add_argument("--threads", type=int, default=1, help="Torch intra-op threads")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random states")
+    args = parser.parse_args()
+
+    cfg = ConfigParser()
+    cfg.read(CURRENT_DIR / "config.ini")
+    max_flows = cfg.getint("env", "max_num_subflows")
+    k = cfg.getint("env", "k")
+
+    torch.set_num_threads(args.threads)
+    if args.checkpoint:
+        agent = load_agent(args.checkpoint)
+    else:
+        torch.manual_seed(args.seed)
+        agent = NAF_LSTM(
+            gamma=cfg.getfloat("nafcnn", "gamma"),
+            tau=cfg.getfloat("nafcnn", "tau"),
+            hidden_size=cfg.getint("nafcnn", "hidden_size"),
+            num_inputs=k * max_flows * 5,
+            action_space=max_flows,
+        )
+
+    # throughput (segments), rtt (ms), cwnd, unacked and retransmissions of every path over the last k measurements
+    rng = np.random.default_rng(args.seed)
+    scale = np.repeat([500.0, 100.0, 100.0, 100.0, 5.0], max_flows)
+    states = [
+        torch.as_tensor(
+            rng.uniform(0, 1, (5 * max_flows, k)) * scale[:, None],
+            dtype=torch.float32,
+        ).view(-1, 1, k, 1)
+        for _ in range(args.states)
+    ]
+
+    print(
+        f"{args.states} states, {args.repeat} passes, {torch.get_num_threads()} threads, "
+        f"quantized engine {torch.backends.quantized.engine}"
+    )
+    print(
+        f"{'model':<10}{'median [us]':>14}{'p99 [us]':>12}{'max drift':>12}{'mean drift':>12}"
+    )
+    reference = None
+    for name, decide in (
+        ("training", lambda state: training_decision(agent, state)),
+        ("float", InferencePolicy(agent.model, quantize=False)),
+        ("int8", InferencePolicy(agent.model, quantize=True)),
+    ):
+        median, p99, actions = measure(decide, states, args.repeat)
+        if reference is None:
+            reference = actions
+        drift = (actions - reference).abs()
+        print(
+            f"{name:<10}{median:>14.1f}{p99:>12.1f}{drift.max().item():>12.2e}{drift.mean().item():>12.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
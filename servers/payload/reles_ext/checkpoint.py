@@ -0,0 +1,325 @@
+"""Checkpoints of the ReLeS NN that hold tensors only
+
+A checkpoint stores the state_dicts of model, target model and optimizer of a
+NAF_LSTM as raw arrays, no pickled objects, so that moving or changing the
+classes does not break old checkpoints. The file starts with a fixed header
+and a JSON description of the agent and of every tensor, followed by the data
+of the tensors, each aligned to ALIGNMENT bytes. Loading maps the file into
+memory and creates the tensors as views into it. The header holds the sha256
+of the data, which is checked on load. Checkpoints are written to a temporary
+file that is renamed over the old one, a reader sees either the old or the new
+checkpoint and never needs a lock.
+
+Trained models are kept as numbered versions in a registry, see ModelRegistry.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+import numpy as np
+import torch
+from naf_lstm import NAF_LSTM
+
+# magic and length of the JSON header
+CHECKPOINT_MAGIC = b"RLCKPT01"
+CHECKPOINT_HEADER = struct.Struct("<8sQ")
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save_checkpoint(path, tensors, meta=None):
+    """Write tensors atomically into a checkpoint file
+
+    :param path: checkpoint file
+    :type path: str
+    :param tensors: tensors by name
+    :type tensors: dict
+    :param meta: values that can be stored as JSON, returned again by load_checkpoint
+    :type meta: dict
+    :return: sha256 of the data of the tensors
+    :rtype: str
+    """
+    arrays = {
+        name: tensor.detach().cpu().contiguous().numpy()
+        for name, tensor in tensors.items()
+    }
+    entries = []
+    offset = 0
+    digest = hashlib.sha256()
+    for name, array in arrays.items():
+        offset = _align(offset)
+        entries.append(
+            {
+                "name": name,
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                "offset": offset,
+            }
+        )
+        digest.update(array.tobytes())
+        offset += array.nbytes
+    header = json.dumps(
+        {"meta": meta or {}, "tensors": entries, "sha256": digest.hexdigest()}
+    ).encode()
+    start = _align(CHECKPOINT_HEADER.size + len(header))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".checkpoint-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, len(header)))
+            f.write(header)
+            for entry, array in zip(entries, arrays.values()):
+                f.seek(start + entry["offset"])
+                f.write(array.tobytes())
+            f.truncate(start + offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return digest.hexdigest()
+
+
+def read_header(path):
+    """Description of a checkpoint without its data
+
+    :return: meta values, tensors with name, dtype, shape and offset, sha256 of the data and offset of the data
+    :rtype: dict
+    """
+    with open(path, "rb") as f:
+        magic, length = CHECKPOINT_HEADER.unpack(f.read(CHECKPOINT_HEADER.size))
+        if magic != CHECKPOINT_MAGIC:
+            raise ValueError(f"{path} is not a checkpoint")
+        header = json.loads(f.read(length))
+    header["start"] = _align(CHECKPOINT_HEADER.size + length)
+    return header
+
+
+def load_checkpoint(path, verify=True):
+    """Map a checkpoint into memory
+
+    :param path: checkpoint file
+    :type path: str
+    :param verify: compare the data with the sha256 of the header
+    :type verify: bool
+    :return: tensors by name, views into the mapped file that are copied on write, and the meta values
+    :rtype: dict, dict
+    """
+    header = read_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=header["start"])
+    arrays = {}
+    digest = hashlib.sha256()
+    for entry in header["tensors"]:
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"]))
+        raw = data[entry["offset"] : entry["offset"] + count * dtype.itemsize]
+        if verify:
+            digest.update(raw)
+        arrays[entry["name"]] = raw.view(dtype).reshape(entry["shape"])
+    if verify and digest.hexdigest() != header["sha256"]:
+        raise ValueError(f"{path} is corrupted, sha256 does not match")
+    tensors = {name: torch.from_numpy(array) for name, array in arrays.items()}
+    return tensors, header["meta"]
+
+
+def _flatten(prefix, state_dict, tensors):
+    """Move the tensors of a (nested) state_dict into tensors, the rest is returned for the JSON header"""
+    rest = {}
+    for key, value in state_dict.items():
+        name = f"{prefix}.{key}"
+        if isinstance(value, torch.Tensor):
+            tensors[name] = value
+        elif isinstance(value, dict):
+            rest[str(key)] = _flatten(name, value, tensors)
+        else:
+            rest[str(key)] = value
+    return rest
+
+
+def _unflatten(prefix, rest, tensors):
+    state_dict = {}
+    for key, value in rest.items():
+        name = f"{prefix}.{key}"
+        state_dict[key] = (
+            _unflatten(name, value, tensors) if isinstance(value, dict) else value
+        )
+    for name, tensor in tensors.items():
+        if name.startswith(prefix + ".") and "." not in name[len(prefix) + 1 :]:
+            state_dict[name[len(prefix) + 1 :]] = tensor
+    return state_dict
+
+
+def save_agent(path, agent):
+    """Checkpoint of a ReLeS NN with model, target model and optimizer
+
+    :param path: checkpoint file
+    :type path: str
+    :param agent: ReLeS NN
+    :type agent: class:'naf_lstm.NAF_LSTM'
+    :return: sha256 of the data of the tensors
+    :rtype: str
+    """
+    tensors = {}
+    for prefix, module in (("model", agent.model), ("target", agent.target_model)):
+        for key, value in module.state_dict().items():
+            tensors[f"{prefix}.{key}"] = value
+    optimizer = agent.optimizer.state_dict()
+    meta = {
+        "agent": "NAF_LSTM",
+        "gamma": agent.gamma,
+        "tau": agent.tau,
+        "hidden_size": agent.model.hidden_size,
+        "num_inputs": agent.num_inputs,
+        "action_space": agent.action_space,
+        "param_groups": optimizer["param_groups"],
+        "optimizer_state": _flatten("optimizer", optimizer["state"], tensors),
+    }
+    return save_checkpoint(path, tensors, meta)
+
+
+def load_agent(path, verify=True):
+    """ReLeS NN of a checkpoint written by save_agent
+
+    :param path: checkpoint file
+    :type path: str
+    :param verify: compare the data with the sha256 of the header
+    :type verify: bool
+    :rtype: class:'naf_lstm.NAF_LSTM'
+    """
+    tensors, meta = load_checkpoint(path, verify)
+    if meta.get("agent") != "NAF_LSTM":
+        raise ValueError(f"{path} does not hold a ReLeS NN")
+    agent = NAF_LSTM(
+        gamma=meta["gamma"],
+        tau=meta["tau"],
+        hidden_size=meta["hidden_size"],
+        num_inputs=meta["num_inputs"],
+        action_space=meta["action_space"],
+    )
+    # load_state_dict copies the parameters out of the mapped file
+    for prefix, module in (("model", agent.model), ("target", agent.target_model)):
+        module.load_state_dict(
+            {
+                name[len(prefix) + 1 :]: tensor
+                for name, tensor in tensors.items()
+                if name.startswith(prefix + ".")
+            }
+        )
+    state = _unflatten("optimizer", meta["optimizer_state"], tensors)
+    agent.optimizer.load_state_dict(
+        {
+            "state": {int(key): value for key, value in state.items()},
+            "param_groups": meta["param_groups"],
+        }
+    )
+    return agent
+
+
+class ModelRegistry(object):
+    """Numbered versions of trained models in a directory, described by registry.json
+
+    :param directory: directory of the registry, usually artifacts/trained_models
+    :type directory: str
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = os.path.join(directory, "registry.json")
+
+    def versions(self):
+        """Registered versions, oldest first
+
+        :return: version, file, sha256, creation time and further values of every version
+        :rtype: list
+        """
+        if not os.path.exists(self.index):
+            return []
+        with open(self.index) as f:
+            return json.load(f)
+
+    def get(self, version):
+        """Entry of a version, the latest one if version is None
+
+        :rtype: dict
+        """
+        versions = self.versions()
+        if not versions:
+            raise KeyError("No model versions registered")
+        if version is None:
+            return versions[-1]
+        for entry in versions:
+            if entry["version"] == version:
+                return entry
+        raise KeyError(f"Model version {version} is not registered")
+
+    def path(self, version=None):
+        """Checkpoint file of a version, the latest one if version is None
+
+        :rtype: str
+        """
+        return os.path.join(self.directory, self.get(version)["file"])
+
+    def register(self, path, **info):
+        """Add a checkpoint as a new version, the file is copied into the registry. A checkpoint equal to a registered
+        version is not added again
+
+        :param path: checkpoint file
+        :type path: str
+        :param info: further values stored with the version, e.g. the reason of registering it
+        :return: version of the checkpoint
+        :rtype: int
+        """
+        sha256 = read_header(path)["sha256"]
+        versions = self.versions()
+        for entry in versions:
+            if entry["sha256"] == sha256:
+                return entry["version"]
+        version = versions[-1]["version"] + 1 if versions else 1
+        name = f"agent-{version:04d}.ckpt"
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = os.path.join(self.directory, "." + name)
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, os.path.join(self.directory, name))
+        versions.append(
+            dict(
+                info,
+                version=version,
+                file=name,
+                sha256=sha256,
+                created=time.strftime("%Y-%m-%d %H:%M:%S"),
+            )
+        )
+        tmp = self.index + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(versions, f, indent=1)
+        os.replace(tmp, self.index)
+        return version
+
+    def restore(self, version, path):
+        """Copy a registered version to the checkpoint file of the agents, the checksum is verified first
+
+        :param version: registered version, the latest one if None
+        :type version: int
+        :param path: checkpoint file of the agents
+        :type path: str
+        :return: restored version
+        :rtype: int
+        """
+        entry = self.get(version)
+        source = os.path.join(self.directory, entry["file"])
+        load_checkpoint(source)
+        tmp = path + ".tmp"
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, path)
+        return entry["version"]
@@ -1,3 +1,4 @@
+import copy
 import sys
 import time
 
@@ -16,17 +17,25 @@ def MSELoss(input, target):
     return torch.sum((input - target) ** 2) / input.data.nelement()
 
 
+# parameters are updated in place outside of autograd (instead of through .data) so that their
+# version counters change and Policy notices that its fused LSTM weights are out of date
+@torch.no_grad()
 def soft_update(target, source, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
+    # one multi tensor kernel per operation instead of a python loop over all parameters
+    target_params = list(target.parameters())
+    torch._foreach_mul_(target_params, 1.0 - tau)
+    torch._foreach_add_(target_params, list(source.parameters()), alpha=tau)
 
 
+@torch.no_grad()
 def hard_update(target, source):
     for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(param.data)
+        target_param.copy_(param)
 
 
 class Policy(nn.Module):
+    num_lstm = 10  # one LSTM per feature stream
+
     def __init__(self, hidden_size, num_inputs, action_space):
         super(Policy, self).__init__()
         self.action_space = action_space
@@ -105,33 +114,23 @@ class Policy(nn.Module):
 
         x, u = inputs
 
-        self.h0 = torch.zeros(2, x.size(1), self.hidden_lstm)
-        self.c0 = torch.zeros(2, x.size(1), self.hidden_lstm)
         # lstm input 3D (samples,time steps,features)
         # in our case this would be (1,8,10)
         # or possibly (1,8,1) wiht 10 stacked LSTM using 3-D tensor
-        x1, _ = self.lstm0(x[0, :, :, :], (self.h0, self.c0))
-        x1 = x1[:, -1, :]
-        x2, _ = self.lstm1(x[1, :, :, :], (self.h0, self.c0))
-        x2 = x2[:, -1, :]
-        x3, _ = self.lstm2(x[2, :, :, :], (self.h0, self.c0))
-        x3 = x3[:, -1, :]
-        x4, _ = self.lstm3(x[3, :, :, :], (self.h0, self.c0))
-        x4 = x4[:, -1, :]
-        x5, _ = self.lstm4(x[4, :, :, :], (self.h0, self.c0))
-        x5 = x5[:, -1, :]
-        x6, _ = self.lstm5(x[5, :, :, :], (self.h0, self.c0))
-        x6 = x6[:, -1, :]
-        x7, _ = self.lstm6(x[6, :, :, :], (self.h0, self.c0))
-        x7 = x7[:, -1, :]
-        x8, _ = self.lstm7(x[7, :, :, :], (self.h0, self.c0))
-        x8 = x8[:, -1, :]
-        x9, _ = self.lstm8(x[8, :, :, :], (self.h0, self.c0))
-        x9 = x9[:, -1, :]
-        x10, _ = self.lstm9(x[9, :, :, :], (self.h0, self.c0))
-        x10 = x10[:, -1, :]
-
-        x = torch.cat([x1, x2, x3, x4, x5, x6, x7, x8, x9, x10], dim=-1)
+        # the 10 LSTMs run as one LSTM over all features, see fused_lstm_weights
+        x = x[: self.num_lstm, :, :, 0].permute(1, 2, 0)
+        x, _, _ = torch.lstm(
+            x,
+            self.zero_states(x.size(0)),
+            self.fused_lstm_weights(),
+            True,  # has biases
+            2,  # layers
+            0.0,  # dropout
+            self.training,
+            False,  # bidirectional
+            True,  # batch first
+        )
+        x = x[:, -1, :]
 
         # x = self.bn0(x)
         x = torch.relu(self.linear1(x))
@@ -154,6 +153,121 @@ class Policy(nn.Module):
 
         return mu, Q, V
 
+    def _fuse_lstm_weights(self):
+        """Weights of lstm0..lstm9 as the weights of a single 2 layer LSTM with num_lstm * hidden_lstm hidden units.
+
+        Every weight matrix is block diagonal, so the hidden units of a feature only see the feature and their own
+        hidden state, and the output of the fused LSTM is the concatenation of the outputs of lstm0..lstm9. Gates stay
+        in the order of torch (input, forget, cell, output), within a gate the hidden units are grouped by feature.
+
+        :return: weights in the order expected by torch.lstm
+        :rtype: list
+        """
+        lstms = [getattr(self, "lstm" + str(i)) for i in range(self.num_lstm)]
+        eye = torch.eye(self.num_lstm)
+        weights = []
+        for layer in range(2):
+            for name in ("weight_ih_l", "weight_hh_l"):
+                w = torch.stack([getattr(lstm, name + str(layer)) for lstm in lstms])
+                w = w.view(self.num_lstm, 4, self.hidden_lstm, -1)
+                weights.append(
+                    torch.einsum("sghj,st->gshtj", w, eye).reshape(
+                        4 * self.num_lstm * self.hidden_lstm, -1
+                    )
+                )
+            for name in ("bias_ih_l", "bias_hh_l"):
+                b = torch.stack([getattr(lstm, name + str(layer)) for lstm in lstms])
+                weights.append(
+                    b.view(self.num_lstm, 4, self.hidden_lstm)
+                    .transpose(0, 1)
+                    .reshape(-1)
+                )
+        return weights
+
+    def fused_lstm_weights(self):
+        """Fused LSTM weights, see _fuse_lstm_weights. Without autograd the weights are cached until a parameter of
+        lstm0..lstm9 changes in place (optimizer step, load_state_dict, soft_update) or is replaced.
+
+        :rtype: list
+        """
+        if torch.is_grad_enabled():
+            return self._fuse_lstm_weights()
+        params = [
+            p
+            for i in range(self.num_lstm)
+            for p in getattr(self, "lstm" + str(i)).parameters()
+        ]
+        key = tuple((p.data_ptr(), p._version) for p in params)
+        cache = self.__dict__.get("_fused_cache")
+        if cache is None or cache[0] != key:
+            cache = (key, self._fuse_lstm_weights())
+            self.__dict__["_fused_cache"] = cache
+        return cache[1]
+
+    def zero_states(self, batch_size):
+        """Initial hidden and cell state of the fused LSTM, cached per batch size
+
+        :rtype: tuple
+        """
+        states = self.__dict__.setdefault("_zero_states", {})
+        if batch_size not in states:
+            h0 = torch.zeros(2, batch_size, self.num_lstm * self.hidden_lstm)
+            states[batch_size] = (h0, torch.zeros_like(h0))
+        return states[batch_size]
+
+    def __getstate__(self):
+        # caches are rebuilt after loading
+        state = self.__dict__.copy()
+        state.pop("_fused_cache", None)
+        state.pop("_zero_states", None)
+        return state
+
+
+class InferencePolicy(nn.Module):
+    """Inference only copy of the part of a Policy that computes the actions (mu). The 10 LSTMs are a single nn.LSTM
+    with the fused weights of Policy.fused_lstm_weights, so that dynamic quantization can replace it and the linear
+    layers by int8 versions. The copy is always in eval mode and does not change when the Policy is trained.
+
+    :param policy: policy network to copy
+    :type policy: class:'Policy'
+    :param quantize: quantize the weights of the LSTM and the linear layers to int8, activations stay float
+    :type quantize: bool
+    """
+
+    def __init__(self, policy, quantize=True):
+        super(InferencePolicy, self).__init__()
+        self.num_lstm = policy.num_lstm
+        self.lstm = nn.LSTM(
+            self.num_lstm, self.num_lstm * policy.hidden_lstm, 2, batch_first=True
+        )
+        with torch.no_grad():
+            # nn.LSTM holds its parameters in the order of torch.lstm
+            for param, weight in zip(
+                self.lstm.parameters(), policy._fuse_lstm_weights()
+            ):
+                param.copy_(weight)
+        self.linear1 = copy.deepcopy(policy.linear1)
+        self.linear2 = copy.deepcopy(policy.linear2)
+        self.mu = copy.deepcopy(policy.mu)
+        self.quantized = quantize
+        super(InferencePolicy, self).train(False)
+        if quantize:
+            torch.ao.quantization.quantize_dynamic(
+                self, {nn.LSTM, nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+
+    def train(self, mode=True):
+        # inference only, stays in eval mode
+        return self
+
+    def forward(self, x):
+        x = x[: self.num_lstm, :, :, 0].permute(1, 2, 0)
+        x, _ = self.lstm(x)
+        x = x[:, -1, :]
+        x = torch.relu(self.linear1(x))
+        x = torch.relu(self.linear2(x))
+        return torch.tanh(self.mu(x))
+
 
 class NAF_LSTM:
     def __init__(self, gamma, tau, hidden_size, num_inputs, action_space):
@@ -166,29 +280,70 @@ class NAF_LSTM:
 
         self.gamma = gamma
         self.tau = tau
+        self.inference = None  # see prepare_inference
 
         hard_update(self.target_model, self.model)
 
-    def select_action(self, state, exploration=None):
-        self.model.eval()
-        mu, _, _ = self.model((Variable(state), None))
-        self.model.train()
-        mu = mu.data
+    def prepare_inference(self, quantize=True):
+        """Let select_action decide with an InferencePolicy copy of the model, until the next training step
+
+        :param quantize: int8 copy, see InferencePolicy
+        :type quantize: bool
+        """
+        self.inference = InferencePolicy(self.model, quantize)
+
+    def select_action(self, state, exploration=None, cache=None):
+        """Split factors of the policy network for a state
+
+        :param state: state of the environment
+        :type state: torch.Tensor
+        :param exploration: noise added to the action
+        :type exploration: class:'ounoise.OUNoise'
+        :param cache: action cache of the connection, the policy network is only evaluated for states it has no action for
+        :type cache: class:'action_cache.ActionCache'
+        :rtype: torch.Tensor
+        """
+        mu = None
+        if cache is not None:
+            signature = cache.signature(state)
+            mu = cache.get(signature, self)
+        if mu is None:
+            if self.inference is not None:
+                with torch.no_grad():
+                    mu = self.inference(state)
+            else:
+                self.model.eval()
+                with torch.no_grad():
+                    mu, _, _ = self.model((Variable(state), None))
+                self.model.train()
+                mu = mu.data
+            if cache is not None:
+                cache.put(signature, self, mu)
         if exploration is not None:
-            mu += torch.Tensor(exploration.noise())
+            # not in place, mu may be cached
+            mu = mu + torch.Tensor(exploration.noise())
 
         return mu.clamp(-1, 1)
 
-    def update_parameters(self, batch):
-        state_batch = Variable(
-            torch.cat(batch.state, dim=1)
-        )  # torch.stack(batch.state).transpose(0,1))
-        next_state_batch = Variable(torch.cat(batch.next_state, dim=1))
-        action_batch = Variable(torch.cat(batch.action))
-        reward_batch = Variable(torch.cat(batch.reward))
-        mask_batch = Variable(torch.cat(batch.mask))
-
-        _, _, next_state_values = self.target_model((next_state_batch, None))
+    def update_parameters(self, batch, weights=None):
+        """One gradient step on a batch
+
+        :param weights: importance sampling weights of the transitions for prioritized replay
+        :type weights: torch.Tensor
+        :return: loss and td errors of the transitions
+        :rtype: float, torch.Tensor
+        """
+        # the inference copy would keep the old weights
+        self.inference = None
+        # batches from ReplayMemory.sample are already concatenated, states along dim 1
+        state_batch = Variable(batch.state)
+        next_state_batch = Variable(batch.next_state)
+        action_batch = Variable(batch.action)
+        reward_batch = Variable(batch.reward)
+        mask_batch = Variable(batch.mask)
+
+        with torch.no_grad():
+            _, _, next_state_values = self.target_model((next_state_batch, None))
 
         reward_batch = torch.unsqueeze(reward_batch, 1)
         mask_batch = mask_batch.unsqueeze(1)
@@ -198,7 +353,11 @@ class NAF_LSTM:
 
         _, state_action_values, _ = self.model((state_batch, action_batch))
 
-        loss = MSELoss(state_action_values, expected_state_action_values)
+        td_errors = expected_state_action_values - state_action_values
+        if weights is None:
+            loss = MSELoss(state_action_values, expected_state_action_values)
+        else:
+            loss = torch.mean(weights.unsqueeze(1) * td_errors**2)
 
         self.optimizer.zero_grad()
         loss.backward()
@@ -207,4 +366,4 @@ class NAF_LSTM:
 
         soft_update(self.target_model, self.model, self.tau)
 
-        return loss.item(), 0  # for plotting the loss
+        return loss.item(), td_errors.detach().squeeze(1)
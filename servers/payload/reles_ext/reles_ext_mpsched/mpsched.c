@@ -2,6 +2,8 @@
 
 #include <Python.h>
 #include <linux/tcp.h>
+#include <string.h>
+#include <time.h>
 
 
 
@@ -95,10 +97,223 @@ static PyObject* set_seg(PyObject* self,PyObject* args)
 }
 
 
+/* number of values written per subflow by get_sub_info_into, in the order of get_sub_info */
+#define NUM_FIELDS 8
+
+static void read_sub_info(int fd, struct tcp_info *others, struct mptcp_sub_info *others_info)
+{
+	struct mptcp_info minfo;
+	struct mptcp_meta_info meta_info;
+	struct tcp_info initial;
+
+	memset(others, 0, sizeof(struct tcp_info) * NUM_SUBFLOWS);
+	minfo.tcp_info_len = sizeof(struct tcp_info);
+	minfo.sub_len = sizeof(struct tcp_info) * NUM_SUBFLOWS;
+	minfo.meta_len = sizeof(struct mptcp_meta_info);
+	minfo.meta_info = &meta_info;
+	minfo.initial = &initial;
+	minfo.subflows = others;
+	minfo.sub_info_len = sizeof(struct mptcp_sub_info);
+	minfo.total_sub_info_len = sizeof(struct mptcp_sub_info) * NUM_SUBFLOWS;
+	minfo.subflow_info = others_info;
+
+	socklen_t len = sizeof(minfo);
+	getsockopt(fd,SOL_TCP,MPTCP_INFO,&minfo,&len);
+}
+
+/* writes the values of the subflows reported by read_sub_info into rows of NUM_FIELDS values, returns their number */
+static int write_rows(struct tcp_info *others, struct mptcp_sub_info *others_info, unsigned int *rows, Py_ssize_t max_rows)
+{
+	int i;
+	for(i=0;i<max_rows;i++){
+		if(others[i].tcpi_state != 1)
+			break;
+		unsigned int *row = rows + i * NUM_FIELDS;
+		row[0] = others[i].tcpi_segs_out;
+		row[1] = others[i].tcpi_rtt;
+		row[2] = others[i].tcpi_snd_cwnd;
+		row[3] = others[i].tcpi_unacked;
+		row[4] = others[i].tcpi_total_retrans;
+		row[5] = others_info[i].dst_v4.sin_addr.s_addr;
+		row[6] = others[i].tcpi_rcv_ooopack;
+		row[7] = others[i].tcpi_snd_wnd;
+	}
+	return i;
+}
+
+/* Same values as get_sub_info, written into a writable C contiguous buffer of unsigned 32 bit integers with
+ * NUM_FIELDS values per subflow, e.g. a numpy array of shape (subflows, NUM_FIELDS) and dtype uint32 or a structured
+ * array with NUM_FIELDS uint32 fields. Returns the number of subflows written, rows after them are not touched. */
+static PyObject* get_sub_info_into(PyObject* self, PyObject* args)
+{
+	int fd;
+	Py_buffer view;
+	if(!PyArg_ParseTuple(args,"iw*",&fd,&view)){
+		return NULL;
+	}
+	Py_ssize_t max_rows = view.len / (Py_ssize_t)(NUM_FIELDS * sizeof(unsigned int));
+	if(max_rows < 1){
+		PyBuffer_Release(&view);
+		PyErr_SetString(PyExc_ValueError,"buffer too small for one subflow");
+		return NULL;
+	}
+	if(max_rows > NUM_SUBFLOWS)
+		max_rows = NUM_SUBFLOWS;
+
+	struct tcp_info others[NUM_SUBFLOWS];
+	struct mptcp_sub_info others_info[NUM_SUBFLOWS];
+	read_sub_info(fd,others,others_info);
+
+	int count = write_rows(others,others_info,(unsigned int *)view.buf,max_rows);
+	PyBuffer_Release(&view);
+	return PyLong_FromLong(count);
+}
+
+/* Takes samples snapshots of the subflows like get_sub_info_into, interval seconds apart on the monotonic clock, without
+ * holding the GIL. samples is a writable buffer of unsigned 32 bit integers with NUM_SUBFLOWS rows of NUM_FIELDS values
+ * per snapshot, rows of subflows that were not reported are zero. times receives the CLOCK_MONOTONIC time of every
+ * snapshot in seconds like time.monotonic, counts the number of reported subflows as 32 bit integers. Sampling stops
+ * early once no subflow is reported anymore, returns the number of snapshots taken. Raises TypeError for buffers of
+ * other types. */
+static int get_typed_buffer(PyObject* obj,Py_buffer* view,const char* kinds,Py_ssize_t itemsize,const char* message)
+{
+	if(PyObject_GetBuffer(obj,view,PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+		return -1;
+	char kind = view->format == NULL ? 'B' : view->format[strlen(view->format) - 1];
+	if(strchr(kinds,kind) == NULL || view->itemsize != itemsize){
+		PyBuffer_Release(view);
+		PyErr_SetString(PyExc_TypeError,message);
+		return -1;
+	}
+	return 0;
+}
+
+static PyObject* sample_sub_info(PyObject* self, PyObject* args)
+{
+	int fd;
+	double interval;
+	PyObject *samples_obj, *times_obj, *counts_obj;
+	Py_buffer samples, times, counts;
+	if(!PyArg_ParseTuple(args,"idOOO",&fd,&interval,&samples_obj,&times_obj,&counts_obj))
+		return NULL;
+	/* the values are written as they are, a buffer of another type would be filled with garbage */
+	if(get_typed_buffer(samples_obj,&samples,"IL",sizeof(unsigned int),"samples must be unsigned 32 bit integers") < 0)
+		return NULL;
+	if(get_typed_buffer(times_obj,&times,"d",sizeof(double),"times must be doubles") < 0){
+		PyBuffer_Release(&samples);
+		return NULL;
+	}
+	if(get_typed_buffer(counts_obj,&counts,"i",sizeof(int),"counts must be 32 bit integers") < 0){
+		PyBuffer_Release(&samples);
+		PyBuffer_Release(&times);
+		return NULL;
+	}
+	Py_ssize_t sample_size = NUM_SUBFLOWS * NUM_FIELDS * sizeof(unsigned int);
+	Py_ssize_t n = samples.len / sample_size;
+	if(times.len < n * (Py_ssize_t)sizeof(double) || counts.len < n * (Py_ssize_t)sizeof(int)){
+		PyBuffer_Release(&samples);
+		PyBuffer_Release(&times);
+		PyBuffer_Release(&counts);
+		PyErr_SetString(PyExc_ValueError,"times and counts need one value per snapshot");
+		return NULL;
+	}
+
+	struct tcp_info others[NUM_SUBFLOWS];
+	struct mptcp_sub_info others_info[NUM_SUBFLOWS];
+	long long step = interval > 0 ? (long long)(interval * 1e9) : 0;
+	struct timespec next, now;
+	Py_ssize_t taken = 0;
+
+	Py_BEGIN_ALLOW_THREADS
+	memset(samples.buf,0,n * sample_size);
+	memset(counts.buf,0,n * sizeof(int));
+	clock_gettime(CLOCK_MONOTONIC,&next);
+	while(taken < n){
+		if(taken > 0 && step > 0){
+			long long ns = next.tv_nsec + step;
+			next.tv_sec += ns / 1000000000;
+			next.tv_nsec = ns % 1000000000;
+			clock_nanosleep(CLOCK_MONOTONIC,TIMER_ABSTIME,&next,NULL);
+		}
+		read_sub_info(fd,others,others_info);
+		clock_gettime(CLOCK_MONOTONIC,&now);
+		unsigned int *rows = (unsigned int *)samples.buf + taken * NUM_SUBFLOWS * NUM_FIELDS;
+		int count = write_rows(others,others_info,rows,NUM_SUBFLOWS);
+		((double *)times.buf)[taken] = now.tv_sec + now.tv_nsec * 1e-9;
+		((int *)counts.buf)[taken] = count;
+		taken++;
+		if(count == 0)
+			break;
+	}
+	Py_END_ALLOW_THREADS
+
+	PyBuffer_Release(&samples);
+	PyBuffer_Release(&times);
+	PyBuffer_Release(&counts);
+	return PyLong_FromSsize_t(taken);
+}
+
+/* set_seg with the file descriptor as first argument and the number of segments of every subflow in a C contiguous
+ * buffer of integers, e.g. a numpy int array */
+static PyObject* set_seg_array(PyObject* self,PyObject* args)
+{
+	int fd;
+	PyObject* obj;
+	Py_buffer view;
+	if(!PyArg_ParseTuple(args,"iO",&fd,&obj))
+		return NULL;
+	if(PyObject_GetBuffer(obj,&view,PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+		return NULL;
+	char kind = view.format == NULL ? 'B' : view.format[strlen(view.format) - 1];
+	if(strchr("bBhHiIlLqQ",kind) == NULL){
+		PyBuffer_Release(&view);
+		PyErr_SetString(PyExc_TypeError,"segments must be integers");
+		return NULL;
+	}
+	Py_ssize_t length = view.len / view.itemsize;
+	if(length > NUM_SUBFLOWS)
+		length = NUM_SUBFLOWS;
+
+	struct mptcp_sched_info sched_info;
+	sched_info.len = length;
+	unsigned char quota[NUM_SUBFLOWS];
+	unsigned char segments[NUM_SUBFLOWS];
+
+	sched_info.quota = quota;
+	sched_info.num_segments = segments;
+
+	Py_ssize_t i;
+	for(i=0;i<length;i++){
+		long long elem;
+		switch(view.itemsize){
+		case 1:
+			elem = ((unsigned char *)view.buf)[i];
+			break;
+		case 2:
+			elem = ((short *)view.buf)[i];
+			break;
+		case 4:
+			elem = ((int *)view.buf)[i];
+			break;
+		default:
+			elem = ((long long *)view.buf)[i];
+			break;
+		}
+		segments[i] = (unsigned char)elem;
+	}
+	PyBuffer_Release(&view);
+	setsockopt(fd,SOL_TCP,MPTCP_SCHED_INFO,&sched_info,sizeof(sched_info));
+
+	return Py_BuildValue("i",fd);
+}
+
 static PyMethodDef Methods[]= {
 	{"persist_state", persist_state,METH_VARARGS,"persist mptcp subflows state"},
 	{"get_sub_info",get_sub_info,METH_VARARGS,"get mptcp subflow info"},
 	{"set_seg",set_seg,METH_VARARGS,"set num of segments in all mptcp subflows"},
+	{"get_sub_info_into",get_sub_info_into,METH_VARARGS,"write mptcp subflow info into a buffer"},
+	{"set_seg_array",set_seg_array,METH_VARARGS,"set num of segments in all mptcp subflows from a buffer"},
+	{"sample_sub_info",sample_sub_info,METH_VARARGS,"take timestamped snapshots of mptcp subflow info into buffers"},
 	{NULL,NULL,0,NULL}
 
 };
@@ -19,13 +19,14 @@ from os import path
 from threading import Event
 from urllib.parse import parse_qs, urlparse
 
+import mpsched_backend as mpsched
 import numpy as np
-import reles_ext_mpsched as mpsched
 import torch
-from agent import Offline_Agent, Online_Agent
+from agent import Offline_Agent, Online_Agent, set_torch_threads
+from checkpoint import ModelRegistry, save_agent
 from gym import spaces
 from naf_lstm import NAF_LSTM
-from replay_memory import ReplayMemory
+from replay_memory import FrameReplayMemory, MemmapStore, ReplayMemory, Transition
 
 # structure and modulisation based on github.com/gaogogo/Experiment
 CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
@@ -39,6 +40,9 @@ class MyHTTPHandler(http.server.SimpleHTTPRequestHandler):
 
     def do_GET(self):
         sock = self.request
+        # always in the server process: the process mode of the RELES payload runs its pool of online agents in the
+        # engine process, this payload still starts an online agent per request that pushes into the replay memory
+        # of the server
         agent = Online_Agent(
             fd=sock.fileno(),
             cfg=self.server.cfg,
@@ -116,6 +120,71 @@ class MyHTTPHandler(http.server.SimpleHTTPRequestHandler):
         return file_path
 
 
+# NAF_LSTM.update_parameters expects the state windows of a batch along dim 1
+MEMORY_CAT_DIMS = Transition(state=1, action=0, mask=0, next_state=1, reward=0)
+
+
+def create_memory(cfg, store=None):
+    """Create an empty replay memory with the storage configured in config.ini
+
+    :param cfg: contains all the neccessary parameters read from config.ini
+    :type cfg: configParser
+    :param store: store that keeps the tensors of the memory in memory-mapped files
+    :type store: class:'MemmapStore'
+    :rtype: class:'ReplayMemory' or class:'FrameReplayMemory'
+    """
+    capacity = cfg.getint("replaymemory", "capacity")
+    dtype = getattr(torch, cfg.get("replaymemory", "dtype"))
+    if cfg.get("replaymemory", "storage") == "frames":
+        return FrameReplayMemory(
+            capacity,
+            dtype=dtype,
+            store=store,
+            max_gap=cfg.getint("replaymemory", "max_gap"),
+        )
+    return ReplayMemory(capacity, dtype=dtype, cat_dims=MEMORY_CAT_DIMS, store=store)
+
+
+def load_memory(cfg, memory_file, store_dir, continue_train):
+    """Attach to the replay memory of the memory-mapped store. A replay memory pickled by earlier versions is moved
+    into the store once. Without continue_train the store starts empty.
+
+    :param cfg: contains all the neccessary parameters read from config.ini
+    :type cfg: configParser
+    :param memory_file: pickled replay memory of earlier versions
+    :type memory_file: str
+    :param store_dir: directory of the memory-mapped store
+    :type store_dir: str
+    :param continue_train: keep the transitions of previous runs
+    :type continue_train: bool
+    :rtype: class:'ReplayMemory' or class:'FrameReplayMemory'
+    """
+    if not continue_train and os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    store = MemmapStore(store_dir)
+    if continue_train and store.exists():
+        memory = store.load()
+        print(f"Attached to replay memory with {len(memory)} transitions")
+        return memory
+
+    memory = create_memory(cfg, store)
+    if continue_train and os.path.exists(memory_file):
+        with open(memory_file, "rb") as f:
+            try:
+                pickled = pickle.load(f)
+            except EOFError:
+                print("memory EOF error not saved properly")
+                pickled = None
+        if pickled is not None:
+            if isinstance(pickled, ReplayMemory):
+                # memories pickled as a list of transitions do not know the layout
+                pickled.cat_dims = MEMORY_CAT_DIMS
+            memory.extend(pickled)
+            store.flush()
+            print(f"Moved {len(memory)} transitions of {memory_file} into {store_dir}")
+    return memory
+
+
 class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
     """ThreadedHTTPServer class initialized with (IP,PORT),HTTPRequestHandler"""
 
@@ -132,6 +201,11 @@ def main():
         default=1,
         help="Continue training from previous state (0: No, 1: Yes)",
     )
+    parser.add_argument(
+        "--model_version",
+        type=int,
+        help="Start from this version of artifacts/trained_models/registry.json instead of the last model",
+    )
 
     parser.add_argument(
         "--debug", action="store_true", help="Enable remote debugging with debugpy"
@@ -151,6 +225,7 @@ def main():
     IP = args.ip
     PORT = args.port
     MEMORY_FILE = str((TMP_DIR / cfg.get("replaymemory", "memory")).resolve())
+    STORE_DIR = str((TMP_DIR / cfg.get("replaymemory", "store")).resolve())
     AGENT_FILE = str((TMP_DIR / cfg.get("nafcnn", "agent")).resolve())
     INTERVAL = cfg.getint("train", "interval")
     EPISODE = cfg.getint("train", "episode")
@@ -162,21 +237,27 @@ def main():
     now = datetime.now().replace(microsecond=0)
     start_train = now.strftime("%Y-%m-%d %H:%M:%S")
 
-    if os.path.exists(MEMORY_FILE) and CONTINUE_TRAIN:
-        with open(MEMORY_FILE, "rb") as f:
-            try:
-                memory = pickle.load(f)
-                f.close()
-            except EOFError:
-                print("memory EOF error not saved properly")
-                memory = ReplayMemory(cfg.getint("replaymemory", "capacity"))
-    else:
-        memory = ReplayMemory(cfg.getint("replaymemory", "capacity"))
-
-    if CONTINUE_TRAIN != 1 and os.path.exists(AGENT_FILE):
-        os.makedirs("trained_models/", exist_ok=True)
-        shutil.move(AGENT_FILE, "trained_models/agent" + start_train + ".pkl")
-    if not os.path.exists(AGENT_FILE) or CONTINUE_TRAIN != 1:
+    # one process for online and offline agents, they share the torch threads
+    set_torch_threads(cfg.getint("train", "num_threads"))
+    memory = load_memory(cfg, MEMORY_FILE, STORE_DIR, CONTINUE_TRAIN)
+    memory.store.flush_periodically(cfg.getfloat("replaymemory", "flush_interval"))
+
+    # a model pickled by earlier versions is converted once
+    legacy = str(pathlib.Path(AGENT_FILE).with_suffix(".pkl"))
+    if not os.path.exists(AGENT_FILE) and os.path.exists(legacy):
+        save_agent(AGENT_FILE, torch.load(legacy))
+        os.remove(legacy)
+        print(f"Converted {legacy} into {AGENT_FILE}")
+    registry = ModelRegistry(str(TMP_DIR / "trained_models"))
+    if os.path.exists(AGENT_FILE) and (
+        CONTINUE_TRAIN != 1 or args.model_version is not None
+    ):
+        version = registry.register(AGENT_FILE)
+        print(f"Model of the last run is version {version}")
+    if args.model_version is not None:
+        version = registry.restore(args.model_version, AGENT_FILE)
+        print(f"Starting from model version {version}")
+    elif not os.path.exists(AGENT_FILE) or CONTINUE_TRAIN != 1:
         pathlib.Path(AGENT_FILE).parent.mkdir(parents=True, exist_ok=True)
         agent = NAF_LSTM(
             gamma=cfg.getfloat("nafcnn", "gamma"),
@@ -185,7 +266,7 @@ def main():
             num_inputs=MAX_NUM_FLOWS * 5,
             action_space=MAX_NUM_FLOWS,
         )  # 5 is the size of state space (TP,RTT,CWND,unACK,retrans)
-        torch.save(agent, AGENT_FILE)
+        save_agent(AGENT_FILE, agent)
 
     off_agent = Offline_Agent(
         cfg=cfg, model=AGENT_FILE, memory=memory, event=transfer_event
@@ -205,13 +286,9 @@ def main():
                 off_agent.start()
             time.sleep(25)
             pass
-        with open(MEMORY_FILE, "wb") as f:
-            pickle.dump(memory, f)
-            f.close()
+        memory.store.flush()
     except (KeyboardInterrupt, SystemExit):
-        with open(MEMORY_FILE, "wb") as f:
-            pickle.dump(memory, f)
-            f.close()
+        memory.store.flush()
 
 
 if __name__ == "__main__":
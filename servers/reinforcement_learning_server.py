@@ -73,6 +73,7 @@ class RELESServer(IServer):
         port = config.test.get("server_port", None)
         debug = self.server_params.get("server_debug", False)
         continue_train = self.server_params.get("continue_train", None)
+        model_version = self.server_params.get("model_version", None)
 
         cmd = f"python3 {self.payload_location}/reles_server_payload.py --ip {self.server_host.ip_address()[0]}"
 
@@ -84,6 +85,8 @@ class RELESServer(IServer):
 
         if continue_train:
             cmd += f" --continue_train {int(continue_train)}"
+        if model_version is not None:
+            cmd += f" --model_version {int(model_version)}"
 
         self.execution_instance = self.server_host.cmdWithErrorCheckNonBlocking(cmd)
         self.__logger.info(
@@ -169,6 +172,7 @@ class RELESExtServer(IServer):
         port = config.test.get("server_port", None)
         debug = self.server_params.get("server_debug", False)
         continue_train = self.server_params.get("continue_train", None)
+        model_version = self.server_params.get("model_version", None)
 
         cmd = f"python3 {self.payload_location}/reles_ext_server_payload.py --ip {self.server_host.ip_address()[0]}"
 
@@ -178,6 +182,8 @@ class RELESExtServer(IServer):
             cmd += f" --debug"
         if continue_train:
             cmd += f" --continue_train {int(continue_train)}"
+        if model_version is not None:
+            cmd += f" --model_version {int(model_version)}"
 
         self.execution_instance = self.server_host.cmdWithErrorCheckNonBlocking(cmd)
         self.__logger.info(